@@ -0,0 +1,143 @@
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from typing import Dict, List, Optional
+
+from ctf_benchmarks.stub_anvil import run_stub_anvil
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+
+    raise TimeoutError(f"nothing listening on port {port}")
+
+
+def run_proxy(
+    port: int,
+    stub_port: int,
+    instances: Dict[str, List[str]],
+    env: Dict[str, str],
+    ready,
+):
+    # anvil_proxy reads its configuration at import, so only import it now
+    os.environ.update(env)
+
+    import uvicorn
+
+    import ctf_server
+
+    from ctf_benchmarks.memorydb import AsyncMemoryDatabase
+    from ctf_server.proxy.supervisor import ProxyWebSocketProtocol
+
+    proxy = sys.modules["ctf_server.anvil_proxy"]
+    # an in-memory database that only this process sees, filled before serving
+    proxy.load_database = lambda asynchronous=False: AsyncMemoryDatabase()
+
+    async def serve():
+        server = uvicorn.Server(
+            uvicorn.Config(
+                proxy.app,
+                host="127.0.0.1",
+                port=port,
+                log_level="warning",
+                ws=ProxyWebSocketProtocol,
+            )
+        )
+        task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+
+        for external_id, anvil_ids in instances.items():
+            await proxy.database.register_instance(
+                external_id,
+                {
+                    "instance_id": external_id,
+                    "external_id": external_id,
+                    "created_at": time.time(),
+                    "expires_at": time.time() + 86400,
+                    "anvil_instances": {
+                        anvil_id: {"id": anvil_id, "ip": "127.0.0.1", "port": stub_port}
+                        for anvil_id in anvil_ids
+                    },
+                    "daemon_instances": {},
+                    "metadata": {},
+                },
+            )
+
+        ready.set()
+        await task
+
+    asyncio.run(serve())
+
+
+class Environment:
+    # a stub anvil and an anvil_proxy routing the given instances to it, each in
+    # its own process so the load generator doesn't compete with them
+    def __init__(
+        self,
+        instances: Dict[str, List[str]],
+        latency: float = 0,
+        response_size: int = 0,
+        block_time: float = 1,
+        env: Optional[Dict[str, str]] = None,
+        logs_per_block: int = 0,
+    ):
+        self.stub_port = free_port()
+        self.proxy_port = free_port()
+        self.proxy_url = f"http://127.0.0.1:{self.proxy_port}"
+
+        context = multiprocessing.get_context("spawn")
+        self.__ready = context.Event()
+        self.__processes = [
+            context.Process(
+                target=run_stub_anvil,
+                args=(
+                    "127.0.0.1",
+                    self.stub_port,
+                    latency,
+                    block_time,
+                    response_size,
+                    logs_per_block,
+                ),
+                daemon=True,
+            ),
+            context.Process(
+                target=run_proxy,
+                args=(self.proxy_port, self.stub_port, instances, env or {}, self.__ready),
+                daemon=True,
+            ),
+        ]
+
+    def __enter__(self) -> "Environment":
+        for process in self.__processes:
+            process.start()
+
+        wait_for_port(self.stub_port)
+        if not self.__ready.wait(60):
+            raise TimeoutError("anvil_proxy didn't start")
+        return self
+
+    @property
+    def proxy_pid(self) -> int:
+        return self.__processes[1].pid
+
+    def __exit__(self, *args):
+        for process in self.__processes:
+            process.terminate()
+        for process in self.__processes:
+            process.join()
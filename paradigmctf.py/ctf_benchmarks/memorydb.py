@@ -0,0 +1,53 @@
+from typing import Dict, List, Optional
+
+from ctf_server.databases.asyncdatabase import AsyncDatabase
+from ctf_server.types import InstanceEvent, UserData
+
+
+class AsyncMemoryDatabase(AsyncDatabase):
+    # stands in for redis so benchmarks measure the proxy and not the database
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.__instances: Dict[str, UserData] = {}
+        self.__by_external_id: Dict[str, str] = {}
+
+    async def register_instance(self, instance_id: str, instance: UserData):
+        self.__instances[instance_id] = instance
+        self.__by_external_id[instance["external_id"]] = instance_id
+
+        self._dispatch_instance_event(
+            InstanceEvent(
+                type="register",
+                instance_id=instance_id,
+                external_id=instance["external_id"],
+            )
+        )
+
+    async def unregister_instance(self, instance_id: str) -> UserData:
+        instance = self.__instances.pop(instance_id, None)
+        if instance is None:
+            return None
+
+        del self.__by_external_id[instance["external_id"]]
+        self._dispatch_instance_event(
+            InstanceEvent(
+                type="unregister",
+                instance_id=instance_id,
+                external_id=instance["external_id"],
+            )
+        )
+        return instance
+
+    async def get_instance(self, instance_id: str) -> Optional[UserData]:
+        return self.__instances.get(instance_id)
+
+    async def get_instance_by_external_id(self, external_id: str) -> Optional[UserData]:
+        instance_id = self.__by_external_id.get(external_id)
+        if instance_id is None:
+            return None
+
+        return self.__instances.get(instance_id)
+
+    async def get_expired_instances(self) -> List[UserData]:
+        return []
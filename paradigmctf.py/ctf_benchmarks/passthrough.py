@@ -0,0 +1,108 @@
+import argparse
+import json
+import random
+import time
+from typing import Callable, List
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+
+def make_logs_response(size: int) -> bytes:
+    rng = random.Random(size)
+
+    logs = []
+    encoded_size = 0
+    while encoded_size < size:
+        log = {
+            "address": "0x" + rng.randbytes(20).hex(),
+            "topics": ["0x" + rng.randbytes(32).hex() for _ in range(3)],
+            "data": "0x" + rng.randbytes(256).hex(),
+            "blockNumber": hex(rng.randrange(1 << 24)),
+            "blockHash": "0x" + rng.randbytes(32).hex(),
+            "transactionHash": "0x" + rng.randbytes(32).hex(),
+            "transactionIndex": hex(rng.randrange(256)),
+            "logIndex": hex(len(logs)),
+            "removed": False,
+        }
+        logs.append(log)
+        encoded_size += len(orjson.dumps(log)) + 1
+
+    return orjson.dumps({"jsonrpc": "2.0", "id": 1, "result": logs})
+
+
+REQUEST = orjson.dumps(
+    {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": "eth_getLogs",
+        "params": [{"fromBlock": "0x0", "toBlock": "latest"}],
+    }
+)
+
+
+# request.json(), session.post(json=...), resp.json(), then fastapi's JSONResponse
+def parsed_path(request: bytes, response: bytes) -> int:
+    body = json.loads(request)
+    upstream_request = json.dumps(body).encode()
+    upstream_response = json.loads(response)
+    client_response = json.dumps(
+        jsonable_encoder(upstream_response),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+    return len(upstream_request) + len(client_response)
+
+
+# orjson validation of the request, bytes forwarded in both directions
+def passthrough_path(request: bytes, response: bytes) -> int:
+    body = orjson.loads(request)
+    if not isinstance(body, dict) or "id" not in body or "method" not in body:
+        raise ValueError("invalid request")
+    return len(request) + len(response)
+
+
+def measure(fn: Callable[[bytes, bytes], int], response: bytes, min_time: float) -> float:
+    iterations = 0
+    start = time.process_time()
+    while True:
+        fn(REQUEST, response)
+        iterations += 1
+
+        elapsed = time.process_time() - start
+        if elapsed >= min_time:
+            return elapsed / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="cpu cost of proxying a single json-rpc request, per MB of reply"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=lambda v: [int(x) for x in v.split(",")],
+        default=[16 * 1024, 256 * 1024, 1024 * 1024, 8 * 1024 * 1024],
+        help="comma separated reply sizes in bytes",
+    )
+    parser.add_argument("--min-time", type=float, default=1.0)
+    args = parser.parse_args()
+
+    print(
+        f"{'reply size':>12} {'parsed ms/MB':>14} {'passthrough ms/MB':>18} {'saved ms/MB':>12}"
+    )
+    for size in args.sizes:
+        response = make_logs_response(size)
+        mb = len(response) / (1024 * 1024)
+
+        parsed = measure(parsed_path, response, args.min_time) / mb * 1000
+        passthrough = measure(passthrough_path, response, args.min_time) / mb * 1000
+
+        print(
+            f"{len(response):>12} {parsed:>14.3f} {passthrough:>18.4f} {parsed - passthrough:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
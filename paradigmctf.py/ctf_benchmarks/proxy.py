@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import aiohttp
+import orjson
+
+from ctf_benchmarks.environment import Environment
+from ctf_benchmarks.replay import percentile
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+ADDRESS = "0x" + "11" * 20
+FORBIDDEN_METHODS = ["eth_sign", "eth_sendTransaction", "debug_traceTransaction", "admin_addPeer"]
+
+
+@dataclass
+class Result:
+    scenario: str
+    requests: int = 0
+    errors: int = 0
+    # json-rpc errors, e.g. forbidden methods in the mixed scenario
+    rejected: int = 0
+    seconds: float = 0
+    requests_per_second: float = 0
+    p50_ms: float = 0
+    p99_ms: float = 0
+    proxy_cpu_ms_per_request: Optional[float] = None
+    proxy_rss_mb: Optional[float] = None
+    notifications: int = 0
+    latencies: List[float] = field(default_factory=list, repr=False)
+
+
+class ProcessStats:
+    # cpu time and memory of another process, read from /proc
+    def __init__(self, pid: int):
+        self.__pid = pid
+
+    def cpu_seconds(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.__pid}/stat") as f:
+                # the command name may contain spaces, fields start after it
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def rss_mb(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.__pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+
+def call(method: str, params: List, request_id: Any = 1) -> Dict:
+    return {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+
+
+def single_body(rng: random.Random) -> Any:
+    return call("eth_call", [{"to": ADDRESS, "data": "0x" + rng.randbytes(36).hex()}, "latest"])
+
+
+def batch_body(rng: random.Random) -> Any:
+    return [
+        call("eth_getBalance", ["0x" + rng.randbytes(20).hex(), "latest"], i) for i in range(100)
+    ]
+
+
+def mixed_body(rng: random.Random) -> Any:
+    roll = rng.random()
+    if roll < 0.2:
+        return call(rng.choice(FORBIDDEN_METHODS), [])
+    if roll < 0.3:
+        return call("eth_blockNumber", [])
+    if roll < 0.4:
+        return call("eth_chainId", [])
+    return single_body(rng)
+
+
+def large_body(rng: random.Random) -> Any:
+    # the stub pads the reply to the size after the colon
+    return call("eth_getBlockReceipts", ["latest"], "1:1048576")
+
+
+def logs_body(rng: random.Random) -> Any:
+    # wide enough to be split into ranges by the proxy
+    start = rng.randrange(0, 10000)
+    return call("eth_getLogs", [{"fromBlock": hex(start), "toBlock": hex(start + 20000)}])
+
+
+HTTP_SCENARIOS: Dict[str, Callable[[random.Random], Any]] = {
+    "single": single_body,
+    "batch": batch_body,
+    "mixed": mixed_body,
+    "large": large_body,
+    "logs": logs_body,
+}
+
+
+async def run_http(
+    env: Environment,
+    make_body: Callable,
+    result: Result,
+    concurrency: int,
+    duration: float,
+    paths: List[str],
+):
+    deadline = time.monotonic() + duration
+
+    async def worker(seed: int, session: aiohttp.ClientSession):
+        rng = random.Random(seed)
+        for path in itertools.cycle(paths[seed % len(paths) :] + paths[: seed % len(paths)]):
+            if time.monotonic() > deadline:
+                return
+
+            body = orjson.dumps(make_body(rng))
+            started_at = time.monotonic()
+            try:
+                async with session.post(env.proxy_url + path, data=body) as resp:
+                    data = await resp.read()
+                    if resp.status != 200:
+                        result.errors += 1
+                    elif b'"error"' in data:
+                        result.rejected += 1
+            except aiohttp.ClientError:
+                result.errors += 1
+                continue
+
+            result.latencies.append(time.monotonic() - started_at)
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[worker(i, session) for i in range(concurrency)])
+
+
+async def run_websocket(
+    env: Environment, result: Result, concurrency: int, duration: float, paths: List[str]
+):
+    deadline = time.monotonic() + duration
+
+    async def client(seed: int, session: aiohttp.ClientSession):
+        url = env.proxy_url.replace("http", "ws", 1) + paths[seed % len(paths)] + "/ws"
+        async with session.ws_connect(url, max_msg_size=0) as ws:
+            await ws.send_str(orjson.dumps(call("eth_subscribe", ["newHeads"], 0)).decode())
+
+            pending: Dict[int, float] = {}
+            next_id = itertools.count(1)
+
+            async def send():
+                request_id = next(next_id)
+                pending[request_id] = time.monotonic()
+                await ws.send_str(orjson.dumps(call("eth_blockNumber", [], request_id)).decode())
+
+            await send()
+            async for message in ws:
+                response = orjson.loads(message.data)
+                if response.get("method") == "eth_subscription":
+                    result.notifications += 1
+                elif response.get("id") in pending:
+                    result.latencies.append(time.monotonic() - pending.pop(response["id"]))
+                    if "error" in response:
+                        result.rejected += 1
+
+                    if time.monotonic() > deadline:
+                        return
+                    await send()
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[client(i, session) for i in range(concurrency)])
+
+
+def run_scenario(
+    scenario: str,
+    concurrency: int,
+    duration: float,
+    instances: int,
+    latency: float,
+) -> Result:
+    external_ids = [f"bench{i}" for i in range(instances)]
+    paths = [f"/{external_id}/main" for external_id in external_ids]
+
+    # benchmarks measure the proxy, not the rate limiter
+    env_vars = {"RATE_LIMIT_RATE": "0"}
+    with Environment(
+        {external_id: ["main"] for external_id in external_ids},
+        latency=latency,
+        block_time=0.1,
+        env=env_vars,
+        logs_per_block=1,
+    ) as env:
+        stats = ProcessStats(env.proxy_pid)
+        result = Result(scenario=scenario)
+
+        cpu_before = stats.cpu_seconds()
+        started_at = time.monotonic()
+        if scenario == "websocket":
+            asyncio.run(run_websocket(env, result, concurrency, duration, paths))
+        else:
+            asyncio.run(
+                run_http(env, HTTP_SCENARIOS[scenario], result, concurrency, duration, paths)
+            )
+        result.seconds = time.monotonic() - started_at
+        cpu_after = stats.cpu_seconds()
+
+        result.requests = len(result.latencies)
+        result.requests_per_second = result.requests / result.seconds
+        result.p50_ms = percentile(result.latencies, 0.5) * 1000
+        result.p99_ms = percentile(result.latencies, 0.99) * 1000
+        if cpu_before is not None and cpu_after is not None and result.requests > 0:
+            result.proxy_cpu_ms_per_request = (cpu_after - cpu_before) * 1000 / result.requests
+        result.proxy_rss_mb = stats.rss_mb()
+
+    return result
+
+
+def print_results(results: List[Result]):
+    def fmt(value: Optional[float], spec: str) -> str:
+        return "n/a" if value is None else format(value, spec)
+
+    print(
+        f"{'scenario':<10} {'requests':>9} {'errors':>7} {'rejected':>9} {'req/s':>9} {'p50':>9} {'p99':>9} "
+        f"{'cpu/req':>10} {'rss':>8} {'notifs':>8}"
+    )
+    for result in results:
+        print(
+            f"{result.scenario:<10} {result.requests:>9} {result.errors:>7} {result.rejected:>9} "
+            f"{result.requests_per_second:>9.0f} {result.p50_ms:>7.2f}ms {result.p99_ms:>7.2f}ms "
+            f"{fmt(result.proxy_cpu_ms_per_request, '.3f'):>8}ms {fmt(result.proxy_rss_mb, '.0f'):>6}MB "
+            f"{result.notifications:>8}"
+        )
+
+
+def main():
+    scenarios = list(HTTP_SCENARIOS) + ["websocket"]
+
+    parser = argparse.ArgumentParser(
+        description="measure anvil_proxy throughput against a stub anvil"
+    )
+    parser.add_argument(
+        "--scenario", action="append", choices=scenarios, help="run only this scenario, repeatable"
+    )
+    parser.add_argument("--concurrency", type=int, default=64, help="clients in flight")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--instances", type=int, default=16, help="instances to spread load over")
+    parser.add_argument("--latency", type=float, default=0, help="stub anvil latency in seconds")
+    parser.add_argument("--json", action="store_true", help="print results as json lines")
+    args = parser.parse_args()
+
+    results = []
+    for scenario in args.scenario or scenarios:
+        result = run_scenario(
+            scenario, args.concurrency, args.duration, args.instances, args.latency
+        )
+        results.append(result)
+
+        if args.json:
+            summary = asdict(result)
+            del summary["latencies"]
+            print(orjson.dumps(summary).decode(), flush=True)
+
+    if not args.json:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import argparse
+import asyncio
+import glob
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import orjson
+
+from ctf_benchmarks.environment import Environment
+from ctf_server.proxy.capture import CapturedCall, CapturedRequest, read_captures
+
+
+def percentile(values: List[float], p: float) -> float:
+    if len(values) == 0:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def make_params(call: CapturedCall) -> List:
+    if call.method == "eth_subscribe":
+        return ["newHeads"]
+
+    # something of the recorded size; the stub doesn't look at it
+    if call.params_size <= 4:
+        return []
+    return ["0x" + "0" * max(0, call.params_size - 6)]
+
+
+class Replayer:
+    def __init__(self, requests: List[CapturedRequest], proxy_url: str, speed: float):
+        self.__requests = requests
+        self.__proxy_url = proxy_url
+        self.__speed = speed
+
+        self.__next_id = 0
+        # method -> latencies in seconds
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        # how far behind schedule requests went out, i.e. whether the driver kept up
+        self.lag: List[float] = []
+
+        self.__websockets: Dict[Tuple[int, int], "ReplayWebSocket"] = {}
+
+    async def run(self):
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.__session = session
+
+            started_at = time.monotonic()
+            first = self.__requests[0].timestamp
+            tasks = []
+            for request in self.__requests:
+                due = started_at + (request.timestamp - first) / self.__speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                self.lag.append(max(0, -delay))
+                tasks.append(asyncio.create_task(self.__send(request)))
+
+            await asyncio.gather(*tasks)
+
+            for ws in self.__websockets.values():
+                await ws.close()
+
+    def __make_body(self, request: CapturedRequest):
+        # spread the recorded reply size over the calls, the stub pads to match
+        share = request.response_size // max(1, len(request.calls))
+
+        calls = []
+        for call in request.calls:
+            self.__next_id += 1
+            calls.append(
+                {
+                    "jsonrpc": "2.0",
+                    "id": f"{self.__next_id}:{share}",
+                    "method": call.method,
+                    "params": make_params(call),
+                }
+            )
+
+        return calls if request.batch else calls[0]
+
+    async def __send(self, request: CapturedRequest):
+        if len(request.calls) == 0:
+            return
+
+        label = "batch" if request.batch else request.calls[0].method
+        path = f"/replay{request.instance:08x}/node{request.node:08x}"
+        body = self.__make_body(request)
+
+        started_at = time.monotonic()
+        try:
+            if request.websocket:
+                ws = self.__websockets.get((request.instance, request.node))
+                if ws is None:
+                    ws = ReplayWebSocket(self.__proxy_url.replace("http", "ws", 1) + path + "/ws")
+                    self.__websockets[(request.instance, request.node)] = ws
+                response = await ws.call(body)
+            else:
+                async with self.__session.post(
+                    self.__proxy_url + path, data=orjson.dumps(body)
+                ) as resp:
+                    response = orjson.loads(await resp.read())
+
+            if isinstance(response, dict) and "error" in response:
+                self.errors[label] += 1
+        except Exception:
+            self.errors[label] += 1
+            return
+
+        self.latencies[label].append(time.monotonic() - started_at)
+
+
+class ReplayWebSocket:
+    def __init__(self, url: str):
+        self.__url = url
+        self.__connected: Optional[asyncio.Task] = None
+        self.__pending: Dict[str, asyncio.Future] = {}
+
+    async def call(self, body: Dict) -> Dict:
+        if self.__connected is None:
+            self.__connected = asyncio.create_task(self.__connect())
+        await self.__connected
+
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[body["id"]] = future
+        await self.__ws.send_str(orjson.dumps(body).decode())
+        return await future
+
+    async def close(self):
+        if self.__connected is not None:
+            await self.__ws.close()
+            await self.__session.close()
+
+    async def __connect(self):
+        self.__session = aiohttp.ClientSession()
+        self.__ws = await self.__session.ws_connect(self.__url, max_msg_size=0)
+        asyncio.create_task(self.__read())
+
+    async def __read(self):
+        async for message in self.__ws:
+            response = orjson.loads(message.data)
+            if isinstance(response, dict) and "id" in response:
+                future = self.__pending.pop(response["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("websocket closed"))
+
+
+def find_captures(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += glob.glob(os.path.join(path, "*.bin"))
+        else:
+            files.append(path)
+    return files
+
+
+def report(replayer: Replayer, elapsed: float, total: int):
+    print(f"replayed {total} requests in {elapsed:.1f}s ({total / elapsed:.0f} req/s)")
+    print(
+        f"driver lag p50 {percentile(replayer.lag, 0.5) * 1000:.1f}ms "
+        f"p99 {percentile(replayer.lag, 0.99) * 1000:.1f}ms"
+    )
+    print()
+    print(f"{'method':<40} {'count':>8} {'errors':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    methods = set(replayer.latencies) | set(replayer.errors)
+    for method in sorted(methods, key=lambda m: -len(replayer.latencies[m])):
+        latencies = replayer.latencies[method]
+        print(
+            f"{method:<40} {len(latencies):>8} {replayer.errors.get(method, 0):>7}"
+            + "".join(
+                f" {percentile(latencies, p) * 1000:>7.2f}ms" for p in (0.5, 0.9, 0.99, 1)
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="replay captured anvil_proxy traffic against a proxy backed by a stub anvil"
+    )
+    parser.add_argument("captures", nargs="+", help="capture files or directories")
+    parser.add_argument("--speed", type=float, default=1, help="1 for real time, 2 for twice as fast")
+    parser.add_argument("--latency", type=float, default=0, help="stub anvil latency in seconds")
+    parser.add_argument("--limit", type=int, default=None, help="only replay the first n requests")
+    args = parser.parse_args()
+
+    requests = read_captures(find_captures(args.captures))[: args.limit]
+    if len(requests) == 0:
+        raise SystemExit("no requests captured")
+
+    instances: Dict[str, List[str]] = defaultdict(list)
+    for request in requests:
+        anvil_id = f"node{request.node:08x}"
+        external_id = f"replay{request.instance:08x}"
+        if anvil_id not in instances[external_id]:
+            instances[external_id].append(anvil_id)
+
+    # the replay shouldn't be throttled unless it's replaying a rate limit
+    with Environment(instances, latency=args.latency, env={"RATE_LIMIT_RATE": "0"}) as env:
+        replayer = Replayer(requests, env.proxy_url, args.speed)
+
+        started_at = time.monotonic()
+        asyncio.run(replayer.run())
+        elapsed = time.monotonic() - started_at
+
+    report(replayer, elapsed, len(requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import secrets
+from typing import Any, Dict, List
+
+import orjson
+from aiohttp import WSMsgType, web
+
+CHAIN_ID = "0x7a69"
+
+
+def response_size_hint(request_id: Any) -> int:
+    # the replay driver asks for a reply of a given size with ids like "12:4096"
+    if isinstance(request_id, str) and ":" in request_id:
+        try:
+            return int(request_id.rsplit(":", 1)[1])
+        except ValueError:
+            pass
+    return 0
+
+
+class StubAnvil:
+    def __init__(
+        self,
+        latency: float = 0,
+        block_time: float = 1,
+        response_size: int = 0,
+        logs_per_block: int = 0,
+    ):
+        self.__latency = latency
+        self.__block_time = block_time
+        # size of replies to calls that don't ask for one
+        self.__response_size = response_size
+        # eth_getLogs answers with this many logs for every block in the range
+        self.__logs_per_block = logs_per_block
+        self.__block_number = 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/", self.__http)
+        app.router.add_get("/", self.__websocket)
+        return app
+
+    def answer(self, request: Any) -> Dict:
+        if not isinstance(request, dict):
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": -32600, "message": "invalid"}}
+
+        method = request.get("method")
+        if method == "eth_chainId":
+            result = CHAIN_ID
+        elif method == "net_version":
+            result = str(int(CHAIN_ID, 16))
+        elif method == "eth_blockNumber":
+            self.__block_number += 1
+            result = hex(self.__block_number)
+        elif method == "eth_getLogs" and self.__logs_per_block > 0:
+            result = self.__logs(request.get("params") or [{}])
+        else:
+            size = response_size_hint(request.get("id")) or self.__response_size
+            result = "0x" + "00" * max(0, (size - 48) // 2)
+
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+
+    def __logs(self, params: List) -> List[Dict]:
+        log_filter = params[0] if len(params) > 0 and isinstance(params[0], dict) else {}
+
+        def block(key: str) -> int:
+            value = log_filter.get(key, "latest")
+            return int(value, 16) if value.startswith("0x") else self.__block_number
+
+        return [
+            {
+                "address": "0x" + "11" * 20,
+                "blockNumber": hex(number),
+                "logIndex": hex(index),
+                "topics": ["0x" + "22" * 32],
+                "data": "0x" + "00" * 64,
+            }
+            for number in range(block("fromBlock"), block("toBlock") + 1)
+            for index in range(self.__logs_per_block)
+        ]
+
+    async def __http(self, request: web.Request) -> web.Response:
+        body = orjson.loads(await request.read())
+        if self.__latency > 0:
+            await asyncio.sleep(self.__latency)
+
+        if isinstance(body, list):
+            response = [self.answer(r) for r in body]
+        else:
+            response = self.answer(body)
+
+        return web.Response(body=orjson.dumps(response), content_type="application/json")
+
+    async def __websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=64 * 1024 * 1024)
+        await ws.prepare(request)
+
+        tickers = {}
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+
+                body = orjson.loads(message.data)
+                if self.__latency > 0:
+                    await asyncio.sleep(self.__latency)
+
+                if isinstance(body, dict) and body.get("method") == "eth_subscribe":
+                    subscription_id = "0x" + secrets.token_hex(16)
+                    tickers[subscription_id] = asyncio.create_task(
+                        self.__notify(ws, subscription_id)
+                    )
+                    response = {"jsonrpc": "2.0", "id": body.get("id"), "result": subscription_id}
+                elif isinstance(body, dict) and body.get("method") == "eth_unsubscribe":
+                    params = body.get("params") or [None]
+                    ticker = tickers.pop(params[0], None)
+                    if ticker is not None:
+                        ticker.cancel()
+                    response = {"jsonrpc": "2.0", "id": body.get("id"), "result": ticker is not None}
+                else:
+                    response = self.answer(body)
+
+                await ws.send_str(orjson.dumps(response).decode())
+        finally:
+            for ticker in tickers.values():
+                ticker.cancel()
+
+        return ws
+
+    async def __notify(self, ws: web.WebSocketResponse, subscription_id: str):
+        while not ws.closed:
+            await asyncio.sleep(self.__block_time)
+            self.__block_number += 1
+            await ws.send_str(
+                orjson.dumps(
+                    {
+                        "jsonrpc": "2.0",
+                        "method": "eth_subscription",
+                        "params": {
+                            "subscription": subscription_id,
+                            "result": {"number": hex(self.__block_number)},
+                        },
+                    }
+                ).decode()
+            )
+
+
+def run_stub_anvil(
+    host: str,
+    port: int,
+    latency: float = 0,
+    block_time: float = 1,
+    response_size: int = 0,
+    logs_per_block: int = 0,
+):
+    web.run_app(
+        StubAnvil(
+            latency=latency,
+            block_time=block_time,
+            response_size=response_size,
+            logs_per_block=logs_per_block,
+        ).make_app(),
+        host=host,
+        port=port,
+        print=None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="answer json-rpc like anvil would, as fast as possible"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8546)
+    parser.add_argument("--latency", type=float, default=0, help="seconds to wait before answering")
+    parser.add_argument("--block-time", type=float, default=1)
+    parser.add_argument("--response-size", type=int, default=0, help="bytes per reply")
+    parser.add_argument("--logs-per-block", type=int, default=0, help="logs in every block")
+    args = parser.parse_args()
+
+    run_stub_anvil(
+        args.host,
+        args.port,
+        args.latency,
+        args.block_time,
+        args.response_size,
+        args.logs_per_block,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ import abc
 import os
 import traceback
 from dataclasses import dataclass
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Optional
 
 import requests
 from ctf_launchers.team_provider import TeamProvider
@@ -11,6 +11,9 @@ from ctf_server.types import (
     CreateInstanceRequest,
     DaemonInstanceArgs,
     LaunchAnvilInstanceArgs,
+    LaunchJobInfo,
+    RateLimitArgs,
+    RpcPolicyArgs,
     UserData,
     get_player_account,
     get_privileged_web3,
@@ -24,6 +27,12 @@ PUBLIC_HOST = os.getenv("PUBLIC_HOST", "http://127.0.0.1:8545")
 ETH_RPC_URL = os.getenv("ETH_RPC_URL")
 TIMEOUT = int(os.getenv("TIMEOUT", "1440"))
 
+LAUNCH_PHASES = {
+    "queued": "waiting for a free slot...",
+    "waiting": "starting nodes...",
+    "funding": "funding accounts...",
+}
+
 
 @dataclass
 class Action:
@@ -74,6 +83,12 @@ class Launcher(abc.ABC):
     def get_daemon_instances(self) -> Dict[str, DaemonInstanceArgs]:
         return {}
 
+    def get_rate_limit(self) -> Optional[RateLimitArgs]:
+        return None
+
+    def get_rpc_policy(self) -> Optional[RpcPolicyArgs]:
+        return None
+
     def get_anvil_instance(self, **kwargs) -> LaunchAnvilInstanceArgs:
         if not "balance" in kwargs:
             kwargs["balance"] = 1000
@@ -106,15 +121,18 @@ class Launcher(abc.ABC):
             f"{ORCHESTRATOR_HOST}/instances",
             json=CreateInstanceRequest(
                 instance_id=self.get_instance_id(),
+                team_id=self.team,
                 timeout=TIMEOUT,
                 anvil_instances=self.get_anvil_instances(),
                 daemon_instances=self.get_daemon_instances(),
+                rate_limit=self.get_rate_limit(),
+                rpc_policy=self.get_rpc_policy(),
             ),
         ).json()
         if body["ok"] == False:
             raise Exception(body["message"])
 
-        user_data = body["data"]
+        user_data = self.wait_for_launch(body["data"])
 
         print("deploying challenge...")
         challenge_addr = self.deploy(user_data, self.mnemonic)
@@ -138,6 +156,36 @@ class Launcher(abc.ABC):
         print(f"challenge contract: {challenge_addr}")
         return 0
 
+    def wait_for_launch(self, job: LaunchJobInfo) -> UserData:
+        seen, printed, position = 0, set(), None
+        while True:
+            for event in job["events"]:
+                # per-node phases repeat for every node, only show them once
+                if event["phase"] in LAUNCH_PHASES and event["phase"] not in printed:
+                    printed.add(event["phase"])
+                    print(LAUNCH_PHASES[event["phase"]])
+            seen += len(job["events"])
+
+            if job.get("position") is not None and job["position"] != position:
+                position = job["position"]
+                print(f"the server is busy, {position} launches ahead of yours...")
+
+            if job["status"] == "succeeded":
+                return job["data"]
+            if job["status"] == "failed":
+                raise Exception(job["message"])
+
+            # the queue position isn't an event, so check back sooner while queued
+            body = requests.get(
+                f"{ORCHESTRATOR_HOST}/jobs/{job['job_id']}",
+                params={"after": seen, "timeout": 5 if job["status"] == "queued" else 30},
+                timeout=60,
+            ).json()
+            if body["ok"] == False:
+                raise Exception(body["message"])
+
+            job = body["data"]
+
     def kill_instance(self) -> int:
         resp = requests.delete(f"{ORCHESTRATOR_HOST}/instances/${self.get_instance_id()}")
         body = resp.json()
@@ -0,0 +1,310 @@
+import heapq
+import itertools
+import logging
+import threading
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .databases.database import Database
+from .types import CreateInstanceRequest, InstanceEvent, UserData
+
+# queued launches are admitted highest priority first, then in order of arrival
+DEFAULT_PRIORITY = 0
+HEALTHCHECK_PRIORITY = 1
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+@dataclass
+class Cost:
+    cpu: float = 0
+    memory: float = 0
+
+
+@dataclass
+class AdmissionStats:
+    admitted: int = 0
+    queued: int = 0
+    quota_rejected: int = 0
+    waiting: int = 0
+    launching: int = 0
+    instances: int = 0
+    cpu_used: float = 0
+    memory_used: float = 0
+
+
+class Admission:
+    # A launch from the time it's requested until it finishes. Once admitted
+    # its cost is charged, first as a launch and then as the instance it became.
+    def __init__(
+        self,
+        instance_id: str,
+        team_id: Optional[str],
+        priority: int,
+        cost: Cost,
+        on_admit: Callable[["Admission"], None],
+    ):
+        self.instance_id = instance_id
+        self.team_id = team_id
+        self.priority = priority
+        self.cost = cost
+        self.on_admit = on_admit
+        # position in the queue, set when queued
+        self.key: Tuple[int, int] = (0, 0)
+        self.admitted = False
+        # charged as a registered instance rather than as a launch
+        self.registered = False
+
+
+@dataclass
+class InstanceUsage:
+    team_id: Optional[str]
+    cost: Cost
+
+
+class AdmissionController:
+    # Decides when a launch may start. Every instance costs cpu and memory by
+    # its number of nodes and daemons, and launches that would go over budget,
+    # or over the number of launches running at once, wait in a priority
+    # queue. Usage follows instance events, so instances launched and killed by
+    # other replicas count too. Teams are limited to a number of instances at
+    # once, queued and launching ones included.
+    def __init__(
+        self,
+        database: Database,
+        anvil_cost: Cost,
+        daemon_cost: Cost,
+        cpu_budget: Optional[float] = None,
+        memory_budget: Optional[float] = None,
+        max_launching: int = 8,
+        team_quota: Optional[int] = None,
+    ):
+        self.__database = database
+        self.__anvil_cost = anvil_cost
+        self.__daemon_cost = daemon_cost
+        self.__cpu_budget = cpu_budget
+        self.__memory_budget = memory_budget
+        self.__max_launching = max_launching
+        self.__team_quota = team_quota
+
+        self.__lock = threading.Lock()
+        self.__counter = itertools.count()
+        # (-priority, seq, admission)
+        self.__queue: List[Tuple[int, int, Admission]] = []
+        self.__launching: Dict[str, Admission] = {}
+        self.__instances: Dict[str, InstanceUsage] = {}
+        # instances, launches and queued launches per team
+        self.__team_counts: Dict[str, int] = {}
+        self.__used = Cost()
+        self.__stats = AdmissionStats()
+
+        database.subscribe_instance_events(self.__on_instance_event)
+        self.__load()
+
+    def get_cost(self, instance: CreateInstanceRequest | UserData) -> Cost:
+        anvils = len(instance.get("anvil_instances") or {})
+        daemons = len(instance.get("daemon_instances") or {})
+        return Cost(
+            cpu=anvils * self.__anvil_cost.cpu + daemons * self.__daemon_cost.cpu,
+            memory=anvils * self.__anvil_cost.memory + daemons * self.__daemon_cost.memory,
+        )
+
+    def request(
+        self,
+        args: CreateInstanceRequest,
+        team_id: Optional[str],
+        priority: int,
+        on_admit: Callable[[Admission], None],
+    ) -> Admission:
+        # on_admit is called once the launch may start, possibly right away;
+        # launches without a team aren't held to the quota
+        admission = Admission(
+            args["instance_id"], team_id, priority, self.get_cost(args), on_admit
+        )
+        with self.__lock:
+            if team_id is not None and self.__team_quota is not None:
+                if self.__team_counts.get(team_id, 0) >= self.__team_quota:
+                    self.__stats.quota_rejected += 1
+                    raise QuotaExceeded()
+
+            self.__count_team(team_id, 1)
+            admission.key = (-priority, next(self.__counter))
+            heapq.heappush(self.__queue, (*admission.key, admission))
+            self.__stats.queued += 1
+            admitted = self.__admit()
+
+        self.__notify(admitted)
+        return admission
+
+    def position(self, admission: Admission) -> Optional[int]:
+        # how many queued launches go first, or None once admitted
+        with self.__lock:
+            if admission.admitted:
+                return None
+
+            return sum(1 for entry in self.__queue if entry[:2] < admission.key)
+
+    def finish(self, admission: Admission, launched: bool):
+        with self.__lock:
+            self.__launching.pop(admission.instance_id, None)
+            if not admission.registered:
+                if launched:
+                    # charged as an instance from now on, its register event may
+                    # not have arrived yet
+                    self.__instances[admission.instance_id] = InstanceUsage(
+                        admission.team_id, admission.cost
+                    )
+                    admission.registered = True
+                else:
+                    self.__charge(admission.cost, -1)
+                    self.__count_team(admission.team_id, -1)
+            admitted = self.__admit()
+
+        self.__notify(admitted)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self.__lock:
+            self.__stats.waiting = len(self.__queue)
+            self.__stats.launching = len(self.__launching)
+            self.__stats.instances = len(self.__instances)
+            self.__stats.cpu_used = self.__used.cpu
+            self.__stats.memory_used = self.__used.memory
+            return asdict(self.__stats)
+
+    def __fits(self, cost: Cost) -> bool:
+        # lock held; with nothing running anything fits, so a launch bigger
+        # than the whole budget runs alone instead of blocking the queue forever
+        if self.__used.cpu == 0 and self.__used.memory == 0:
+            return True
+        if self.__cpu_budget is not None and self.__used.cpu + cost.cpu > self.__cpu_budget:
+            return False
+        if (
+            self.__memory_budget is not None
+            and self.__used.memory + cost.memory > self.__memory_budget
+        ):
+            return False
+        return True
+
+    def __admit(self) -> List[Admission]:
+        # lock held; strictly in order, so a big launch isn't starved by small
+        # ones slipping past it
+        admitted = []
+        while len(self.__queue) > 0 and len(self.__launching) < self.__max_launching:
+            admission = self.__queue[0][2]
+            if not self.__fits(admission.cost):
+                break
+
+            heapq.heappop(self.__queue)
+            admission.admitted = True
+            self.__launching[admission.instance_id] = admission
+            self.__charge(admission.cost, 1)
+            self.__stats.admitted += 1
+            admitted.append(admission)
+        return admitted
+
+    def __notify(self, admitted: List[Admission]):
+        for admission in admitted:
+            try:
+                admission.on_admit(admission)
+            except Exception as e:
+                logging.error(
+                    "failed to start launch of %s", admission.instance_id, exc_info=e
+                )
+
+    def __charge(self, cost: Cost, sign: int):
+        # lock held
+        self.__used.cpu += sign * cost.cpu
+        self.__used.memory += sign * cost.memory
+
+    def __count_team(self, team_id: Optional[str], delta: int):
+        # lock held
+        if team_id is None:
+            return
+        count = self.__team_counts.get(team_id, 0) + delta
+        if count > 0:
+            self.__team_counts[team_id] = count
+        else:
+            self.__team_counts.pop(team_id, None)
+
+    def __get_usage(self, instance: UserData) -> InstanceUsage:
+        return InstanceUsage(instance.get("team_id"), self.get_cost(instance))
+
+    def __on_instance_event(self, event: InstanceEvent):
+        if event["type"] == "resync":
+            self.__load()
+            return
+
+        instance_id = event["instance_id"]
+        if event["type"] == "register":
+            with self.__lock:
+                launch = self.__launching.get(instance_id)
+                if launch is not None and not launch.registered:
+                    # one of ours, already charged
+                    launch.registered = True
+                    self.__instances[instance_id] = InstanceUsage(launch.team_id, launch.cost)
+                    return
+                if instance_id in self.__instances:
+                    # updated rather than newly registered
+                    return
+
+            # launched by another replica
+            instance = self.__database.get_instance(instance_id)
+            if instance is None:
+                return
+            with self.__lock:
+                if instance_id in self.__instances:
+                    return
+                usage = self.__get_usage(instance)
+                self.__instances[instance_id] = usage
+                self.__charge(usage.cost, 1)
+                self.__count_team(usage.team_id, 1)
+        elif event["type"] == "unregister":
+            with self.__lock:
+                usage = self.__instances.pop(instance_id, None)
+                if usage is None:
+                    return
+                self.__charge(usage.cost, -1)
+                self.__count_team(usage.team_id, -1)
+                admitted = self.__admit()
+
+            self.__notify(admitted)
+
+    def __load(self):
+        try:
+            instances = self.__database.get_all_instances()
+        except Exception as e:
+            logging.error("failed to load instances for admission control", exc_info=e)
+            return
+
+        with self.__lock:
+            self.__instances = {
+                instance["instance_id"]: self.__get_usage(instance) for instance in instances
+            }
+            for launch in self.__launching.values():
+                if launch.registered and launch.instance_id not in self.__instances:
+                    # killed while we weren't listening
+                    continue
+                if not launch.registered and launch.instance_id in self.__instances:
+                    launch.registered = True
+                    self.__instances[launch.instance_id] = InstanceUsage(
+                        launch.team_id, launch.cost
+                    )
+
+            # everything is recounted from scratch, which is the only time this
+            # isn't kept up incrementally
+            self.__used = Cost()
+            self.__team_counts = {}
+            for usage in self.__instances.values():
+                self.__charge(usage.cost, 1)
+                self.__count_team(usage.team_id, 1)
+            for launch in self.__launching.values():
+                if not launch.registered:
+                    self.__charge(launch.cost, 1)
+                    self.__count_team(launch.team_id, 1)
+            for _, _, admission in self.__queue:
+                self.__count_team(admission.team_id, 1)
+            admitted = self.__admit()
+
+        self.__notify(admitted)
@@ -1,38 +1,196 @@
-import json
 import logging
-from ast import Dict, List
-from contextlib import asynccontextmanager
-from typing import Any, Optional
+import os
+import secrets
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, Dict, Optional, Tuple
 
-import aiohttp
 import asyncio
-from fastapi import FastAPI, Request, WebSocket
-import websockets
-
+import aiohttp
+import orjson
+from aiohttp import ClientResponse
+from fastapi import FastAPI, Header, Request, Response, WebSocket
+from fastapi.responses import StreamingResponse
+
+from .metrics import CONTENT_TYPE, Registry
+from .proxy import (
+    DEFAULT_POLICY,
+    ChunkedLogs,
+    LogQueryError,
+    ProxyMetrics,
+    RateLimited,
+    RateLimiter,
+    ResponseCache,
+    ResponseCompressor,
+    RouteSnapshotReader,
+    RoutingTable,
+    RpcPolicy,
+    SingleFlight,
+    SnapshotRoutingTable,
+    TrafficCapture,
+    UpstreamHealth,
+    UpstreamPools,
+    WebSocketClient,
+    WebSocketMultiplexer,
+    canonical_params,
+    get_log_filter,
+    needs_head,
+    resolve_range,
+    too_large_error,
+)
 from .utils import load_database
 
-
-ALLOWED_NAMESPACES = ["web3", "eth", "net"]
-DISALLOWED_METHODS = [
-    "eth_sign",
-    "eth_signTransaction",
-    "eth_signTypedData",
-    "eth_signTypedData_v3",
-    "eth_signTypedData_v4",
-    "eth_sendTransaction",
-    "eth_sendUnsignedTransaction",
-]
-
+# set by the supervisor when running several workers, see ctf_server.proxy.supervisor
+ROUTE_SNAPSHOT_PATH = os.getenv("ROUTE_SNAPSHOT_PATH")
+
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "4096"))
+ROUTING_CACHE_TTL = float(os.getenv("ROUTING_CACHE_TTL", "60"))
+
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "32"))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "60"))
+UPSTREAM_IDLE_TIMEOUT = float(os.getenv("UPSTREAM_IDLE_TIMEOUT", "300"))
+# how long requests wait for a node that refused a connection to come back
+UPSTREAM_RESTART_HOLD = float(os.getenv("UPSTREAM_RESTART_HOLD", "3"))
+UPSTREAM_CONNECT_ATTEMPTS = int(os.getenv("UPSTREAM_CONNECT_ATTEMPTS", "3"))
+
+# off unless set here or by a challenge's rate_limit, which overrides these per instance
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "0"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "1000"))
+RATE_LIMIT_MAX_QUEUE = int(os.getenv("RATE_LIMIT_MAX_QUEUE", "64"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5"))
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", str(64 * 1024 * 1024)))
+
+# messages buffered for a websocket client before it is dropped as too slow
+WS_CLIENT_QUEUE_SIZE = int(os.getenv("WS_CLIENT_QUEUE_SIZE", "256"))
+
+# replies larger than this are streamed back to the client instead of buffered
+STREAM_THRESHOLD = int(os.getenv("STREAM_THRESHOLD", str(64 * 1024)))
+
+# eth_getLogs over more blocks than this is split into ranges fetched a few at a
+# time, and the merged logs are streamed back as the ranges complete
+LOGS_CHUNK_BLOCKS = int(os.getenv("LOGS_CHUNK_BLOCKS", "2000"))
+LOGS_CHUNK_TARGET_SIZE = int(os.getenv("LOGS_CHUNK_TARGET_SIZE", str(1024 * 1024)))
+LOGS_CONCURRENCY = int(os.getenv("LOGS_CONCURRENCY", "4"))
+LOGS_MAX_RESPONSE_SIZE = int(os.getenv("LOGS_MAX_RESPONSE_SIZE", str(128 * 1024 * 1024)))
+
+# when set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# instances exported with their own label, the rest are summed up as "other"
+METRICS_TOP_INSTANCES = int(os.getenv("METRICS_TOP_INSTANCES", "20"))
+
+# when set, an anonymized record of every request is written here for replay
+CAPTURE_DIR = os.getenv("CAPTURE_DIR")
+CAPTURE_FILE_SIZE = int(os.getenv("CAPTURE_FILE_SIZE", str(64 * 1024 * 1024)))
+# across every worker, older files in CAPTURE_DIR are deleted first
+CAPTURE_FILES = int(os.getenv("CAPTURE_FILES", "8"))
+# shared by the workers so an instance gets the same anonymized id in every capture
+CAPTURE_SALT = os.getenv("CAPTURE_SALT")
+
+# content-encodings offered to clients, in order of preference
+COMPRESSION_ENCODINGS = os.getenv("COMPRESSION_ENCODINGS", "br,zstd,gzip").split(",")
+# replies smaller than this are never compressed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# replies larger than this are compressed off the event loop
+COMPRESSION_OFFLOAD_SIZE = int(os.getenv("COMPRESSION_OFFLOAD_SIZE", str(16 * 1024)))
+
+JSON_HEADERS = {"content-type": "application/json"}
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global session, database
-    session = aiohttp.ClientSession()
-    database = load_database()
+    global database, routing_table, upstream_pools, upstream_health, ws_multiplexer
+    global response_cache, single_flight, rate_limiter, metrics, capture, compressor
+    global chunked_logs
+    metrics = ProxyMetrics(Registry(), top_instances=METRICS_TOP_INSTANCES)
+    database = load_database(asynchronous=True)
+    database.subscribe_instance_events(metrics.on_instance_event)
+    routing_kwargs = dict(
+        max_size=ROUTING_CACHE_SIZE,
+        ttl=ROUTING_CACHE_TTL,
+        lookup_seconds=metrics.database_seconds,
+    )
+    if ROUTE_SNAPSHOT_PATH is not None:
+        routing_table = SnapshotRoutingTable(
+            database, RouteSnapshotReader(ROUTE_SNAPSHOT_PATH), **routing_kwargs
+        )
+    else:
+        routing_table = RoutingTable(database, **routing_kwargs)
+    upstream_pools = UpstreamPools(
+        max_connections_per_host=UPSTREAM_MAX_CONNECTIONS,
+        keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+        connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+        read_timeout=UPSTREAM_READ_TIMEOUT,
+        idle_timeout=UPSTREAM_IDLE_TIMEOUT,
+    )
+    database.subscribe_instance_events(upstream_pools.on_instance_event)
+    response_cache = ResponseCache(max_bytes=RESPONSE_CACHE_SIZE)
+    database.subscribe_instance_events(response_cache.on_instance_event)
+    upstream_health = UpstreamHealth(
+        routing_table,
+        hold_seconds=UPSTREAM_RESTART_HOLD,
+        # a node that went down may have restarted from an older state dump
+        on_outage_end=response_cache.drop_node,
+    )
+    database.subscribe_instance_events(upstream_health.on_instance_event)
+    single_flight = SingleFlight()
+    database.subscribe_instance_events(single_flight.on_instance_event)
+    # every worker enforces the whole limit: keep-alive pins a client to one
+    # worker, so splitting it would leave each client a fraction of its budget
+    rate_limiter = RateLimiter(
+        rate=RATE_LIMIT_RATE,
+        burst=RATE_LIMIT_BURST,
+        max_queue=RATE_LIMIT_MAX_QUEUE,
+        max_wait=RATE_LIMIT_MAX_WAIT,
+    )
+    database.subscribe_instance_events(rate_limiter.on_instance_event)
+    ws_multiplexer = WebSocketMultiplexer()
+    database.subscribe_instance_events(ws_multiplexer.on_instance_event)
+    chunked_logs = ChunkedLogs(
+        chunk_blocks=LOGS_CHUNK_BLOCKS,
+        target_chunk_size=LOGS_CHUNK_TARGET_SIZE,
+        concurrency=LOGS_CONCURRENCY,
+        max_size=LOGS_MAX_RESPONSE_SIZE,
+    )
+    compressor = ResponseCompressor(
+        encodings=COMPRESSION_ENCODINGS,
+        min_size=COMPRESSION_MIN_SIZE,
+        offload_size=COMPRESSION_OFFLOAD_SIZE,
+    )
+
+    metrics.add_stats("routing", "Routing table state", lambda: {"entries": len(routing_table)})
+    metrics.add_stats(
+        "upstream_pools", "Upstream connection pool counters", upstream_pools.get_stats
+    )
+    metrics.add_stats("upstream_health", "Upstream node health", upstream_health.get_stats)
+    metrics.add_stats("response_cache", "Response cache counters", response_cache.get_stats)
+    metrics.add_stats("single_flight", "Request coalescing counters", single_flight.get_stats)
+    metrics.add_stats("rate_limiter", "Rate limiter counters", rate_limiter.get_stats)
+    metrics.add_stats("websocket_multiplexer", "Upstream websocket state", ws_multiplexer.get_stats)
+    metrics.add_stats("chunked_logs", "Split eth_getLogs counters", chunked_logs.get_stats)
+    metrics.add_stats("compression", "Response compression counters", compressor.get_stats)
+
+    capture = None
+    if CAPTURE_DIR is not None:
+        capture = TrafficCapture(
+            CAPTURE_DIR,
+            max_file_bytes=CAPTURE_FILE_SIZE,
+            max_files=CAPTURE_FILES,
+            salt=bytes.fromhex(CAPTURE_SALT) if CAPTURE_SALT is not None else None,
+        )
+        capture.start()
+        metrics.add_stats("capture", "Traffic capture counters", capture.get_stats)
 
     yield
 
-    await session.close()
+    if capture is not None:
+        await capture.close()
+
+    await ws_multiplexer.close()
+    await upstream_health.close()
+    await upstream_pools.close()
+    await database.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -43,6 +201,16 @@ async def root():
     return "rpc proxy running"
 
 
+@app.get("/metrics")
+async def get_metrics(authorization: Optional[str] = Header(default=None)):
+    if METRICS_TOKEN is not None and not secrets.compare_digest(
+        authorization or "", f"Bearer {METRICS_TOKEN}"
+    ):
+        return Response(status_code=401)
+
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
+
+
 def jsonrpc_fail(id: Any, code: int, message: str) -> Dict:
     return {
         "jsonrpc": "2.0",
@@ -54,66 +222,538 @@ def jsonrpc_fail(id: Any, code: int, message: str) -> Dict:
     }
 
 
-def validate_request(request: Any) -> Optional[Dict]:
+def validate_request(request: Any, policy: RpcPolicy) -> Optional[Dict]:
     if not isinstance(request, dict):
+        metrics.rejections.inc("invalid")
         return jsonrpc_fail(None, -32600, "expected json object")
 
     request_id = request.get("id")
     request_method = request.get("method")
 
     if request_id is None:
+        metrics.rejections.inc("invalid")
         return jsonrpc_fail(None, -32600, "invalid jsonrpc id")
 
     if not isinstance(request_method, str):
+        metrics.rejections.inc("invalid")
         return jsonrpc_fail(request["id"], -32600, "invalid jsonrpc method")
 
-    if (
-        request_method.split("_")[0] not in ALLOWED_NAMESPACES
-        or request_method in DISALLOWED_METHODS
-    ):
+    if not policy.is_allowed(request_method):
+        metrics.rejections.inc("forbidden")
         return jsonrpc_fail(request["id"], -32600, "forbidden jsonrpc method")
 
     return None
 
 
+async def lookup_upstream(
+    external_id: str, anvil_id: str, request_id: Optional[str]
+) -> Tuple[Optional[str], Optional[Dict]]:
+    route = await routing_table.lookup(external_id)
+    if route is None:
+        metrics.rejections.inc("instance_not_found")
+        return None, jsonrpc_fail(
+            request_id, -32602, "invalid rpc url, instance not found"
+        )
+
+    upstream = route.upstreams.get(anvil_id)
+    if upstream is None:
+        metrics.rejections.inc("chain_not_found")
+        return None, jsonrpc_fail(request_id, -32602, "invalid rpc url, chain not found")
+
+    return f"http://{upstream}", None
+
+
+async def lookup_policy(external_id: str, anvil_id: str) -> RpcPolicy:
+    route = await routing_table.lookup(external_id)
+    if route is None:
+        # the request will fail the upstream lookup anyway
+        return DEFAULT_POLICY
+
+    return route.get_policy(anvil_id)
+
+
+async def admit_request(external_id: str, body: Any) -> bool:
+    route = await routing_table.lookup(external_id)
+    if route is None:
+        # the request is about to fail anyway, don't create a bucket for it
+        return True
+
+    try:
+        await rate_limiter.acquire(
+            external_id, rate_limiter.cost(body, route.rate_limit), route.rate_limit
+        )
+        return True
+    except RateLimited:
+        return False
+
+
+def observe_method(external_id: str, anvil_id: str, method: str):
+    # called before forwarding, so state changes invalidate what was read before them
+    single_flight.observe_write(external_id, anvil_id, method)
+    response_cache.observe_request(external_id, anvil_id, method)
+
+
+def rate_limit_fail(request_id: Any) -> Dict:
+    metrics.rejections.inc("rate_limited")
+    return jsonrpc_fail(request_id, -32005, "rate limit exceeded")
+
+
+def upstream_unavailable_fail(
+    external_id: str, anvil_id: str, request_id: Optional[str]
+) -> Dict:
+    metrics.upstream_failures.inc("unavailable")
+    logging.warning("anvil %s/%s is unavailable", external_id, anvil_id)
+    return jsonrpc_fail(request_id, -32603, "upstream node unavailable, try again shortly")
+
+
+def upstream_fail(
+    external_id: str, anvil_id: str, request_id: Optional[str], e: Exception
+) -> Dict:
+    if isinstance(e, asyncio.TimeoutError):
+        metrics.upstream_failures.inc("timeout")
+        logging.error("timed out proxying anvil request to %s/%s", external_id, anvil_id)
+        return jsonrpc_fail(request_id, -32603, "upstream request timed out")
+
+    if isinstance(e, aiohttp.ServerDisconnectedError):
+        # anvil died with the request in flight; it may have run, so it isn't retried
+        upstream_health.record_failure(external_id, anvil_id)
+        return upstream_unavailable_fail(external_id, anvil_id, request_id)
+
+    metrics.upstream_failures.inc("error")
+    logging.error(
+        "failed to proxy anvil request to %s/%s", external_id, anvil_id, exc_info=e
+    )
+    return jsonrpc_fail(request_id, -32602, str(e))
+
+
+def upstream_status_fail(
+    external_id: str, anvil_id: str, request_id: Optional[str], resp: ClientResponse
+) -> Dict:
+    metrics.upstream_failures.inc("status")
+    logging.error(
+        "anvil %s/%s responded with http status %d", external_id, anvil_id, resp.status
+    )
+    return jsonrpc_fail(request_id, -32603, f"upstream responded with http status {resp.status}")
+
+
+def json_response(body: Any) -> Response:
+    return Response(content=orjson.dumps(body), media_type="application/json")
+
+
+def jsonrpc_result(id: Any, result: bytes) -> bytes:
+    return b'{"jsonrpc":"2.0","id":' + orjson.dumps(id) + b',"result":' + result + b"}"
+
+
+async def open_upstream(
+    external_id: str,
+    anvil_id: str,
+    request_id: Optional[str],
+    body: bytes,
+    stack: AsyncExitStack,
+) -> Tuple[Optional[ClientResponse], Optional[Dict]]:
+    # a refused connection never reached anvil, so even a write is safe to send
+    # again once the node is back up
+    for _ in range(UPSTREAM_CONNECT_ATTEMPTS):
+        if not await upstream_health.wait_ready(external_id, anvil_id):
+            return None, upstream_unavailable_fail(external_id, anvil_id, request_id)
+
+        # looked up each time, the node may have come back at another address
+        instance_host, failure = await lookup_upstream(external_id, anvil_id, request_id)
+        if failure is not None:
+            return None, failure
+
+        try:
+            resp = await stack.enter_async_context(
+                upstream_pools.get(external_id).post(
+                    instance_host, data=body, headers=JSON_HEADERS
+                )
+            )
+            return resp, None
+        except aiohttp.ClientConnectorError:
+            upstream_health.record_failure(external_id, anvil_id)
+
+    return None, upstream_unavailable_fail(external_id, anvil_id, request_id)
+
+
+async def fetch_upstream(
+    external_id: str, anvil_id: str, request_id: Optional[str], method: str, body: bytes
+) -> Tuple[Optional[bytes], Optional[Dict]]:
+    started_at = time.perf_counter()
+    try:
+        async with AsyncExitStack() as stack:
+            resp, failure = await open_upstream(
+                external_id, anvil_id, request_id, body, stack
+            )
+            if failure is not None:
+                return None, failure
+            if resp.status != 200:
+                return None, upstream_status_fail(external_id, anvil_id, request_id, resp)
+            return await resp.read(), None
+    except Exception as e:
+        return None, upstream_fail(external_id, anvil_id, request_id, e)
+    finally:
+        metrics.upstream_seconds.observe(time.perf_counter() - started_at, method)
+
+
 async def proxy_request(
     external_id: str, anvil_id: str, request_id: Optional[str], body: Any
 ) -> Optional[Any]:
-    user_data = database.get_instance_by_external_id(external_id)
-    if user_data is None:
-        return jsonrpc_fail(request_id, -32602, "invalid rpc url, instance not found")
+    response, failure = await fetch_upstream(
+        external_id, anvil_id, request_id, "batch", orjson.dumps(body)
+    )
+    if failure is not None:
+        return failure
+
+    return orjson.loads(response)
+
+
+def replace_id(response: Any, id: Any) -> bytes:
+    return orjson.dumps({**response, "id": id})
+
+
+async def proxy_buffered_request(
+    external_id: str, anvil_id: str, body: Dict, raw_body: bytes
+) -> Response:
+    method = body["method"]
+    params = body.get("params", [])
+
+    cache_key = None
+    if response_cache.is_candidate(method):
+        cache_key = response_cache.make_key(external_id, anvil_id, method, params)
+        if cache_key is not None:
+            result = response_cache.get(cache_key)
+            if result is not None:
+                return Response(
+                    content=jsonrpc_result(body["id"], result),
+                    media_type="application/json",
+                )
+
+    async def fetch() -> Tuple[bytes, Any]:
+        response, failure = await fetch_upstream(
+            external_id, anvil_id, body["id"], metrics.method_label(method), raw_body
+        )
+        if failure is not None:
+            return orjson.dumps(failure), failure
 
-    anvil_instance = user_data.get("anvil_instances", {}).get(anvil_id, None)
-    if anvil_instance is None:
-        return jsonrpc_fail(request_id, -32602, "invalid rpc url, chain not found")
+        try:
+            parsed = orjson.loads(response)
+        except orjson.JSONDecodeError:
+            return response, None
+
+        response_cache.observe(external_id, anvil_id, method, cache_key, parsed)
+        return response, parsed
+
+    canonical = None
+    if single_flight.is_coalescable(method):
+        canonical = canonical_params(params)
+
+    if canonical is None:
+        response, _ = await fetch()
+        return Response(content=response, media_type="application/json")
+
+    # identical reads already in flight to the same node answer this one too
+    (response, parsed), leader = await single_flight.do(
+        single_flight.make_key(external_id, anvil_id, method, canonical), fetch
+    )
+    if not leader and isinstance(parsed, dict):
+        response = replace_id(parsed, body["id"])
+
+    return Response(content=response, media_type="application/json")
+
+
+async def proxy_raw_request(
+    external_id: str,
+    anvil_id: str,
+    request_id: Optional[str],
+    method: str,
+    body: bytes,
+    max_size: Optional[int] = None,
+) -> Response:
+    # the client's bytes go upstream untouched and the reply comes back untouched,
+    # so large results are never decoded or re-encoded by the proxy
+    stack = AsyncExitStack()
+    started_at = time.perf_counter()
+    try:
+        resp, failure = await open_upstream(external_id, anvil_id, request_id, body, stack)
+        # streamed replies are timed up to the response headers
+        metrics.upstream_seconds.observe(time.perf_counter() - started_at, method)
+        if failure is not None:
+            await stack.aclose()
+            return json_response(failure)
+
+        if resp.status != 200:
+            async with stack:
+                return json_response(
+                    upstream_status_fail(external_id, anvil_id, request_id, resp)
+                )
+
+        if (
+            max_size is not None
+            and resp.content_length is not None
+            and resp.content_length > max_size
+        ):
+            async with stack:
+                return json_response(
+                    {"jsonrpc": "2.0", "id": request_id, "error": too_large_error(max_size)}
+                )
+
+        if resp.content_length is not None and resp.content_length <= STREAM_THRESHOLD:
+            async with stack:
+                return Response(
+                    content=await resp.read(),
+                    status_code=resp.status,
+                    media_type="application/json",
+                )
+    except Exception as e:
+        await stack.aclose()
+        return json_response(upstream_fail(external_id, anvil_id, request_id, e))
+
+    async def stream_body():
+        size = 0
+        async with stack:
+            async for chunk in resp.content.iter_any():
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    # only without a content-length; cut off like a chunked query
+                    logging.warning(
+                        "cutting off %s stream to %s/%s after %s bytes",
+                        method,
+                        external_id,
+                        anvil_id,
+                        max_size,
+                    )
+                    return
+
+                metrics.bytes_sent.inc("http", amount=len(chunk))
+                metrics.observe_instance_bytes_out(external_id, len(chunk))
+                yield chunk
+
+    headers = {}
+    if resp.content_length is not None:
+        headers["content-length"] = str(resp.content_length)
+
+    return StreamingResponse(
+        stream_body(),
+        status_code=resp.status,
+        headers=headers,
+        media_type="application/json",
+    )
+
+
+async def fetch_jsonrpc(
+    external_id: str, anvil_id: str, method: str, params: Any
+) -> Any:
+    response, failure = await fetch_upstream(
+        external_id,
+        anvil_id,
+        1,
+        metrics.method_label(method),
+        orjson.dumps({"jsonrpc": "2.0", "id": 1, "method": method, "params": params}),
+    )
+    if failure is not None:
+        return failure
+
+    try:
+        return orjson.loads(response)
+    except orjson.JSONDecodeError:
+        raise LogQueryError({"code": -32603, "message": "invalid upstream response"})
+
+
+async def proxy_logs_request(
+    external_id: str, anvil_id: str, body: Dict, raw_body: bytes
+) -> Response:
+    log_filter = get_log_filter(body.get("params"))
+    if log_filter is None:
+        return await proxy_raw_request(
+            external_id,
+            anvil_id,
+            body["id"],
+            "eth_getLogs",
+            raw_body,
+            max_size=LOGS_MAX_RESPONSE_SIZE,
+        )
 
-    instance_host = f"http://{anvil_instance['ip']}:{anvil_instance['port']}"
+    head = None
+    if needs_head(log_filter):
+        try:
+            response = await fetch_jsonrpc(external_id, anvil_id, "eth_blockNumber", [])
+        except LogQueryError as e:
+            return json_response({"jsonrpc": "2.0", "id": body["id"], "error": e.error})
+        if isinstance(response, dict) and "error" in response:
+            return json_response({**response, "id": body["id"]})
+        try:
+            head = int(response["result"], 16)
+        except (KeyError, TypeError, ValueError):
+            return json_response(
+                jsonrpc_fail(body["id"], -32603, "invalid upstream response")
+            )
+
+    block_range = resolve_range(log_filter, head)
+    if block_range is None or not chunked_logs.should_split(block_range):
+        return await proxy_raw_request(
+            external_id,
+            anvil_id,
+            body["id"],
+            "eth_getLogs",
+            raw_body,
+            max_size=LOGS_MAX_RESPONSE_SIZE,
+        )
 
+    async def fetch(chunk_filter: Dict) -> Any:
+        return await fetch_jsonrpc(external_id, anvil_id, "eth_getLogs", [chunk_filter])
+
+    logs = chunked_logs.query(fetch, log_filter, block_range)
+    prefix = b'{"jsonrpc":"2.0","id":' + orjson.dumps(body["id"]) + b',"result":['
+
+    # hold the reply back until it's clearly large, so that a query failing early
+    # still gets a proper json-rpc error instead of a cut off stream
+    buffered = []
+    buffered_size = 0
     try:
-        async with session.post(instance_host, json=body) as resp:
-            return await resp.json()
-    except Exception as e:
-        logging.error(
-            "failed to proxy anvil request to %s/%s", external_id, anvil_id, exc_info=e
+        async for chunk in logs:
+            buffered.append(chunk)
+            buffered_size += len(chunk)
+            if buffered_size > STREAM_THRESHOLD:
+                break
+        else:
+            return Response(
+                content=prefix + b",".join(buffered) + b"]}", media_type="application/json"
+            )
+    except LogQueryError as e:
+        return json_response({"jsonrpc": "2.0", "id": body["id"], "error": e.error})
+
+    def sent(chunk: bytes) -> bytes:
+        metrics.bytes_sent.inc("http", amount=len(chunk))
+        metrics.observe_instance_bytes_out(external_id, len(chunk))
+        return chunk
+
+    async def stream_body():
+        try:
+            yield sent(prefix + b",".join(buffered))
+            async for chunk in logs:
+                yield sent(b"," + chunk)
+            yield sent(b"]}")
+        except LogQueryError as e:
+            # the status line is long gone, so end the body without closing the json;
+            # the client fails to parse it rather than mistaking it for every log
+            logging.warning(
+                "cutting off eth_getLogs stream to %s/%s: %s", external_id, anvil_id, e
+            )
+
+    return StreamingResponse(stream_body(), media_type="application/json")
+
+
+async def compress_response(response: Response, accept_encoding: Optional[str]) -> Response:
+    if isinstance(response, StreamingResponse):
+        content_length = response.headers.get("content-length")
+        encoding = compressor.choose(
+            accept_encoding, int(content_length) if content_length is not None else None
+        )
+        if encoding is None:
+            return response
+
+        return StreamingResponse(
+            compressor.compress_stream(response.body_iterator, encoding),
+            status_code=response.status_code,
+            headers={"content-encoding": encoding, "vary": "accept-encoding"},
+            media_type="application/json",
         )
-        return jsonrpc_fail(request_id, -32602, str(e))
+
+    encoding = compressor.choose(accept_encoding, len(response.body))
+    if encoding is None:
+        return response
+
+    return Response(
+        content=await compressor.compress(response.body, encoding),
+        status_code=response.status_code,
+        headers={"content-encoding": encoding, "vary": "accept-encoding"},
+        media_type="application/json",
+    )
+
+
+def method_label(body: Any) -> str:
+    if isinstance(body, list):
+        return "batch"
+
+    if isinstance(body, dict) and isinstance(body.get("method"), str):
+        return metrics.method_label(body["method"])
+
+    return "invalid"
 
 
 @app.post("/{external_id}/{anvil_id}")
 async def rpc(external_id: str, anvil_id: str, request: Request):
+    arrived_at = time.time()
+    started_at = time.perf_counter()
+    raw_body = await request.body()
     try:
-        body = await request.json()
-    except json.JSONDecodeError:
-        return jsonrpc_fail(None, -32600, "expected json body")
+        body = orjson.loads(raw_body)
+    except orjson.JSONDecodeError:
+        body = None
+
+    response = await handle_rpc(external_id, anvil_id, body, raw_body)
+
+    elapsed = time.perf_counter() - started_at
+    method = method_label(body)
+    metrics.requests.inc("http", method)
+    metrics.request_seconds.observe(elapsed, method)
+    metrics.bytes_received.inc("http", amount=len(raw_body))
+
+    # streamed bodies are counted as they go out
+    bytes_out = 0 if isinstance(response, StreamingResponse) else len(response.body)
+    metrics.bytes_sent.inc("http", amount=bytes_out)
+
+    route = await routing_table.lookup(external_id)
+    if route is not None:
+        metrics.observe_instance(
+            external_id,
+            route.instance_id,
+            bytes_in=len(raw_body),
+            bytes_out=bytes_out,
+            seconds=elapsed,
+        )
+
+        if capture is not None:
+            capture.record(
+                route.instance_id,
+                anvil_id,
+                body,
+                arrived_at,
+                elapsed,
+                bytes_out or int(response.headers.get("content-length", 0)),
+            )
+
+    # everything above measures the uncompressed reply
+    return await compress_response(response, request.headers.get("accept-encoding"))
+
+
+async def handle_rpc(
+    external_id: str, anvil_id: str, body: Any, raw_body: bytes
+) -> Response:
+    if body is None:
+        metrics.rejections.inc("invalid")
+        return json_response(jsonrpc_fail(None, -32600, "expected json body"))
 
     # special handling for batch requests
     if isinstance(body, list):
+        metrics.batch_size.observe(len(body))
+        if not await admit_request(external_id, body):
+            return json_response(
+                [
+                    rate_limit_fail(req.get("id") if isinstance(req, dict) else None)
+                    for req in body
+                ]
+            )
+
+        policy = await lookup_policy(external_id, anvil_id)
         responses = []
         for idx, req in enumerate(body):
-            validation_error = validate_request(req)
+            validation_error = validate_request(req, policy)
             responses.append(validation_error)
 
-            if validation_error is not None:
+            if validation_error is None:
+                observe_method(external_id, anvil_id, req["method"])
+            else:
                 # neuter the request
                 body[idx] = {
                     "jsonrpc": "2.0",
@@ -125,58 +765,111 @@ async def rpc(external_id: str, anvil_id: str, request: Request):
 
         for idx in range(len(responses)):
             if responses[idx] is None:
-                if isinstance(upstream_responses, List):
+                if isinstance(upstream_responses, list):
                     responses[idx] = upstream_responses[idx]
                 else:
                     responses[idx] = upstream_responses
 
-        return responses
+        return json_response(responses)
 
-    validation_resp = validate_request(body)
+    policy = await lookup_policy(external_id, anvil_id)
+    validation_resp = validate_request(body, policy)
     if validation_resp is not None:
-        return validation_resp
+        return json_response(validation_resp)
 
-    return await proxy_request(external_id, anvil_id, body["id"], body)
+    if not await admit_request(external_id, body):
+        return json_response(rate_limit_fail(body["id"]))
 
-async def forward_message(client_to_remote: bool, client_ws: WebSocket, remote_ws: websockets):
-    if client_to_remote:
-        async for message in client_ws.iter_text():
-            try:
-                json_msg = json.loads(message)
-            except json.JSONDecodeError:
-                await client_ws.send_json(jsonrpc_fail(None, -32600, "expected json body"))
+    observe_method(external_id, anvil_id, body["method"])
+    if body["method"] == "eth_getLogs":
+        return await proxy_logs_request(external_id, anvil_id, body, raw_body)
+
+    if response_cache.is_candidate(body["method"]) or single_flight.is_coalescable(
+        body["method"]
+    ):
+        return await proxy_buffered_request(external_id, anvil_id, body, raw_body)
+
+    return await proxy_raw_request(
+        external_id, anvil_id, body["id"], metrics.method_label(body["method"]), raw_body
+    )
 
-            validation = validate_request(json_msg)
-            if validation is not None:
-                await client_ws.send_json(validation)
-            else:
-                await remote_ws.send(message)
-    else:
-        async for message in remote_ws:
-            await client_ws.send_text(message)
 
 @app.websocket("/{external_id}/{anvil_id}/ws")
 async def ws_rpc(external_id: str, anvil_id: str, client_ws: WebSocket):
-    user_data = database.get_instance_by_external_id(external_id)
-    if user_data is None:
-        client_ws.send_json(jsonrpc_fail(None, -32602, "invalid rpc url, instance not found"))
+    failure = None
+    if not await upstream_health.wait_ready(external_id, anvil_id):
+        failure = upstream_unavailable_fail(external_id, anvil_id, None)
+    else:
+        instance_host, failure = await lookup_upstream(external_id, anvil_id, None)
+    if failure is not None:
+        await client_ws.accept()
+        await client_ws.send_text(orjson.dumps(failure).decode())
+        await client_ws.close()
         return
 
-    anvil_instance = user_data.get("anvil_instances", {}).get(anvil_id, None)
-    if anvil_instance is None:
-        client_ws.send_json(jsonrpc_fail(None, -32602, "invalid rpc url, chain not found"))
+    route = await routing_table.lookup(external_id)
+    policy = await lookup_policy(external_id, anvil_id)
+    await client_ws.accept()
+
+    try:
+        upstream = await ws_multiplexer.acquire(
+            external_id, anvil_id, "ws://" + instance_host[len("http://") :]
+        )
+    except Exception as e:
+        if isinstance(e, OSError):
+            upstream_health.record_failure(external_id, anvil_id)
+        logging.error(
+            "failed to connect to anvil websocket %s/%s", external_id, anvil_id, exc_info=e
+        )
+        await client_ws.close(code=1011, reason="upstream unavailable")
         return
 
-    instance_host = f"ws://{anvil_instance['ip']}:{anvil_instance['port']}"
+    def on_send(size: int):
+        metrics.bytes_sent.inc("ws", amount=size)
+        metrics.observe_instance_bytes_out(external_id, size)
 
-    async with websockets.connect(instance_host) as remote_ws:
-        await client_ws.accept()
-        task_a = asyncio.create_task(forward_message(True, client_ws, remote_ws))
-        task_b = asyncio.create_task(forward_message(False, client_ws, remote_ws))
+    # no awaits between acquiring and attaching, so the upstream can't be
+    # released in between unnoticed
+    client = WebSocketClient(client_ws, WS_CLIENT_QUEUE_SIZE, on_send=on_send)
+    upstream.attach(client)
+    metrics.websockets.inc()
+    pump = asyncio.create_task(client.pump())
+    try:
+        async for message in client_ws.iter_text():
+            metrics.bytes_received.inc("ws", amount=len(message))
+            try:
+                json_msg = orjson.loads(message)
+            except orjson.JSONDecodeError:
+                json_msg = None
+
+            metrics.requests.inc("ws", method_label(json_msg))
+            if capture is not None and route is not None:
+                # replies arrive asynchronously, so only the arrival is recorded
+                capture.record(
+                    route.instance_id, anvil_id, json_msg, time.time(), 0, 0, websocket=True
+                )
+            if json_msg is None:
+                metrics.rejections.inc("invalid")
+                client.send(orjson.dumps(jsonrpc_fail(None, -32600, "expected json body")))
+                continue
+
+            validation = validate_request(json_msg, policy)
+            if validation is not None:
+                client.send(orjson.dumps(validation))
+            elif not await admit_request(external_id, json_msg):
+                client.send(orjson.dumps(rate_limit_fail(json_msg["id"])))
+            else:
+                observe_method(external_id, anvil_id, json_msg["method"])
+                await upstream.handle(client, json_msg)
 
-        try:
-            await asyncio.wait([task_a, task_b], return_when=asyncio.FIRST_COMPLETED)
-            task_a.cancel()
-            task_b.cancel()
-        except:
-            pass
\ No newline at end of file
+            if client.closed:
+                break
+    except Exception as e:
+        logging.error(
+            "failed to proxy websocket to %s/%s", external_id, anvil_id, exc_info=e
+        )
+        client.close(1011, "proxy error")
+    finally:
+        metrics.websockets.dec()
+        upstream.detach(client)
+        await pump
@@ -1,9 +1,10 @@
 import abc
 import logging
+import os
 import random
 import string
 import time
-from threading import Thread
+from typing import Callable, Dict, Optional
 
 from ctf_server.databases.database import Database
 from ctf_server.types import (
@@ -14,12 +15,38 @@ from ctf_server.types import (
     CreateInstanceRequest,
     LaunchAnvilInstanceArgs,
     UserData,
+    derive_account,
 )
-from eth_account import Account
-from eth_account.hdaccount import key_from_seed, seed_from_mnemonic
-from foundry.anvil import anvil_setBalance
+from foundry.anvil import anvil_setBalances
 from web3 import Web3
 
+from .deletion_queue import DeletionQueue
+from .expiry import ExpiryScheduler
+from .locks import InstanceLocks, LockTimeout
+from .warm_pool import WarmPools
+
+# readiness probes start at this interval and back off to the max
+NODE_PROBE_INTERVAL = 0.02
+NODE_MAX_PROBE_INTERVAL = 1
+# a node that isn't answering rpc after this long fails the launch
+NODE_READY_TIMEOUT = 300
+
+# instances torn down at once in the background
+DELETION_WORKERS = int(os.getenv("DELETION_WORKERS", "4"))
+# expired instances unregistered at once
+EXPIRY_WORKERS = int(os.getenv("EXPIRY_WORKERS", "4"))
+
+# how long a launch, kill or update waits for another one on the same instance,
+# which includes an earlier instance with its id still being torn down
+INSTANCE_LOCK_TIMEOUT = 120
+
+# (phase, detail) as a launch makes progress, e.g. ("funding", "main")
+ProgressCallback = Callable[[str, Optional[str]], None]
+
+
+def no_progress(phase: str, detail: Optional[str] = None):
+    pass
+
 
 class InstanceExists(Exception):
     pass
@@ -28,72 +55,178 @@ class InstanceExists(Exception):
 class Backend(abc.ABC):
     def __init__(self, database: Database):
         self._database = database
+        # launches, kills and updates of one instance are serialized across replicas
+        self.locks = InstanceLocks(database)
+        # pre-booted nodes, for backends that can hand a running node to an instance
+        self.warm_pools: Optional[WarmPools] = None
+        # killing an instance unregisters it right away and deletes it here
+        self.deletions = DeletionQueue(
+            self._delete_instance, database, self.locks, workers=DELETION_WORKERS
+        )
+
+        self.expiry = ExpiryScheduler(database, self.kill_instance, workers=EXPIRY_WORKERS)
 
-        Thread(
-            target=self.__instance_pruner_thread,
-            name=f"{self.__class__.__name__} Anvil Pruner",
-            daemon=True,
-        ).start()
-
-    def __instance_pruner_thread(self):
-        while True:
-            try:
-                for instance in self._database.get_expired_instances():
-                    logging.info(
-                        "pruning expired instance: %s", instance["instance_id"]
-                    )
-
-                    self.kill_instance(instance["instance_id"])
-            except Exception as e:
-                logging.error("failed to prune instances", exc_info=e)
-            time.sleep(1)
-
-    def launch_instance(self, args: CreateInstanceRequest) -> UserData:
+    def launch_instance(
+        self, args: CreateInstanceRequest, progress: ProgressCallback = no_progress
+    ) -> UserData:
         if self._database.get_instance(args["instance_id"]) is not None:
             raise InstanceExists()
 
+        # also held by a kill until the old instance's resources are gone, which
+        # would collide with ours
+        lock = self.locks.acquire(args["instance_id"], INSTANCE_LOCK_TIMEOUT)
         try:
-            user_data = self._launch_instance_impl(args)
-            self._database.register_instance(args["instance_id"], user_data)
+            # another replica may have launched it while we waited
+            if self._database.get_instance(args["instance_id"]) is not None:
+                raise InstanceExists()
+
+            # left over from a kill whose deletion gave up or whose replica
+            # died, and its resources would collide with ours
+            pending = self._database.get_pending_deletion(args["instance_id"])
+            if pending is not None:
+                self._delete_instance(pending)
+                self._database.finish_deletion(args["instance_id"], fencing_token=lock.token)
+
+            return self.__launch_locked(args, progress, lock.token)
+        finally:
+            self.locks.release(lock)
+
+    def __launch_locked(
+        self, args: CreateInstanceRequest, progress: ProgressCallback, fencing_token: int
+    ) -> UserData:
+        try:
+            progress("creating", None)
+            user_data = self._launch_instance_impl(args, progress)
+            user_data["rate_limit"] = args.get("rate_limit")
+            user_data["rpc_policy"] = args.get("rpc_policy")
+            user_data["team_id"] = args.get("team_id")
+            for anvil_id, anvil_args in args.get("anvil_instances", {}).items():
+                if anvil_args.get("rpc_policy") is not None:
+                    user_data["anvil_instances"][anvil_id]["rpc_policy"] = anvil_args[
+                        "rpc_policy"
+                    ]
+            progress("registering", None)
+            self._database.register_instance(
+                args["instance_id"], user_data, fencing_token=fencing_token
+            )
             return user_data
 
         except:
             self._cleanup_instance(args)
             raise
 
-    def _launch_instance_impl(self, args: CreateInstanceRequest) -> UserData:
+    def _launch_instance_impl(
+        self, args: CreateInstanceRequest, progress: ProgressCallback
+    ) -> UserData:
         pass
 
     def _cleanup_instance(self, args: CreateInstanceRequest):
         pass
 
+    def kill_instance(self, id: str) -> Optional[UserData]:
+        # the instance stops routing immediately, its resources go in the background
+        if self._database.get_instance(id) is None:
+            # don't wait behind the teardown of one that was already killed
+            return None
+
+        lock = self.locks.acquire(id, INSTANCE_LOCK_TIMEOUT)
+        try:
+            instance = self._database.unregister_instance(id, fencing_token=lock.token)
+        except:
+            self.locks.release(lock)
+            raise
+
+        if instance is None:
+            self.locks.release(lock)
+            return None
+
+        # the lock stays held until the resources are deleted, so a new launch
+        # with the same id waits for them
+        self.deletions.submit(instance, lock)
+        return instance
+
+    def update_metadata(self, instance_id: str, metadata: Dict[str, str]):
+        with self.locks.hold(instance_id, INSTANCE_LOCK_TIMEOUT) as lock:
+            self._database.update_metadata(instance_id, metadata, fencing_token=lock.token)
+
     @abc.abstractmethod
-    def kill_instance(self, id: str) -> UserData:
+    def _delete_instance(self, instance: UserData):
         pass
 
+    def refresh_endpoints(self, instance_id: str) -> Optional[UserData]:
+        # a node that was restarted may have come back at a different address
+        if self._database.get_instance(instance_id) is None:
+            # still launching, the launch records the address itself
+            return None
+
+        try:
+            # best-effort, so don't hold up the caller behind a kill or update
+            lock = self.locks.acquire(instance_id, 0)
+        except LockTimeout:
+            return None
+
+        try:
+            return self.__refresh_endpoints_locked(instance_id)
+        finally:
+            self.locks.release(lock)
+
+    def __refresh_endpoints_locked(self, instance_id: str) -> Optional[UserData]:
+        instance = self._database.get_instance(instance_id)
+        if instance is None:
+            return None
+
+        changed = False
+        for anvil_id, anvil_instance in instance["anvil_instances"].items():
+            ip = self._get_anvil_ip(instance_id, anvil_id)
+            if ip is not None and ip != anvil_instance["ip"]:
+                logging.info(
+                    "anvil %s/%s moved from %s to %s",
+                    instance_id,
+                    anvil_id,
+                    anvil_instance["ip"],
+                    ip,
+                )
+                anvil_instance["ip"] = ip
+                changed = True
+
+        if changed:
+            self._database.update_instance(instance_id, instance)
+        return instance
+
+    def _get_anvil_ip(self, instance_id: str, anvil_id: str) -> Optional[str]:
+        return None
+
     def _generate_rpc_id(self, N: int = 24) -> str:
         return "".join(
             random.SystemRandom().choice(string.ascii_letters) for _ in range(N)
         )
 
-    def __derive_account(self, derivation_path: str, mnemonic: str, index: int) -> str:
-        seed = seed_from_mnemonic(mnemonic, "")
-        private_key = key_from_seed(seed, f"{derivation_path}{index}")
-
-        return Account.from_key(private_key)
-
-    def _prepare_node(self, args: LaunchAnvilInstanceArgs, web3: Web3):
+    def _prepare_node(
+        self,
+        args: LaunchAnvilInstanceArgs,
+        web3: Web3,
+        progress: ProgressCallback = no_progress,
+        anvil_id: Optional[str] = None,
+    ):
+        progress("waiting", anvil_id)
+        # poll quickly at first, most nodes come up within a second
+        delay = NODE_PROBE_INTERVAL
+        deadline = time.monotonic() + NODE_READY_TIMEOUT
         while not web3.is_connected():
-            time.sleep(0.1)
-            continue
-
-        for i in range(args.get("accounts", DEFAULT_ACCOUNTS)):
-            anvil_setBalance(
-                web3,
-                self.__derive_account(
-                    args.get("derivation_path", DEFAULT_DERIVATION_PATH),
+            if time.monotonic() > deadline:
+                raise Exception(f"node {anvil_id} did not start in time")
+            time.sleep(delay)
+            delay = min(delay * 2, NODE_MAX_PROBE_INTERVAL)
+
+        progress("funding", anvil_id)
+        balance = hex(int(args.get("balance", DEFAULT_BALANCE) * 10**18))
+        anvil_setBalances(
+            web3,
+            {
+                derive_account(
                     args.get("mnemonic", DEFAULT_MNEMONIC),
-                    i,
-                ).address,
-                hex(int(args.get("balance", DEFAULT_BALANCE) * 10**18)),
-            )
+                    f"{args.get('derivation_path', DEFAULT_DERIVATION_PATH)}{i}",
+                ).address: balance
+                for i in range(args.get("accounts", DEFAULT_ACCOUNTS))
+            },
+        )
@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, Tuple
+
+from ctf_server.databases.database import Database
+from ctf_server.types import UserData
+
+from .locks import InstanceLock, InstanceLocks, LockTimeout
+
+
+@dataclass
+class DeletionStats:
+    queued: int = 0
+    deleted: int = 0
+    retried: int = 0
+    failed: int = 0
+    resumed: int = 0
+    running: int = 0
+    backlog: int = 0
+
+
+class DeletionQueue:
+    # Deletes the resources of unregistered instances in the background, a few
+    # at a time, retrying failures with backoff. Unregistering leaves a pending
+    # deletion in the database that is only removed once the resources are
+    # gone, and every so often pending deletions that nobody is working on,
+    # because their replica died or gave up, are picked up again. The instance
+    # stays locked while it's being deleted.
+    def __init__(
+        self,
+        delete: Callable[[UserData], None],
+        database: Database,
+        locks: InstanceLocks,
+        workers: int = 4,
+        max_attempts: int = 5,
+        retry_delay: float = 1,
+        reconcile_interval: float = 30,
+    ):
+        self.__delete = delete
+        self.__database = database
+        self.__locks = locks
+        self.__max_attempts = max_attempts
+        self.__retry_delay = retry_delay
+        self.__reconcile_interval = reconcile_interval
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="delete"
+        )
+
+        self.__lock = threading.Lock()
+        # instance_id -> (instance, its lock), until its deletion succeeds or gives up
+        self.__pending: Dict[str, Tuple[UserData, InstanceLock]] = {}
+        self.__stats = DeletionStats()
+
+        # the first pass waits an interval too, so the backend is fully set up
+        threading.Thread(
+            target=self.__reconcile_thread, name="Deletion Reconciler", daemon=True
+        ).start()
+
+    def submit(self, instance: UserData, lock: InstanceLock):
+        # the lock is released once the deletion succeeds or gives up
+        with self.__lock:
+            duplicate = instance["instance_id"] in self.__pending
+            if not duplicate:
+                self.__pending[instance["instance_id"]] = (instance, lock)
+                self.__stats.queued += 1
+
+        if duplicate:
+            self.__locks.release(lock)
+            return
+
+        self.__executor.submit(self.__run, instance, 1)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.__lock:
+            self.__stats.backlog = len(self.__pending)
+            return asdict(self.__stats)
+
+    def __run(self, instance: UserData, attempt: int):
+        instance_id = instance["instance_id"]
+        with self.__lock:
+            self.__stats.running += 1
+
+        try:
+            self.__delete(instance)
+        except Exception as e:
+            if attempt < self.__max_attempts:
+                delay = self.__retry_delay * 2 ** (attempt - 1)
+                logging.warning(
+                    "failed to delete instance %s, retrying in %ss",
+                    instance_id,
+                    delay,
+                    exc_info=e,
+                )
+                with self.__lock:
+                    self.__stats.retried += 1
+                # don't hold a worker while waiting
+                timer = threading.Timer(
+                    delay, self.__executor.submit, (self.__run, instance, attempt + 1)
+                )
+                timer.daemon = True
+                timer.start()
+                return
+
+            logging.error(
+                "giving up on deleting instance %s until the next reconcile",
+                instance_id,
+                exc_info=e,
+            )
+            self.__finish(instance_id, deleted=False)
+            return
+        finally:
+            with self.__lock:
+                self.__stats.running -= 1
+
+        logging.info("deleted instance %s", instance_id)
+        self.__finish(instance_id, deleted=True)
+
+    def __finish(self, instance_id: str, deleted: bool):
+        with self.__lock:
+            _, lock = self.__pending.pop(instance_id)
+            if deleted:
+                self.__stats.deleted += 1
+            else:
+                self.__stats.failed += 1
+
+        try:
+            if deleted:
+                self.__database.finish_deletion(instance_id, fencing_token=lock.token)
+        except Exception as e:
+            # deleting again is harmless, the next reconcile will
+            logging.error("failed to finish deleting instance %s", instance_id, exc_info=e)
+        finally:
+            self.__locks.release(lock)
+
+    def __reconcile_thread(self):
+        while True:
+            time.sleep(self.__reconcile_interval)
+
+            try:
+                self.__reconcile()
+            except Exception as e:
+                logging.error("failed to reconcile pending deletions", exc_info=e)
+
+    def __reconcile(self):
+        for instance in self.__database.get_pending_deletions():
+            instance_id = instance["instance_id"]
+            with self.__lock:
+                if instance_id in self.__pending:
+                    continue
+
+            try:
+                # held while another replica deletes it
+                lock = self.__locks.acquire(instance_id, 0)
+            except LockTimeout:
+                continue
+
+            # it may have been finished between listing and locking
+            instance = self.__database.get_pending_deletion(instance_id)
+            if instance is None:
+                self.__locks.release(lock)
+                continue
+
+            logging.info("resuming deletion of instance %s", instance_id)
+            with self.__lock:
+                self.__stats.resumed += 1
+            self.submit(instance, lock)
@@ -1,8 +1,12 @@
 import http.client
 import logging
+import secrets
 import shlex
+import os
 import time
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Thread
+from typing import Callable, Dict, List, Optional, TypeVar
 
 import docker
 from ctf_server.databases.database import Database
@@ -10,6 +14,7 @@ from ctf_server.types import (
     DEFAULT_IMAGE,
     CreateInstanceRequest,
     InstanceInfo,
+    LaunchAnvilInstanceArgs,
     UserData,
     format_anvil_args,
 )
@@ -20,7 +25,29 @@ from docker.types import Mount, RestartPolicy
 from docker.types.services import RestartConditionTypesEnum
 from web3 import Web3
 
-from .backend import Backend
+from .backend import Backend, ProgressCallback
+from .locks import get_lease_holder
+from .warm_pool import WarmPool, WarmPools
+
+INSTANCE_LABEL = "paradigmctf.instance_id"
+ANVIL_LABEL = "paradigmctf.anvil_id"
+# set on pre-booted nodes, which are renamed to "<instance_id>-<anvil_id>" when
+# claimed; labels can't be changed, so those never get an instance label
+WARM_LABEL = "paradigmctf.warm_profile"
+WARM_PREFIX = "warm-"
+# the replica whose pools a pre-booted node belongs to; each replica holds a
+# lease named after itself, and nodes of replicas whose lease lapsed are swept
+WARM_OWNER_LABEL = "paradigmctf.warm_owner"
+WARM_OWNER_LEASE_TTL = 30
+WARM_SWEEP_INTERVAL = 60
+
+# how long a pre-booted node may take to answer rpc
+WARM_NODE_BOOT_TIMEOUT = 120
+
+# docker calls and node preparation running at once, across all launches
+DOCKER_CONCURRENCY = int(os.getenv("DOCKER_CONCURRENCY", "16"))
+
+T = TypeVar("T")
 
 
 class DockerBackend(Backend):
@@ -28,72 +55,84 @@ class DockerBackend(Backend):
         super().__init__(database)
 
         self.__client = docker.from_env()
+        self.__executor = ThreadPoolExecutor(
+            max_workers=DOCKER_CONCURRENCY, thread_name_prefix="docker"
+        )
 
-    def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
-        instance_id = request["instance_id"]
+        self.__warm_owner = get_lease_holder()
+        self.__renew_warm_owner_lease()
 
-        volume: Volume = self.__client.volumes.create(name=instance_id)
+        self.warm_pools = WarmPools(
+            create=self.__create_warm_node,
+            destroy=self.__try_delete_container,
+            is_alive=self.__is_running,
+        )
 
-        anvil_containers: Dict[str, Container] = {}
-        for anvil_id, anvil_args in request["anvil_instances"].items():
-            anvil_containers[anvil_id] = self.__client.containers.run(
-                name=f"{instance_id}-{anvil_id}",
-                image=anvil_args.get("image", DEFAULT_IMAGE),
-                network="paradigmctf",
-                entrypoint=["sh", "-c"],
-                command=[
-                    "while true; do anvil "
-                    + " ".join(
-                        [
-                            shlex.quote(str(v))
-                            for v in format_anvil_args(anvil_args, anvil_id)
-                        ]
-                    )
-                    + "; sleep 1; done;"
-                ],
-                restart_policy={"Name": "always"},
-                detach=True,
-                mounts=[
-                    Mount(target="/data", source=volume.id),
-                ],
-            )
+        Thread(
+            target=self.__warm_sweeper_thread,
+            name=f"{self.__class__.__name__} Warm Node Sweeper",
+            daemon=True,
+        ).start()
 
-        daemon_containers: Dict[str, Container] = {}
-        for daemon_id, daemon_args in request.get("daemon_instances", {}).items():
-            daemon_containers[daemon_id] = self.__client.containers.run(
-                name=f"{instance_id}-{daemon_id}",
-                image=daemon_args["image"],
-                network="paradigmctf",
-                restart_policy={"Name": "always"},
-                detach=True,
-                environment={
-                    "INSTANCE_ID": instance_id,
-                },
-            )
+        Thread(
+            target=self.__endpoint_watcher_thread,
+            name=f"{self.__class__.__name__} Endpoint Watcher",
+            daemon=True,
+        ).start()
 
-        anvil_instances: Dict[str, InstanceInfo] = {}
-        for anvil_id, anvil_container in anvil_containers.items():
-            container: Container = self.__client.containers.get(anvil_container.id)
+    def _launch_instance_impl(
+        self, request: CreateInstanceRequest, progress: ProgressCallback
+    ) -> UserData:
+        instance_id = request["instance_id"]
 
-            anvil_instances[anvil_id] = {
-                "id": anvil_id,
-                "ip": container.attrs["NetworkSettings"]["Networks"]["paradigmctf"][
-                    "IPAddress"
-                ],
-                "port": 8545,
-            }
+        volume: Volume = self.__client.volumes.create(name=instance_id)
+
+        anvil_ids = list(request["anvil_instances"].keys())
+        daemon_ids = list(request.get("daemon_instances", {}).keys())
+
+        # every container of the instance is created, inspected and prepared at
+        # once, so a launch takes as long as its slowest node
+        self.__run_all(
+            [
+                lambda anvil_id=anvil_id: self.__start_anvil(
+                    instance_id, anvil_id, request["anvil_instances"][anvil_id], volume
+                )
+                for anvil_id in anvil_ids
+            ]
+            + [
+                lambda daemon_id=daemon_id: self.__client.containers.run(
+                    name=f"{instance_id}-{daemon_id}",
+                    image=request["daemon_instances"][daemon_id]["image"],
+                    network="paradigmctf",
+                    restart_policy={"Name": "always"},
+                    detach=True,
+                    environment={
+                        "INSTANCE_ID": instance_id,
+                    },
+                )
+                for daemon_id in daemon_ids
+            ]
+        )
 
-            self._prepare_node(
-                request["anvil_instances"][anvil_id],
-                Web3(
-                    Web3.HTTPProvider(
-                        f"http://{anvil_instances[anvil_id]['ip']}:{anvil_instances[anvil_id]['port']}"
-                    )
+        anvil_instances: Dict[str, InstanceInfo] = dict(
+            zip(
+                anvil_ids,
+                self.__run_all(
+                    [
+                        lambda anvil_id=anvil_id: self.__prepare_anvil(
+                            instance_id,
+                            anvil_id,
+                            request["anvil_instances"][anvil_id],
+                            progress,
+                        )
+                        for anvil_id in anvil_ids
+                    ]
                 ),
             )
+        )
 
         daemon_instances = {}
-        for daemon_id, daemon_container in daemon_containers.items():
+        for daemon_id in daemon_ids:
             daemon_instances[daemon_id] = {
                 "id": daemon_id,
             }
@@ -109,6 +148,209 @@ class DockerBackend(Backend):
             metadata={},
         )
 
+    def __run_all(self, calls: List[Callable[[], T]]) -> List[T]:
+        futures = [self.__executor.submit(call) for call in calls]
+        # let everything finish before raising, so cleanup sees every container
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def __start_anvil(
+        self,
+        instance_id: str,
+        anvil_id: str,
+        anvil_args: LaunchAnvilInstanceArgs,
+        volume: Volume,
+    ) -> Container:
+        return self.__claim_warm_node(instance_id, anvil_id, anvil_args) or self.__run_anvil(
+            f"{instance_id}-{anvil_id}",
+            anvil_id,
+            anvil_args,
+            labels={INSTANCE_LABEL: instance_id, ANVIL_LABEL: anvil_id},
+            mount=Mount(target="/data", source=volume.id),
+        )
+
+    def __prepare_anvil(
+        self,
+        instance_id: str,
+        anvil_id: str,
+        anvil_args: LaunchAnvilInstanceArgs,
+        progress: ProgressCallback,
+    ) -> InstanceInfo:
+        container: Container = self.__client.containers.get(f"{instance_id}-{anvil_id}")
+
+        anvil_instance: InstanceInfo = {
+            "id": anvil_id,
+            "ip": container.attrs["NetworkSettings"]["Networks"]["paradigmctf"][
+                "IPAddress"
+            ],
+            "port": 8545,
+        }
+
+        self._prepare_node(
+            anvil_args,
+            Web3(
+                Web3.HTTPProvider(
+                    f"http://{anvil_instance['ip']}:{anvil_instance['port']}"
+                )
+            ),
+            progress,
+            anvil_id,
+        )
+        return anvil_instance
+
+    def __run_anvil(
+        self,
+        name: str,
+        anvil_id: str,
+        anvil_args: LaunchAnvilInstanceArgs,
+        labels: Dict[str, str],
+        mount: Mount,
+    ) -> Container:
+        return self.__client.containers.run(
+            name=name,
+            image=anvil_args.get("image", DEFAULT_IMAGE),
+            network="paradigmctf",
+            entrypoint=["sh", "-c"],
+            command=[
+                "while true; do anvil "
+                + " ".join(
+                    [
+                        shlex.quote(str(v))
+                        for v in format_anvil_args(anvil_args, anvil_id)
+                    ]
+                )
+                + "; sleep 1; done;"
+            ],
+            restart_policy={"Name": "always"},
+            detach=True,
+            labels=labels,
+            mounts=[mount],
+        )
+
+    def __claim_warm_node(
+        self, instance_id: str, anvil_id: str, anvil_args: LaunchAnvilInstanceArgs
+    ) -> Optional[Container]:
+        name = self.warm_pools.claim(anvil_id, anvil_args)
+        if name is None:
+            return None
+
+        try:
+            container: Container = self.__client.containers.get(name)
+            container.rename(f"{instance_id}-{anvil_id}")
+        except Exception as e:
+            logging.error("failed to claim warm node %s", name, exc_info=e)
+            self.__try_delete_container(name)
+            return None
+
+        logging.info("claimed warm node %s for %s/%s", name, instance_id, anvil_id)
+        return container
+
+    def __create_warm_node(self, pool: WarmPool) -> str:
+        name = f"{WARM_PREFIX}{secrets.token_hex(8)}-{pool.anvil_id}"
+        # an anonymous volume, removed along with the container
+        container = self.__run_anvil(
+            name,
+            pool.anvil_id,
+            pool.profile,
+            labels={
+                ANVIL_LABEL: pool.anvil_id,
+                WARM_LABEL: pool.key,
+                WARM_OWNER_LABEL: self.__warm_owner,
+            },
+            mount=Mount(target="/data", source=None, type="volume"),
+        )
+
+        try:
+            deadline = time.time() + WARM_NODE_BOOT_TIMEOUT
+            while True:
+                container.reload()
+                ip = container.attrs["NetworkSettings"]["Networks"]["paradigmctf"]["IPAddress"]
+                if ip and Web3(Web3.HTTPProvider(f"http://{ip}:8545")).is_connected():
+                    return name
+                if time.time() > deadline:
+                    raise Exception(f"warm node {name} did not start in time")
+                time.sleep(0.1)
+        except:
+            self.__try_delete_container(name)
+            raise
+
+    def __renew_warm_owner_lease(self):
+        if self._database.acquire_lease(
+            f"warm_owner/{self.__warm_owner}", self.__warm_owner, WARM_OWNER_LEASE_TTL
+        ) is None:
+            logging.error("warm node lease of %s is held by someone else", self.__warm_owner)
+
+    def __warm_sweeper_thread(self):
+        swept_at = 0.0
+        while True:
+            try:
+                self.__renew_warm_owner_lease()
+                if time.monotonic() - swept_at >= WARM_SWEEP_INTERVAL:
+                    self.__sweep_warm_nodes()
+                    swept_at = time.monotonic()
+            except Exception as e:
+                logging.error("failed to sweep warm nodes", exc_info=e)
+            time.sleep(WARM_OWNER_LEASE_TTL / 3)
+
+    def __sweep_warm_nodes(self):
+        # unclaimed nodes of replicas that are gone; claimed ones have been
+        # renamed and belong to their instance
+        orphans: Dict[str, List[str]] = {}
+        for container in self.__client.containers.list(
+            all=True, filters={"label": WARM_LABEL}
+        ):
+            owner = container.labels.get(WARM_OWNER_LABEL, "")
+            if container.name.startswith(WARM_PREFIX) and owner != self.__warm_owner:
+                orphans.setdefault(owner, []).append(container.name)
+
+        for owner, names in orphans.items():
+            # taking the lease only works once its owner stopped renewing it
+            lease = f"warm_owner/{owner}"
+            if self._database.acquire_lease(lease, self.__warm_owner, WARM_OWNER_LEASE_TTL) is None:
+                continue
+
+            logging.info("deleting %d warm nodes left by %s", len(names), owner or "unknown")
+            self.__run_all([lambda name=name: self.__try_delete_container(name) for name in names])
+            self._database.release_lease(lease, self.__warm_owner)
+
+    def __is_running(self, container_name: str) -> bool:
+        try:
+            container: Container = self.__client.containers.get(container_name)
+        except NotFound:
+            return False
+
+        return container.status == "running"
+
+    def _get_anvil_ip(self, instance_id: str, anvil_id: str) -> Optional[str]:
+        try:
+            container: Container = self.__client.containers.get(f"{instance_id}-{anvil_id}")
+        except NotFound:
+            return None
+
+        return container.attrs["NetworkSettings"]["Networks"]["paradigmctf"]["IPAddress"] or None
+
+    def __endpoint_watcher_thread(self):
+        # a restarted container can get a new address, so re-read it on every start
+        while True:
+            try:
+                for event in self.__client.events(
+                    decode=True,
+                    filters={"type": "container", "event": "start", "label": ANVIL_LABEL},
+                ):
+                    attributes = event["Actor"]["Attributes"]
+                    instance_id = attributes.get(INSTANCE_LABEL)
+                    if instance_id is None and not attributes["name"].startswith(WARM_PREFIX):
+                        # a claimed warm node, which only has its name to go by
+                        instance_id = attributes["name"].removesuffix(
+                            f"-{attributes[ANVIL_LABEL]}"
+                        )
+                    if instance_id is not None:
+                        # unknown while the instance is still launching, which is fine
+                        self.refresh_endpoints(instance_id)
+            except Exception as e:
+                logging.error("failed to watch container events", exc_info=e)
+            time.sleep(1)
+
     def _cleanup_instance(self, args: CreateInstanceRequest):
         instance_id = args["instance_id"]
 
@@ -118,36 +360,38 @@ class DockerBackend(Backend):
             args.get("daemon_instances", {}).keys(),
         )
 
-    def kill_instance(self, instance_id: str) -> UserData:
-        instance = self._database.unregister_instance(instance_id)
-        if instance is None:
-            return None
-
-        self.__try_delete(
-            instance_id,
+    def _delete_instance(self, instance: UserData):
+        if not self.__try_delete(
+            instance["instance_id"],
             instance.get("anvil_instances", {}).keys(),
             instance.get("daemon_instances", {}).keys(),
-        )
-
-        return instance
+        ):
+            raise Exception(f"failed to delete instance {instance['instance_id']}")
 
     def __try_delete(
         self, instance_id: str, anvil_ids: List[str], daemon_ids: List[str]
-    ):
-        for anvil_id in anvil_ids:
-            self.__try_delete_container(f"{instance_id}-{anvil_id}")
-
-        for daemon_id in daemon_ids:
-            self.__try_delete_container(f"{instance_id}-{daemon_id}")
+    ) -> bool:
+        deleted = self.__run_all(
+            [
+                lambda container_id=container_id: self.__try_delete_container(
+                    f"{instance_id}-{container_id}"
+                )
+                for container_id in list(anvil_ids) + list(daemon_ids)
+            ]
+        )
+        if not all(deleted):
+            # the volume is still in use
+            return False
 
-        self.__try_delete_volume(instance_id)
+        # the volume can only go once no container uses it
+        return self.__try_delete_volume(instance_id)
 
-    def __try_delete_container(self, container_name: str):
+    def __try_delete_container(self, container_name: str) -> bool:
         try:
             try:
                 container: Container = self.__client.containers.get(container_name)
             except NotFound:
-                return
+                return True
 
             logging.info("deleting container %s (%s)", container.id, container.name)
 
@@ -158,7 +402,9 @@ class DockerBackend(Backend):
                 if api_error.status_code != http.client.CONFLICT:
                     raise
 
-            container.remove()
+            # also drops the anonymous volume of a warm node
+            container.remove(v=True)
+            return True
         except Exception as e:
             logging.error(
                 "failed to delete container %s (%s)",
@@ -166,18 +412,21 @@ class DockerBackend(Backend):
                 container.name,
                 exc_info=e,
             )
+            return False
 
-    def __try_delete_volume(self, volume_name: str):
+    def __try_delete_volume(self, volume_name: str) -> bool:
         try:
             try:
                 volume: Volume = self.__client.volumes.get(volume_name)
             except NotFound:
-                return
+                return True
 
             logging.info("deleting volume %s (%s)", volume.id, volume.name)
 
             volume.remove()
+            return True
         except Exception as e:
             logging.error(
                 "failed to delete volume %s (%s)", volume.id, volume.name, exc_info=e
             )
+            return False
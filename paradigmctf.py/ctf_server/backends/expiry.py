@@ -0,0 +1,177 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Tuple
+
+from ctf_server.databases.database import Database
+from ctf_server.types import InstanceEvent
+
+from .locks import get_lease_holder
+
+EXPIRY_LEASE = "expiry_scheduler"
+
+
+@dataclass
+class ExpiryStats:
+    leader: int = 0
+    scheduled: int = 0
+    reaped: int = 0
+    reap_failures: int = 0
+    reloads: int = 0
+
+
+class ExpiryScheduler:
+    # Kills instances when they expire. The upcoming expiries are kept in a
+    # heap that is loaded once and then maintained from instance events, and
+    # the scheduler sleeps until the earliest one. Only the replica holding the
+    # lease keeps the heap and reaps; the others just try to take the lease
+    # over now and then, and load the heap when they do.
+    def __init__(
+        self,
+        database: Database,
+        kill: Callable[[str], None],
+        workers: int = 4,
+        lease_ttl: float = 15,
+    ):
+        self.__database = database
+        self.__kill = kill
+        self.__lease_ttl = lease_ttl
+        self.__holder = get_lease_holder()
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="expiry"
+        )
+
+        self.__condition = threading.Condition()
+        # (expires_at, instance_id); entries that no longer match __expiries are stale
+        self.__heap: List[Tuple[float, str]] = []
+        self.__expiries: Dict[str, float] = {}
+        self.__leader = False
+        self.__reload = True
+        self.__stats = ExpiryStats()
+
+        database.subscribe_instance_events(self.__on_instance_event)
+
+        threading.Thread(
+            target=self.__scheduler_thread, name="Expiry Scheduler", daemon=True
+        ).start()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.__condition:
+            self.__stats.leader = int(self.__leader)
+            self.__stats.scheduled = len(self.__expiries)
+            return asdict(self.__stats)
+
+    def __on_instance_event(self, event: InstanceEvent):
+        with self.__condition:
+            if event["type"] == "resync":
+                self.__reload = True
+            elif event["type"] == "unregister":
+                self.__expiries.pop(event["instance_id"], None)
+                return
+            elif event["type"] == "register":
+                expires_at = event.get("expires_at")
+                if expires_at is None:
+                    # published by an older replica
+                    self.__reload = True
+                else:
+                    self.__schedule(event["instance_id"], expires_at)
+            self.__condition.notify_all()
+
+    def __schedule(self, instance_id: str, expires_at: float):
+        # lock held
+        if not self.__leader:
+            return
+        if self.__expiries.get(instance_id) == expires_at:
+            return
+        self.__expiries[instance_id] = expires_at
+        heapq.heappush(self.__heap, (expires_at, instance_id))
+
+    def __scheduler_thread(self):
+        renew_at = 0.0
+        while True:
+            try:
+                now = time.monotonic()
+                if now >= renew_at:
+                    self.__renew_lease()
+                    renew_at = now + self.__lease_ttl / 3
+
+                with self.__condition:
+                    leader, reload = self.__leader, self.__reload
+                if leader and reload:
+                    self.__load()
+
+                due = self.__pop_due() if leader else []
+                for instance_id in due:
+                    self.__executor.submit(self.__reap, instance_id)
+
+                with self.__condition:
+                    timeout = renew_at - time.monotonic()
+                    if self.__leader and not self.__reload and len(self.__heap) > 0:
+                        timeout = min(timeout, self.__heap[0][0] - time.time())
+                    if timeout > 0 and not self.__reload:
+                        self.__condition.wait(timeout)
+            except Exception as e:
+                logging.error("failed to schedule expiries", exc_info=e)
+                time.sleep(1)
+
+    def __renew_lease(self):
+        token = self.__database.acquire_lease(EXPIRY_LEASE, self.__holder, self.__lease_ttl)
+        with self.__condition:
+            if (token is not None) != self.__leader:
+                logging.info(
+                    "%s the expiry lease", "acquired" if token is not None else "lost"
+                )
+                # whatever happened while we weren't leading has to be read back
+                self.__reload = True
+            self.__leader = token is not None
+            if not self.__leader:
+                self.__heap = []
+                self.__expiries = {}
+
+    def __load(self):
+        expiries = self.__database.get_expiries()
+        with self.__condition:
+            # merged rather than replaced, so events that raced the read aren't
+            # lost; leftovers of deleted instances are skipped when reaped
+            for instance_id, expires_at in expiries.items():
+                self.__schedule(instance_id, expires_at)
+            self.__reload = False
+            self.__stats.reloads += 1
+
+    def __pop_due(self) -> List[str]:
+        now = time.time()
+        due = []
+        with self.__condition:
+            while len(self.__heap) > 0 and self.__heap[0][0] <= now:
+                expires_at, instance_id = heapq.heappop(self.__heap)
+                if self.__expiries.get(instance_id) == expires_at:
+                    del self.__expiries[instance_id]
+                    due.append(instance_id)
+        return due
+
+    def __reap(self, instance_id: str):
+        try:
+            # it may have been extended by a replica whose event we haven't seen
+            instance = self.__database.get_instance(instance_id)
+            if instance is None:
+                return
+            if instance["expires_at"] > time.time():
+                with self.__condition:
+                    self.__schedule(instance_id, instance["expires_at"])
+                    self.__condition.notify_all()
+                return
+
+            logging.info("pruning expired instance: %s", instance_id)
+            self.__kill(instance_id)
+            with self.__condition:
+                self.__stats.reaped += 1
+        except Exception as e:
+            logging.error("failed to prune instance %s", instance_id, exc_info=e)
+            with self.__condition:
+                self.__stats.reap_failures += 1
+                # try again shortly rather than never
+                self.__schedule(instance_id, time.time() + 5)
+                self.__condition.notify_all()
@@ -1,7 +1,7 @@
 import http.client
 import shlex
 import time
-from typing import Any, List
+from typing import Any, List, Optional
 
 from web3 import Web3
 
@@ -18,7 +18,14 @@ from kubernetes.client.models import V1Pod
 
 from kubernetes import config
 
-from .backend import Backend
+from .backend import NODE_READY_TIMEOUT, Backend, ProgressCallback
+from .pod_informer import PodInformer, are_containers_ready, is_pod_finished
+
+# set on every instance pod, and what the informer watches
+INSTANCE_LABEL = "paradigmctf.instance_id"
+
+# how long a kill waits for the pod to be gone
+POD_DELETE_TIMEOUT = 60
 
 
 class KubernetesBackend(Backend):
@@ -31,14 +38,17 @@ class KubernetesBackend(Backend):
             config.load_kube_config(kubeconfig)
 
         self.__core_v1 = core_v1_api.CoreV1Api()
+        self.__informer = PodInformer(self.__core_v1, "default", INSTANCE_LABEL)
 
-    def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
+    def _launch_instance_impl(
+        self, request: CreateInstanceRequest, progress: ProgressCallback
+    ) -> UserData:
         instance_id = request["instance_id"]
 
         pod_manifest = {
             "apiVersion": "v1",
             "kind": "Pod",
-            "metadata": {"name": instance_id},
+            "metadata": {"name": instance_id, "labels": {INSTANCE_LABEL: instance_id}},
             "spec": {
                 "volumes": [{"name": "workdir", "emptyDir": {}}],
                 "containers": self.__get_anvil_containers(request)
@@ -50,13 +60,17 @@ class KubernetesBackend(Backend):
             namespace="default", body=pod_manifest
         )
 
-        while True:
-            api_response = self.__core_v1.read_namespaced_pod(
-                name=pod_manifest["metadata"]["name"], namespace="default"
-            )
-            if api_response.status.phase != "Pending":
-                break
-            time.sleep(1)
+        progress("waiting", None)
+        # ready once every node accepts connections, see the readiness probes;
+        # daemons need the instance registered first, so they aren't waited for
+        anvil_ids = list(request.get("anvil_instances", {}).keys())
+        api_response = self.__informer.wait_for(
+            instance_id,
+            lambda pod: are_containers_ready(pod, anvil_ids) or is_pod_finished(pod),
+            NODE_READY_TIMEOUT,
+        )
+        if not are_containers_ready(api_response, anvil_ids):
+            raise Exception(f"pod {instance_id} exited with phase {api_response.status.phase}")
 
         anvil_instances = {}
         for offset, anvil_id in enumerate(request.get("anvil_instances", []).keys()):
@@ -73,6 +87,8 @@ class KubernetesBackend(Backend):
                         f"http://{anvil_instances[anvil_id]['ip']}:{anvil_instances[anvil_id]['port']}"
                     )
                 ),
+                progress,
+                anvil_id,
             )
 
         daemon_instances = {}
@@ -90,6 +106,14 @@ class KubernetesBackend(Backend):
             metadata={},
         )
 
+    def _get_anvil_ip(self, instance_id: str, anvil_id: str) -> Optional[str]:
+        # every node of an instance runs in the same pod
+        pod = self.__informer.get(instance_id)
+        if pod is None:
+            return None
+
+        return pod.status.pod_ip
+
     def __get_anvil_containers(self, args: CreateInstanceRequest) -> List[Any]:
         return [
             {
@@ -114,6 +138,11 @@ class KubernetesBackend(Backend):
                         "name": "workdir",
                     }
                 ],
+                "readinessProbe": {
+                    "tcpSocket": {"port": 8545 + offset},
+                    "periodSeconds": 1,
+                    "failureThreshold": 1,
+                },
             }
             for offset, (anvil_id, anvil_args) in enumerate(
                 args.get("anvil_instances", []).items()
@@ -135,23 +164,13 @@ class KubernetesBackend(Backend):
             for (daemon_id, daemon_args) in args.get("daemon_instances", []).items()
         ]
 
-    def kill_instance(self, instance_id: str) -> UserData:
-        instance = self._database.unregister_instance(instance_id)
-        if instance is None:
-            return None
-
-        self.__core_v1.delete_namespaced_pod(namespace="default", name=instance_id, grace_period_seconds=0)
-
-        while True:
-            try:
-                self.__core_v1.read_namespaced_pod(
-                    namespace="default",
-                    name=instance_id,
-                )
-            except ApiException as e:
-                if e.status == http.client.NOT_FOUND:
-                    break
-
-            time.sleep(0.5)
+    def _delete_instance(self, instance: UserData):
+        instance_id = instance["instance_id"]
+        try:
+            self.__core_v1.delete_namespaced_pod(namespace="default", name=instance_id, grace_period_seconds=0)
+        except ApiException as e:
+            if e.status != http.client.NOT_FOUND:
+                raise
 
-        return instance
+        # raises if the pod lingers, and the deletion is retried
+        self.__informer.wait_for(instance_id, lambda pod: pod is None, POD_DELETE_TIMEOUT)
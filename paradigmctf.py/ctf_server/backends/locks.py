@@ -0,0 +1,157 @@
+import itertools
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterator
+
+from ctf_server.databases.database import Database, instance_lock_name
+
+
+def get_lease_holder() -> str:
+    # unique per process, and readable enough to tell who holds a lease
+    return f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}"
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class InstanceLock:
+    __slots__ = ("instance_id", "name", "holder", "token", "lost")
+
+    def __init__(self, instance_id: str, holder: str, token: int):
+        self.instance_id = instance_id
+        self.name = instance_lock_name(instance_id)
+        self.holder = holder
+        # passed along with writes, which the database refuses once the lock
+        # has moved on to someone else
+        self.token = token
+        self.lost = False
+
+
+@dataclass
+class LockStats:
+    acquired: int = 0
+    contended: int = 0
+    timeouts: int = 0
+    lost: int = 0
+    wait_seconds: float = 0
+    held: int = 0
+
+
+class InstanceLocks:
+    # Per-instance leases in the database, so replicas never launch, kill or
+    # modify the same instance at once. Held locks are renewed in the
+    # background for as long as a launch or teardown takes.
+    def __init__(
+        self,
+        database: Database,
+        ttl: float = 30,
+        min_poll_interval: float = 0.02,
+        max_poll_interval: float = 0.5,
+    ):
+        self.__database = database
+        self.__ttl = ttl
+        self.__min_poll_interval = min_poll_interval
+        self.__max_poll_interval = max_poll_interval
+        self.__holder = get_lease_holder()
+        self.__counter = itertools.count()
+
+        self.__lock = threading.Lock()
+        self.__held: Dict[str, InstanceLock] = {}
+        self.__stats = LockStats()
+
+        threading.Thread(
+            target=self.__renewer_thread, name="Instance Lock Renewer", daemon=True
+        ).start()
+
+    def acquire(self, instance_id: str, timeout: float) -> InstanceLock:
+        name = instance_lock_name(instance_id)
+        # every acquisition is its own holder, so threads of one process exclude
+        # each other too
+        holder = f"{self.__holder}-{next(self.__counter)}"
+
+        started_at = time.monotonic()
+        interval = self.__min_poll_interval
+        while True:
+            token = self.__database.acquire_lease(name, holder, self.__ttl)
+            if token is not None:
+                break
+
+            if interval == self.__min_poll_interval:
+                # first failed attempt
+                with self.__lock:
+                    self.__stats.contended += 1
+            if time.monotonic() - started_at + interval > timeout:
+                with self.__lock:
+                    self.__stats.timeouts += 1
+                    self.__stats.wait_seconds += time.monotonic() - started_at
+                raise LockTimeout(f"timed out waiting for the lock on {instance_id}")
+
+            time.sleep(interval)
+            interval = min(interval * 2, self.__max_poll_interval)
+
+        lock = InstanceLock(instance_id, holder, token)
+        with self.__lock:
+            self.__held[holder] = lock
+            self.__stats.acquired += 1
+            self.__stats.wait_seconds += time.monotonic() - started_at
+        return lock
+
+    def release(self, lock: InstanceLock):
+        with self.__lock:
+            self.__held.pop(lock.holder, None)
+
+        try:
+            self.__database.release_lease(lock.name, lock.holder)
+        except Exception as e:
+            # it expires on its own
+            logging.error("failed to release lock on %s", lock.instance_id, exc_info=e)
+
+    @contextmanager
+    def hold(self, instance_id: str, timeout: float) -> Iterator[InstanceLock]:
+        lock = self.acquire(instance_id, timeout)
+        try:
+            yield lock
+        finally:
+            self.release(lock)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self.__lock:
+            self.__stats.held = len(self.__held)
+            return asdict(self.__stats)
+
+    def __renewer_thread(self):
+        while True:
+            time.sleep(self.__ttl / 3)
+
+            with self.__lock:
+                locks = list(self.__held.values())
+
+            for lock in locks:
+                with self.__lock:
+                    if lock.holder not in self.__held:
+                        # released in the meantime
+                        continue
+
+                try:
+                    token = self.__database.acquire_lease(lock.name, lock.holder, self.__ttl)
+                except Exception as e:
+                    logging.error("failed to renew lock on %s", lock.instance_id, exc_info=e)
+                    continue
+
+                if token != lock.token:
+                    # expired and taken over; fenced writes from here on fail
+                    logging.warning("lost the lock on %s", lock.instance_id)
+                    lock.lost = True
+                    with self.__lock:
+                        self.__held.pop(lock.holder, None)
+                        self.__stats.lost += 1
+                    if token is not None:
+                        # we just took it again with a new token, give it back
+                        self.__database.release_lease(lock.name, lock.holder)
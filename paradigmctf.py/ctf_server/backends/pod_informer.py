@@ -0,0 +1,175 @@
+import http.client
+import logging
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Collection, Dict, Optional
+
+from kubernetes import watch
+from kubernetes.client.api import core_v1_api
+from kubernetes.client.exceptions import ApiException
+from kubernetes.client.models import V1Pod
+
+# how long one watch request stays open before it is renewed
+WATCH_TIMEOUT = 300
+
+
+def are_containers_ready(pod: Optional[V1Pod], names: Collection[str]) -> bool:
+    # only the named containers, unlike the pod's Ready condition which needs
+    # every container ready, including ones that only start working later
+    if pod is None or pod.status is None:
+        return False
+
+    ready = {status.name for status in pod.status.container_statuses or [] if status.ready}
+    return all(name in ready for name in names)
+
+
+def is_pod_finished(pod: Optional[V1Pod]) -> bool:
+    return pod is not None and pod.status is not None and pod.status.phase in ("Succeeded", "Failed")
+
+
+@dataclass
+class PodInformerStats:
+    lists: int = 0
+    watches: int = 0
+    events: int = 0
+    fallback_reads: int = 0
+    pods: int = 0
+
+
+class PodInformer:
+    # Keeps a local copy of our pods from one list and a long-running watch, so
+    # launches and kills can wait for a pod to change instead of polling the api
+    # server. While the watch is down, waiters fall back to reading the pod.
+    def __init__(
+        self,
+        core_v1: core_v1_api.CoreV1Api,
+        namespace: str,
+        label_selector: str,
+        fallback_interval: float = 1,
+    ):
+        self.__core_v1 = core_v1
+        self.__namespace = namespace
+        self.__label_selector = label_selector
+        self.__fallback_interval = fallback_interval
+
+        self.__pods: Dict[str, V1Pod] = {}
+        self.__synced = False
+        self.__condition = threading.Condition()
+        self.__stats = PodInformerStats()
+
+        threading.Thread(
+            target=self.__watch_thread, name="Pod Informer", daemon=True
+        ).start()
+
+    def get(self, name: str) -> Optional[V1Pod]:
+        with self.__condition:
+            return self.__pods.get(name)
+
+    def wait_for(
+        self,
+        name: str,
+        predicate: Callable[[Optional[V1Pod]], bool],
+        timeout: float,
+    ) -> Optional[V1Pod]:
+        # returns the pod (or None if it doesn't exist) once predicate holds for
+        # it, raising TimeoutError if it doesn't in time
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            while True:
+                if not self.__synced:
+                    self.__condition.release()
+                    try:
+                        pod = self.__read(name)
+                    finally:
+                        self.__condition.acquire()
+                    self.__stats.fallback_reads += 1
+                else:
+                    pod = self.__pods.get(name)
+
+                if predicate(pod):
+                    return pod
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"timed out waiting for pod {name}")
+
+                self.__condition.wait(
+                    remaining if self.__synced else min(remaining, self.__fallback_interval)
+                )
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.__condition:
+            self.__stats.pods = len(self.__pods)
+            return asdict(self.__stats)
+
+    def __read(self, name: str) -> Optional[V1Pod]:
+        try:
+            return self.__core_v1.read_namespaced_pod(name=name, namespace=self.__namespace)
+        except ApiException as e:
+            if e.status == http.client.NOT_FOUND:
+                return None
+            raise
+
+    def __watch_thread(self):
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    resource_version = self.__list()
+
+                self.__stats.watches += 1
+                stream = watch.Watch()
+                for event in stream.stream(
+                    self.__core_v1.list_namespaced_pod,
+                    namespace=self.__namespace,
+                    label_selector=self.__label_selector,
+                    resource_version=resource_version,
+                    timeout_seconds=WATCH_TIMEOUT,
+                    allow_watch_bookmarks=True,
+                ):
+                    self.__apply(event["type"], event["object"])
+                # picks up where the expired watch left off
+                resource_version = stream.resource_version
+            except ApiException as e:
+                if e.status != http.client.GONE:
+                    logging.error("failed to watch pods", exc_info=e)
+                    self.__set_unsynced()
+                    time.sleep(1)
+                # too far behind to resume, start over with a fresh list
+                resource_version = None
+            except Exception as e:
+                logging.error("failed to watch pods", exc_info=e)
+                self.__set_unsynced()
+                resource_version = None
+                time.sleep(1)
+
+    def __list(self) -> str:
+        self.__stats.lists += 1
+        pods = self.__core_v1.list_namespaced_pod(
+            namespace=self.__namespace, label_selector=self.__label_selector
+        )
+
+        with self.__condition:
+            self.__pods = {pod.metadata.name: pod for pod in pods.items}
+            self.__synced = True
+            self.__condition.notify_all()
+        return pods.metadata.resource_version
+
+    def __apply(self, event_type: str, pod: V1Pod):
+        if event_type == "BOOKMARK":
+            return
+
+        with self.__condition:
+            self.__stats.events += 1
+            if event_type == "DELETED":
+                self.__pods.pop(pod.metadata.name, None)
+            else:
+                self.__pods[pod.metadata.name] = pod
+            self.__condition.notify_all()
+
+    def __set_unsynced(self):
+        with self.__condition:
+            self.__synced = False
+            # waiters switch to reading the pods themselves
+            self.__condition.notify_all()
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Deque, Dict, List, Optional
+
+from ctf_server.types import LaunchAnvilInstanceArgs, WarmPoolArgs
+
+# launch arguments that decide what a booted node looks like; everything else,
+# like the mnemonic and balances, is applied when the node is claimed
+PROFILE_FIELDS = (
+    "image",
+    "fork_url",
+    "fork_block_num",
+    "fork_chain_id",
+    "no_rate_limit",
+    "chain_id",
+    "code_size_limit",
+    "block_time",
+)
+
+
+def get_profile_key(anvil_id: str, args: LaunchAnvilInstanceArgs) -> str:
+    # the anvil id is part of the node's command line, so it's part of the profile
+    profile = {key: args.get(key) for key in PROFILE_FIELDS if args.get(key) is not None}
+    encoded = json.dumps([anvil_id, profile], sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+@dataclass
+class WarmPoolStats:
+    size: int = 0
+    ready: int = 0
+    starting: int = 0
+    hits: int = 0
+    misses: int = 0
+    created: int = 0
+    failed: int = 0
+    expired: int = 0
+
+
+@dataclass
+class WarmNode:
+    handle: str
+    created_at: float = field(default_factory=time.time)
+
+
+class WarmPool:
+    def __init__(self, name: str, args: WarmPoolArgs):
+        self.name = name
+        self.anvil_id = args.get("anvil_id") or "main"
+        self.profile: LaunchAnvilInstanceArgs = args.get("profile") or {}
+        self.key = get_profile_key(self.anvil_id, self.profile)
+        self.size = args.get("size", 0)
+        # nodes older than this are replaced, so forks of "latest" don't go stale
+        self.max_age = args.get("max_age")
+
+        self.ready: Deque[WarmNode] = deque()
+        self.starting = 0
+        self.stats = WarmPoolStats()
+
+    def get_info(self) -> WarmPoolArgs:
+        return WarmPoolArgs(
+            size=self.size,
+            anvil_id=self.anvil_id,
+            max_age=self.max_age,
+            profile=self.profile,
+        )
+
+
+class WarmPools:
+    # Keeps a few nodes per launch profile booted ahead of time, so a launch can
+    # claim one instead of waiting for a container and anvil to start. The
+    # backend supplies how nodes are created, checked and destroyed; creating
+    # one blocks until the node answers rpc.
+    def __init__(
+        self,
+        create: Callable[[WarmPool], str],
+        destroy: Callable[[str], None],
+        is_alive: Callable[[str], bool],
+        workers: int = 2,
+        refill_interval: float = 5,
+    ):
+        self.__create = create
+        self.__destroy = destroy
+        self.__is_alive = is_alive
+        self.__refill_interval = refill_interval
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="warm-pool"
+        )
+
+        self.__lock = threading.Lock()
+        self.__pools: Dict[str, WarmPool] = {}
+        self.__wakeup = threading.Event()
+
+        threading.Thread(
+            target=self.__refill_thread, name="Warm Pool Refill", daemon=True
+        ).start()
+
+    def configure(self, name: str, args: WarmPoolArgs) -> WarmPoolArgs:
+        with self.__lock:
+            pool = self.__pools.get(name)
+            if pool is None or (
+                args.get("profile") is not None
+                and get_profile_key(args.get("anvil_id") or "main", args["profile"]) != pool.key
+            ):
+                if pool is not None:
+                    self.__drain(pool)
+                pool = WarmPool(name, args)
+                self.__pools[name] = pool
+            else:
+                pool.size = args.get("size", pool.size)
+                if "max_age" in args:
+                    pool.max_age = args["max_age"]
+
+            info = pool.get_info()
+
+        logging.info("warm pool %s configured with %d nodes", name, info["size"])
+        self.__wakeup.set()
+        return info
+
+    def remove(self, name: str) -> bool:
+        with self.__lock:
+            pool = self.__pools.pop(name, None)
+            if pool is None:
+                return False
+            self.__drain(pool)
+        return True
+
+    def get_pools(self) -> Dict[str, WarmPoolArgs]:
+        with self.__lock:
+            return {name: pool.get_info() for name, pool in self.__pools.items()}
+
+    def claim(self, anvil_id: str, args: LaunchAnvilInstanceArgs) -> Optional[str]:
+        key = get_profile_key(anvil_id, args)
+        while True:
+            with self.__lock:
+                pool = next(
+                    (pool for pool in self.__pools.values() if pool.key == key), None
+                )
+                if pool is None:
+                    return None
+                if len(pool.ready) == 0:
+                    pool.stats.misses += 1
+                    return None
+
+                node = pool.ready.popleft()
+
+            # refill right away rather than at the next interval
+            self.__wakeup.set()
+            if self.__is_alive(node.handle):
+                with self.__lock:
+                    pool.stats.hits += 1
+                return node.handle
+
+            with self.__lock:
+                pool.stats.failed += 1
+            self.__destroy_node(node.handle)
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        with self.__lock:
+            stats = {}
+            for name, pool in self.__pools.items():
+                pool.stats.size = pool.size
+                pool.stats.ready = len(pool.ready)
+                pool.stats.starting = pool.starting
+                stats[name] = asdict(pool.stats)
+            return stats
+
+    def __drain(self, pool: WarmPool):
+        # lock held; the nodes are destroyed in the background
+        pool.size = 0
+        nodes, pool.ready = list(pool.ready), deque()
+        for node in nodes:
+            self.__executor.submit(self.__destroy_node, node.handle)
+
+    def __refill_thread(self):
+        while True:
+            self.__wakeup.wait(self.__refill_interval)
+            self.__wakeup.clear()
+
+            try:
+                self.__refill()
+            except Exception as e:
+                logging.error("failed to refill warm pools", exc_info=e)
+
+    def __refill(self):
+        now = time.time()
+        to_create: List[WarmPool] = []
+        to_destroy: List[str] = []
+        with self.__lock:
+            for pool in self.__pools.values():
+                if pool.max_age is not None:
+                    while len(pool.ready) > 0 and now - pool.ready[0].created_at > pool.max_age:
+                        to_destroy.append(pool.ready.popleft().handle)
+                        pool.stats.expired += 1
+
+                while len(pool.ready) > pool.size:
+                    to_destroy.append(pool.ready.pop().handle)
+
+                for _ in range(pool.size - len(pool.ready) - pool.starting):
+                    pool.starting += 1
+                    to_create.append(pool)
+
+        for handle in to_destroy:
+            self.__executor.submit(self.__destroy_node, handle)
+        for pool in to_create:
+            self.__executor.submit(self.__create_node, pool)
+
+    def __create_node(self, pool: WarmPool):
+        try:
+            handle = self.__create(pool)
+        except Exception as e:
+            logging.error("failed to start warm node for pool %s", pool.name, exc_info=e)
+            with self.__lock:
+                pool.starting -= 1
+                pool.stats.failed += 1
+            return
+
+        with self.__lock:
+            pool.starting -= 1
+            pool.stats.created += 1
+            # the pool may have been shrunk or replaced while this one booted
+            keep = self.__pools.get(pool.name) is pool and len(pool.ready) < pool.size
+            if keep:
+                pool.ready.append(WarmNode(handle))
+
+        if not keep:
+            self.__destroy_node(handle)
+
+    def __destroy_node(self, handle: str):
+        try:
+            self.__destroy(handle)
+        except Exception as e:
+            logging.error("failed to destroy warm node %s", handle, exc_info=e)
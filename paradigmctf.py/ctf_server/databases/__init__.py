@@ -1,3 +1,6 @@
 from .database import Database
 from .sqlitedb import SQLiteDatabase
 from .redisdb import RedisDatabase
+from .asyncdatabase import AsyncDatabase
+from .asyncsqlitedb import AsyncSQLiteDatabase
+from .asyncredisdb import AsyncRedisDatabase
@@ -0,0 +1,47 @@
+import abc
+import logging
+from typing import Callable, Dict, List, Optional
+from ctf_server.types import InstanceEvent, InstanceRoute, UserData, get_instance_route
+
+
+class AsyncDatabase(abc.ABC):
+    # read-only, for the proxy; instances are only changed through Database
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.__listeners: List[Callable[[InstanceEvent], None]] = []
+
+    @abc.abstractmethod
+    async def get_instance(self, instance_id: str) -> Optional[UserData]:
+        pass
+
+    @abc.abstractmethod
+    async def get_instance_by_external_id(self, external_id: str) -> Optional[UserData]:
+        pass
+
+    async def get_route_by_external_id(self, external_id: str) -> Optional[InstanceRoute]:
+        instance = await self.get_instance_by_external_id(external_id)
+        if instance is None:
+            return None
+
+        return get_instance_route(instance)
+
+    async def get_expired_instances(self) -> List[UserData]:
+        pass
+
+    async def get_metadata(self, instance_id: str) -> Optional[Dict[str, str]]:
+        pass
+
+    async def close(self):
+        pass
+
+    # listeners are always invoked on the event loop that subscribed them
+    def subscribe_instance_events(self, listener: Callable[[InstanceEvent], None]):
+        self.__listeners.append(listener)
+
+    def _dispatch_instance_event(self, event: InstanceEvent):
+        for listener in list(self.__listeners):
+            try:
+                listener(event)
+            except Exception as e:
+                logging.error("failed to dispatch instance event %s", event, exc_info=e)
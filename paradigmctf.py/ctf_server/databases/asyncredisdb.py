@@ -0,0 +1,89 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import redis.asyncio
+from ctf_server.types import InstanceEvent, InstanceRoute, UserData
+
+from .asyncdatabase import AsyncDatabase
+from .redisdb import INSTANCE_EVENTS_CHANNEL
+
+
+class AsyncRedisDatabase(AsyncDatabase):
+    def __init__(self, url: str, redis_kwargs: Dict[str, Any] = {}) -> None:
+        super().__init__()
+
+        self.__client: redis.asyncio.Redis = redis.asyncio.Redis.from_url(
+            url,
+            decode_responses=True,
+            **redis_kwargs,
+        )
+        self.__pubsub_task: Optional[asyncio.Task] = None
+
+    async def get_instance(self, instance_id: str) -> Optional[UserData]:
+        pipeline = self.__client.pipeline(transaction=False)
+        pipeline.json().get(f"instance/{instance_id}")
+        pipeline.hgetall(f"metadata/{instance_id}")
+        instance, metadata = await pipeline.execute()
+        if instance is None:
+            return None
+
+        instance["metadata"] = metadata if metadata is not None else {}
+        return instance
+
+    async def get_instance_by_external_id(self, external_id: str) -> Optional[UserData]:
+        instance_id = await self.__client.hget("external_ids", external_id)
+        if instance_id is None:
+            return None
+
+        return await self.get_instance(instance_id)
+
+    async def get_route_by_external_id(self, external_id: str) -> Optional[InstanceRoute]:
+        route = await self.__client.hget("routes", external_id)
+        if route is None:
+            # instances registered before routes were tracked
+            return await super().get_route_by_external_id(external_id)
+
+        return json.loads(route)
+
+    async def get_expired_instances(self) -> List[UserData]:
+        instance_ids = await self.__client.zrange(
+            "expiries", 0, int(time.time()), byscore=True
+        )
+
+        instances = []
+        for instance_id in instance_ids:
+            instances.append(await self.get_instance(instance_id))
+
+        return instances
+
+    async def close(self):
+        if self.__pubsub_task is not None:
+            self.__pubsub_task.cancel()
+
+        await self.__client.aclose()
+
+    def subscribe_instance_events(self, listener: Callable[[InstanceEvent], None]):
+        super().subscribe_instance_events(listener)
+
+        if self.__pubsub_task is not None:
+            return
+
+        self.__pubsub_task = asyncio.create_task(self.__run_pubsub())
+
+    async def __run_pubsub(self):
+        pubsub = self.__client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(**{INSTANCE_EVENTS_CHANNEL: self.__on_message})
+        await pubsub.run(exception_handler=self.__on_pubsub_error)
+
+    async def __on_message(self, message: Dict[str, Any]):
+        self._dispatch_instance_event(json.loads(message["data"]))
+
+    async def __on_pubsub_error(self, e: Exception, pubsub: redis.asyncio.client.PubSub):
+        logging.error("instance event subscription failed", exc_info=e)
+
+        # anything published while we were disconnected is lost
+        self._dispatch_instance_event(InstanceEvent(type="resync"))
+        await asyncio.sleep(1)
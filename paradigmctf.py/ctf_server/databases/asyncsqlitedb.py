@@ -0,0 +1,51 @@
+import asyncio
+from typing import Callable, Dict, List, Optional
+
+from ctf_server.types import InstanceEvent, InstanceRoute, UserData
+
+from .asyncdatabase import AsyncDatabase
+from .sqlitedb import SQLiteDatabase
+
+
+class AsyncSQLiteDatabase(AsyncDatabase):
+    def __init__(self, db_path: str):
+        super().__init__()
+
+        self.__database = SQLiteDatabase(db_path)
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def get_all_instances(self) -> List[UserData]:
+        return await asyncio.to_thread(self.__database.get_all_instances)
+
+    async def get_instance(self, instance_id: str) -> Optional[UserData]:
+        return await asyncio.to_thread(self.__database.get_instance, instance_id)
+
+    async def get_instance_by_external_id(self, external_id: str) -> Optional[UserData]:
+        return await asyncio.to_thread(
+            self.__database.get_instance_by_external_id, external_id
+        )
+
+    async def get_route_by_external_id(self, external_id: str) -> Optional[InstanceRoute]:
+        return await asyncio.to_thread(
+            self.__database.get_route_by_external_id, external_id
+        )
+
+    async def get_expired_instances(self) -> List[UserData]:
+        return await asyncio.to_thread(self.__database.get_expired_instances)
+
+    async def get_metadata(self, instance_id: str) -> Optional[Dict[str, str]]:
+        return await asyncio.to_thread(self.__database.get_metadata, instance_id)
+
+    def subscribe_instance_events(self, listener: Callable[[InstanceEvent], None]):
+        super().subscribe_instance_events(listener)
+
+        if self.__loop is not None:
+            return
+
+        # the sync database publishes from whichever worker thread made the change
+        self.__loop = asyncio.get_running_loop()
+        self.__database.subscribe_instance_events(
+            lambda event: self.__loop.call_soon_threadsafe(
+                self._dispatch_instance_event, event
+            )
+        )
@@ -1,32 +1,110 @@
 import abc
-from typing import Dict, List, Optional
-from ctf_server.types import UserData
+import logging
+from typing import Callable, Dict, List, Optional
+from ctf_server.types import InstanceEvent, InstanceRoute, UserData, get_instance_route
+
+
+def instance_lock_name(instance_id: str) -> str:
+    return f"instance/{instance_id}"
+
+
+class StaleLockError(Exception):
+    # a write carried the fencing token of a lock that has since moved on
+    pass
+
 
 class Database(abc.ABC):
     def __init__(self) -> None:
         super().__init__()
 
+        self.__listeners: List[Callable[[InstanceEvent], None]] = []
+
+    # writes that take a fencing token only go through while the instance's
+    # lock still has that token, and raise StaleLockError otherwise
+
     @abc.abstractmethod
-    def register_instance(self, instance_id: str, instance: UserData):
+    def register_instance(
+        self, instance_id: str, instance: UserData, fencing_token: Optional[int] = None
+    ):
         pass
 
     @abc.abstractmethod
-    def unregister_instance(self, instance_id: str) -> UserData:
+    def unregister_instance(
+        self, instance_id: str, fencing_token: Optional[int] = None
+    ) -> UserData:
+        # the instance is kept as a pending deletion until finish_deletion, so
+        # its resources aren't forgotten if the process dies before they're gone
+        pass
+
+    def get_pending_deletions(self) -> List[UserData]:
+        pass
+
+    def get_pending_deletion(self, instance_id: str) -> Optional[UserData]:
+        pass
+
+    def finish_deletion(self, instance_id: str, fencing_token: Optional[int] = None):
         pass
 
     @abc.abstractmethod
     def get_instance(self, instance_id: str) -> Optional[UserData]:
         pass
-    
+
     @abc.abstractmethod
     def get_instance_by_external_id(self, external_id: str) -> Optional[UserData]:
         pass
 
+    def update_instance(self, instance_id: str, instance: UserData):
+        pass
+
+    def get_route_by_external_id(self, external_id: str) -> Optional[InstanceRoute]:
+        instance = self.get_instance_by_external_id(external_id)
+        if instance is None:
+            return None
+
+        return get_instance_route(instance)
+
+    def get_all_instances(self) -> List[UserData]:
+        pass
+
+    def get_all_routes(self) -> Dict[str, InstanceRoute]:
+        return {
+            instance["external_id"]: get_instance_route(instance)
+            for instance in self.get_all_instances()
+        }
+
     def get_expired_instances(self) -> List[UserData]:
         pass
 
+    def get_expiries(self) -> Dict[str, float]:
+        # instance_id -> expires_at for every instance
+        pass
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> Optional[int]:
+        # takes or renews a lease that expires unless renewed within ttl seconds;
+        # returns its fencing token, which increases every time the lease
+        # changes hands, or None if someone else holds it
+        pass
+
+    def release_lease(self, name: str, holder: str):
+        pass
+
     def get_metadata(self, instance_id: str) -> Optional[Dict[str, str]]:
         pass
 
-    def update_metadata(self, instance_id: str, metadata: Dict[str, str]):
+    def update_metadata(
+        self, instance_id: str, metadata: Dict[str, str], fencing_token: Optional[int] = None
+    ):
         pass
+
+    def subscribe_instance_events(self, listener: Callable[[InstanceEvent], None]):
+        self.__listeners.append(listener)
+
+    def _publish_instance_event(self, event: InstanceEvent):
+        self._dispatch_instance_event(event)
+
+    def _dispatch_instance_event(self, event: InstanceEvent):
+        for listener in list(self.__listeners):
+            try:
+                listener(event)
+            except Exception as e:
+                logging.error("failed to dispatch instance event %s", event, exc_info=e)
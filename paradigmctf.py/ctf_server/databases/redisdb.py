@@ -1,11 +1,40 @@
 import json
+import logging
 import time
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
 import redis
-from ctf_server.types import UserData
+from ctf_server.types import InstanceEvent, InstanceRoute, UserData, get_instance_route
 
-from .database import Database
+from .database import Database, StaleLockError, instance_lock_name
+
+INSTANCE_EVENTS_CHANNEL = "instance_events"
+
+# KEYS: lease, token counter; ARGV: holder, ttl in ms
+ACQUIRE_LEASE_SCRIPT = """
+local holder = redis.call('HGET', KEYS[1], 'holder')
+if holder and holder ~= ARGV[1] then
+    return false
+end
+
+local token
+if holder then
+    token = redis.call('HGET', KEYS[1], 'token')
+else
+    token = redis.call('INCR', KEYS[2])
+    redis.call('HSET', KEYS[1], 'holder', ARGV[1], 'token', token)
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return token
+"""
+
+# KEYS: lease; ARGV: holder
+RELEASE_LEASE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'holder') == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 
 class RedisDatabase(Database):
@@ -17,41 +46,89 @@ class RedisDatabase(Database):
             decode_responses=True,
             **redis_kwargs,
         )
+        self.__pubsub: Optional[redis.client.PubSub] = None
+        self.__acquire_lease = self.__client.register_script(ACQUIRE_LEASE_SCRIPT)
+        self.__release_lease = self.__client.register_script(RELEASE_LEASE_SCRIPT)
 
-    def register_instance(self, instance_id: str, instance: UserData):
-        pipeline = self.__client.pipeline()
-
-        try:
+    def register_instance(
+        self, instance_id: str, instance: UserData, fencing_token: Optional[int] = None
+    ):
+        def write(pipeline: redis.client.Pipeline):
             pipeline.json().set(f"instance/{instance['instance_id']}", "$", instance)
             pipeline.hset(
                 "external_ids", instance["external_id"], instance["instance_id"]
             )
+            pipeline.hset(
+                "routes",
+                instance["external_id"],
+                json.dumps(get_instance_route(instance)),
+            )
             pipeline.zadd(
                 "expiries",
                 {
                     instance["instance_id"]: int(instance["expires_at"]),
                 },
             )
+
+        self.__write(instance_id, fencing_token, write)
+
+        self._publish_instance_event(
+            InstanceEvent(
+                type="register",
+                instance_id=instance["instance_id"],
+                external_id=instance["external_id"],
+                expires_at=instance["expires_at"],
+            )
+        )
+
+    def update_instance(self, instance_id: str, instance: UserData):
+        pipeline = self.__client.pipeline()
+        try:
+            pipeline.json().set(f"instance/{instance_id}", "$", instance)
+            pipeline.hset(
+                "routes",
+                instance["external_id"],
+                json.dumps(get_instance_route(instance)),
+            )
+            pipeline.zadd("expiries", {instance_id: int(instance["expires_at"])})
         finally:
             pipeline.execute()
 
-    def update_instance(self, instance_id: str, instance: UserData):
-        raise Exception("not supported")
+        # the route changed, listeners reload it as if freshly registered
+        self._publish_instance_event(
+            InstanceEvent(
+                type="register",
+                instance_id=instance_id,
+                external_id=instance["external_id"],
+                expires_at=instance["expires_at"],
+            )
+        )
 
-    def unregister_instance(self, instance_id: str) -> UserData:
+    def unregister_instance(
+        self, instance_id: str, fencing_token: Optional[int] = None
+    ) -> UserData:
         instance = self.__client.json().get(f"instance/{instance_id}")
         if instance is None:
             return None
 
-        pipeline = self.__client.pipeline()
-        try:
+        def write(pipeline: redis.client.Pipeline):
             pipeline.json().delete(f"instance/{instance_id}")
             pipeline.hdel("external_ids", instance["external_id"])
+            pipeline.hdel("routes", instance["external_id"])
             pipeline.zrem("expiries", instance_id)
             pipeline.delete(f"metadata/{instance_id}")
-            return instance
-        finally:
-            pipeline.execute()
+            pipeline.hset("deletions", instance_id, json.dumps(instance))
+
+        self.__write(instance_id, fencing_token, write)
+
+        self._publish_instance_event(
+            InstanceEvent(
+                type="unregister",
+                instance_id=instance_id,
+                external_id=instance["external_id"],
+            )
+        )
+        return instance
 
     def get_instance(self, instance_id: str) -> Optional[UserData]:
         instance: Optional[UserData] = self.__client.json().get(f"instance/{instance_id}")
@@ -73,6 +150,14 @@ class RedisDatabase(Database):
 
         return self.get_instance(instance_id)
 
+    def get_route_by_external_id(self, external_id: str) -> Optional[InstanceRoute]:
+        route = self.__client.hget("routes", external_id)
+        if route is None:
+            # instances registered before routes were tracked
+            return super().get_route_by_external_id(external_id)
+
+        return json.loads(route)
+
     def get_all_instances(self) -> List[UserData]:
         keys = self.__client.keys("instance/*")
 
@@ -93,10 +178,94 @@ class RedisDatabase(Database):
 
         return instances
 
-    def update_metadata(self, instance_id: str, metadata: Dict[str, str]):
-        pipeline = self.__client.pipeline()
-        try:
+    def get_expiries(self) -> Dict[str, float]:
+        return dict(self.__client.zrange("expiries", 0, -1, withscores=True))
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> Optional[int]:
+        token = self.__acquire_lease(
+            keys=[f"lease/{name}", f"lease_token/{name}"], args=[holder, int(ttl * 1000)]
+        )
+        return int(token) if token is not None else None
+
+    def release_lease(self, name: str, holder: str):
+        self.__release_lease(keys=[f"lease/{name}"], args=[holder])
+
+    def get_pending_deletions(self) -> List[UserData]:
+        return [json.loads(instance) for instance in self.__client.hvals("deletions")]
+
+    def get_pending_deletion(self, instance_id: str) -> Optional[UserData]:
+        instance = self.__client.hget("deletions", instance_id)
+        if instance is None:
+            return None
+
+        return json.loads(instance)
+
+    def finish_deletion(self, instance_id: str, fencing_token: Optional[int] = None):
+        def write(pipeline: redis.client.Pipeline):
+            pipeline.hdel("deletions", instance_id)
+
+        self.__write(instance_id, fencing_token, write)
+
+    def update_metadata(
+        self, instance_id: str, metadata: Dict[str, str], fencing_token: Optional[int] = None
+    ):
+        def write(pipeline: redis.client.Pipeline):
             for k, v in metadata.items():
                 pipeline.hset(f"metadata/{instance_id}", k, v)
-        finally:
-            pipeline.execute()
+
+        self.__write(instance_id, fencing_token, write)
+
+    def __write(
+        self,
+        instance_id: str,
+        fencing_token: Optional[int],
+        write: Callable[[redis.client.Pipeline], None],
+    ):
+        if fencing_token is None:
+            pipeline = self.__client.pipeline()
+            try:
+                write(pipeline)
+            finally:
+                pipeline.execute()
+            return
+
+        # the lease is watched, so the write fails if it changes hands before
+        # the transaction runs
+        lease = f"lease/{instance_lock_name(instance_id)}"
+
+        def transaction(pipeline: redis.client.Pipeline):
+            token = pipeline.hget(lease, "token")
+            if token is None or int(token) != fencing_token:
+                raise StaleLockError(f"lock on {instance_id} was lost")
+
+            pipeline.multi()
+            write(pipeline)
+
+        self.__client.transaction(transaction, lease)
+
+    def subscribe_instance_events(self, listener: Callable[[InstanceEvent], None]):
+        super().subscribe_instance_events(listener)
+
+        if self.__pubsub is not None:
+            return
+
+        self.__pubsub = self.__client.pubsub(ignore_subscribe_messages=True)
+        self.__pubsub.subscribe(**{INSTANCE_EVENTS_CHANNEL: self.__on_message})
+        self.__pubsub.run_in_thread(
+            sleep_time=1,
+            daemon=True,
+            exception_handler=self.__on_pubsub_error,
+        )
+
+    def _publish_instance_event(self, event: InstanceEvent):
+        self.__client.publish(INSTANCE_EVENTS_CHANNEL, json.dumps(event))
+
+    def __on_message(self, message: Dict[str, Any]):
+        self._dispatch_instance_event(json.loads(message["data"]))
+
+    def __on_pubsub_error(self, e: Exception, pubsub: redis.client.PubSub, thread):
+        logging.error("instance event subscription failed", exc_info=e)
+
+        # anything published while we were disconnected is lost
+        self._dispatch_instance_event(InstanceEvent(type="resync"))
+        time.sleep(1)
@@ -1,8 +1,10 @@
 import json
 import sqlite3
-from typing import List, Optional
-from ctf_server.databases import Database
-from ctf_server.types import InstanceInfo
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+from ctf_server.databases.database import Database, StaleLockError, instance_lock_name
+from ctf_server.types import InstanceEvent, InstanceInfo
 from threading import Lock
 
 
@@ -21,62 +23,233 @@ CREATE TABLE IF NOT EXISTS anvil_instances
     instance_data JSON
 );"""
         )
+        self.__conn.execute(
+            """
+CREATE TABLE IF NOT EXISTS leases
+(
+    name VARCHAR PRIMARY KEY,
+    holder VARCHAR,
+    token INTEGER,
+    expires_at REAL
+);"""
+        )
+        self.__conn.execute(
+            """
+CREATE TABLE IF NOT EXISTS deletions
+(
+    instance_id VARCHAR PRIMARY KEY,
+    instance_data JSON
+);"""
+        )
+
+    def register_instance(
+        self, instance_id: str, instance: InstanceInfo, fencing_token: Optional[int] = None
+    ):
+        with self.__transaction() as cursor:
+            self.__check_fence(cursor, instance_id, fencing_token)
+            cursor.execute(
+                """INSERT INTO anvil_instances(instance_id, rpc_id, instance_data) VALUES (?, ?, ?)""",
+                (instance_id, instance["external_id"], json.dumps(instance)),
+            )
+
+        self._publish_instance_event(
+            InstanceEvent(
+                type="register",
+                instance_id=instance_id,
+                external_id=instance["external_id"],
+                expires_at=instance["expires_at"],
+            )
+        )
+
+    def update_instance(self, instance_id: str, instance: InstanceInfo):
+        with self.__transaction() as cursor:
+            cursor.execute(
+                """UPDATE anvil_instances SET instance_data = ? WHERE instance_id = ?""",
+                (json.dumps(instance), instance_id),
+            )
+
+        # the route changed, listeners reload it as if freshly registered
+        self._publish_instance_event(
+            InstanceEvent(
+                type="register",
+                instance_id=instance_id,
+                external_id=instance["external_id"],
+                expires_at=instance["expires_at"],
+            )
+        )
+
+    def unregister_instance(
+        self, instance_id: str, fencing_token: Optional[int] = None
+    ) -> InstanceInfo:
+        with self.__transaction() as cursor:
+            self.__check_fence(cursor, instance_id, fencing_token)
+            cursor.execute(
+                """DELETE FROM anvil_instances WHERE instance_id = ? RETURNING instance_data""", (instance_id,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+
+            cursor.execute(
+                """INSERT OR REPLACE INTO deletions(instance_id, instance_data) VALUES (?, ?)""",
+                (instance_id, row[0]),
+            )
+            instance = json.loads(row[0])
+
+        self._publish_instance_event(
+            InstanceEvent(
+                type="unregister",
+                instance_id=instance_id,
+                external_id=instance["external_id"],
+            )
+        )
+        return instance
 
-    def register_instance(self, instance_id: str, instance: InstanceInfo):
+    def get_all_instances(self) -> List[InstanceInfo]:
         self.__conn_lock.acquire()
         try:
             cursor = self.__conn.execute(
-                """INSERT INTO anvil_instances(instance_id, instance_data) VALUES (?, ?)""",
-                (instance_id, json.dumps(instance)),
+                """SELECT instance_data FROM anvil_instances"""
             )
+            result = []
+            while True:
+                row = cursor.fetchone()
+                if row is None:
+                    break
+
+                result.append(json.loads(row[0]))
+            return result
         finally:
             cursor.close()
             self.__conn_lock.release()
+    
+    def update_metadata(
+        self, instance_id: str, metadata: Dict[str, str], fencing_token: Optional[int] = None
+    ):
+        with self.__transaction() as cursor:
+            self.__check_fence(cursor, instance_id, fencing_token)
+            cursor.execute(
+                """UPDATE anvil_instances SET instance_data = json_patch(instance_data, json_object('metadata', json(?))) WHERE instance_id = ?""",
+                (json.dumps(metadata), instance_id),
+            )
+            if cursor.rowcount == 0:
+                raise KeyError(instance_id)
 
-    def update_instance(self, instance_id: str, instance: InstanceInfo):
+    def get_pending_deletions(self) -> List[InstanceInfo]:
         self.__conn_lock.acquire()
         try:
-            cursor = self.__conn.execute(
-                """UPDATE anvil_instances SET instance_data = ? WHERE instance_id = ?""",
-                (json.dumps(instance), instance_id),
-            )
+            cursor = self.__conn.execute("""SELECT instance_data FROM deletions""")
+            return [json.loads(row[0]) for row in cursor.fetchall()]
         finally:
             cursor.close()
             self.__conn_lock.release()
 
-    def unregister_instance(self, instance_id: str) -> InstanceInfo:
+    def get_pending_deletion(self, instance_id: str) -> InstanceInfo | None:
         self.__conn_lock.acquire()
         try:
             cursor = self.__conn.execute(
-                """DELETE FROM anvil_instances WHERE instance_id = ? RETURNING instance_data""", (instance_id,)
+                """SELECT instance_data FROM deletions WHERE instance_id = ?""", (instance_id,)
             )
             row = cursor.fetchone()
             if row is None:
                 return None
-            
+
             return json.loads(row[0])
         finally:
             cursor.close()
             self.__conn_lock.release()
 
-    def get_all_instances(self) -> List[InstanceInfo]:
+    def finish_deletion(self, instance_id: str, fencing_token: Optional[int] = None):
+        with self.__transaction() as cursor:
+            self.__check_fence(cursor, instance_id, fencing_token)
+            cursor.execute("""DELETE FROM deletions WHERE instance_id = ?""", (instance_id,))
+
+    def get_expired_instances(self) -> List[InstanceInfo]:
         self.__conn_lock.acquire()
         try:
             cursor = self.__conn.execute(
-                """SELECT instance_data FROM anvil_instances"""
+                """SELECT instance_data FROM anvil_instances WHERE json_extract(instance_data, '$.expires_at') <= ?""",
+                (time.time(),),
             )
-            result = []
-            while True:
-                row = cursor.fetchone()
-                if row is None:
-                    break
+            return [json.loads(row[0]) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
 
-                result.append(json.loads(row[0]))
-            return result
+    def get_expiries(self) -> Dict[str, float]:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                """SELECT instance_id, json_extract(instance_data, '$.expires_at') FROM anvil_instances"""
+            )
+            return dict(cursor.fetchall())
         finally:
             cursor.close()
             self.__conn_lock.release()
-    
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> Optional[int]:
+        with self.__transaction() as cursor:
+            now = time.time()
+            cursor.execute(
+                """SELECT holder, token, expires_at FROM leases WHERE name = ?""", (name,)
+            )
+            row = cursor.fetchone()
+            if row is not None and row[0] != holder and row[2] > now:
+                return None
+
+            # a new holder gets a new token, a renewal keeps its own
+            if row is None:
+                token = 1
+            elif row[0] == holder and row[2] > now:
+                token = row[1]
+            else:
+                token = row[1] + 1
+            cursor.execute(
+                """INSERT OR REPLACE INTO leases(name, holder, token, expires_at) VALUES (?, ?, ?, ?)""",
+                (name, holder, token, now + ttl),
+            )
+            return token
+
+    def __check_fence(
+        self, cursor: sqlite3.Cursor, instance_id: str, fencing_token: Optional[int]
+    ):
+        # in a transaction, so the lease can't change until the write is done
+        if fencing_token is None:
+            return
+
+        row = cursor.execute(
+            """SELECT token, expires_at FROM leases WHERE name = ?""",
+            (instance_lock_name(instance_id),),
+        ).fetchone()
+
+        if row is None or row[0] != fencing_token or row[1] <= time.time():
+            raise StaleLockError(f"lock on {instance_id} was lost")
+
+    def release_lease(self, name: str, holder: str):
+        with self.__transaction() as cursor:
+            cursor.execute(
+                """UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?""", (name, holder)
+            )
+
+    @contextmanager
+    def __transaction(self) -> Iterator[sqlite3.Cursor]:
+        # writes are committed right away so other connections, like another
+        # replica's, see them; BEGIN IMMEDIATE takes the database's write lock
+        # up front, so a lease or fencing token checked first can't change
+        # before the write that depends on it
+        self.__conn_lock.acquire()
+        cursor = self.__conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            yield cursor
+            self.__conn.commit()
+        except:
+            self.__conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
     def get_instance_by_external_id(self, rpc_id: str) -> InstanceInfo | None:
         self.__conn_lock.acquire()
         try:
@@ -107,3 +280,10 @@ CREATE TABLE IF NOT EXISTS anvil_instances
             cursor.close()
             self.__conn_lock.release()
         
+
+    def get_metadata(self, instance_id: str) -> Optional[Dict[str, str]]:
+        instance = self.get_instance(instance_id)
+        if instance is None:
+            return None
+
+        return instance.get("metadata", {})
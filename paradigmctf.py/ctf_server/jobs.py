@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .admission import DEFAULT_PRIORITY, Admission, AdmissionController
+from .backends.backend import Backend, InstanceExists
+from .types import CreateInstanceRequest, JobEvent, LaunchJobInfo, UserData
+
+FINISHED = {"succeeded", "failed"}
+
+
+class LaunchQueueFull(Exception):
+    pass
+
+
+class LaunchJob:
+    # A launch running on a worker thread. Progress is recorded as a list of
+    # events that waiters on the event loop can follow by index.
+    def __init__(self, instance_id: str):
+        self.id = secrets.token_hex(16)
+        self.instance_id = instance_id
+        self.status = "queued"
+        self.result: Optional[UserData] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        # place in the admission queue while waiting for capacity
+        self.get_position: Callable[[], Optional[int]] = lambda: None
+
+        self.__events: List[JobEvent] = []
+        self.__lock = threading.Lock()
+        # futures of async waiters, resolved from whichever thread records an event
+        self.__waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+        self.record("queued")
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED
+
+    def record(self, phase: str, detail: Optional[str] = None):
+        with self.__lock:
+            if phase in FINISHED:
+                self.status = phase
+            elif phase != "queued":
+                self.status = "running"
+            self.__events.append(JobEvent(phase=phase, detail=detail, time=time.time()))
+            waiters, self.__waiters = self.__waiters, []
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.__wake, future)
+
+    def finish(self, result: Optional[UserData] = None, error: Optional[str] = None):
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self.record("failed" if error is not None else "succeeded")
+
+    def events(self, after: int = 0) -> List[JobEvent]:
+        with self.__lock:
+            return self.__events[after:]
+
+    async def wait(self, after: int, timeout: float) -> List[JobEvent]:
+        # returns the events past the first `after`, waiting for at least one
+        # unless the timeout passes first
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self.__lock:
+                if len(self.__events) > after or loop.time() >= deadline:
+                    return self.__events[after:]
+                future = loop.create_future()
+                self.__waiters.append((loop, future))
+
+            try:
+                await asyncio.wait_for(future, deadline - loop.time())
+            except asyncio.TimeoutError:
+                with self.__lock:
+                    if (loop, future) in self.__waiters:
+                        self.__waiters.remove((loop, future))
+
+    def get_info(self, after: int = 0) -> LaunchJobInfo:
+        events = self.events()
+        info = LaunchJobInfo(
+            job_id=self.id,
+            instance_id=self.instance_id,
+            status=self.status,
+            phase=events[-1]["phase"],
+            events=events[after:],
+            created_at=self.created_at,
+            finished_at=self.finished_at,
+        )
+        position = self.get_position() if self.status == "queued" else None
+        if position is not None:
+            info["position"] = position
+        if self.result is not None:
+            info["data"] = self.result
+        if self.error is not None:
+            info["message"] = self.error
+        return info
+
+    @staticmethod
+    def __wake(future: asyncio.Future):
+        if not future.done():
+            future.set_result(None)
+
+
+@dataclass
+class LaunchJobStats:
+    submitted: int = 0
+    coalesced: int = 0
+    rejected: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    pending: int = 0
+
+
+class LaunchJobs:
+    # Runs launches on a fixed pool of worker threads so a burst of players
+    # can't pile up unbounded docker or kubernetes calls. Launches only reach a
+    # worker once admission control lets them, which never admits more than
+    # there are workers. A second submission for an instance that is still
+    # launching joins the existing job.
+    def __init__(
+        self,
+        backend: Backend,
+        admission: AdmissionController,
+        workers: int = 8,
+        max_queue: int = 256,
+        retention: float = 600,
+    ):
+        self.__backend = backend
+        self.__admission = admission
+        self.__max_pending = workers + max_queue
+        # finished jobs stay around this long so clients can read the result
+        self.__retention = retention
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="launch"
+        )
+
+        self.__lock = threading.Lock()
+        self.__jobs: Dict[str, LaunchJob] = {}
+        self.__launching: Dict[str, LaunchJob] = {}
+        self.__stats = LaunchJobStats()
+
+    def submit(
+        self,
+        args: CreateInstanceRequest,
+        team_id: Optional[str] = None,
+        priority: int = DEFAULT_PRIORITY,
+    ) -> Tuple[LaunchJob, bool]:
+        # returns the job and whether it was newly created; raises QuotaExceeded
+        # if the team already has as many instances as it may
+        with self.__lock:
+            self.__prune()
+
+            job = self.__launching.get(args["instance_id"])
+            if job is not None:
+                self.__stats.coalesced += 1
+                return job, False
+
+            if len(self.__launching) >= self.__max_pending:
+                self.__stats.rejected += 1
+                raise LaunchQueueFull()
+
+            job = LaunchJob(args["instance_id"])
+            admission = self.__admission.request(
+                args, team_id, priority, partial(self.__start, job, args)
+            )
+            job.get_position = partial(self.__admission.position, admission)
+            self.__jobs[job.id] = job
+            self.__launching[job.instance_id] = job
+            self.__stats.submitted += 1
+
+        return job, True
+
+    def get(self, job_id: str) -> Optional[LaunchJob]:
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.__lock:
+            self.__stats.pending = len(self.__launching)
+            return asdict(self.__stats)
+
+    def __start(self, job: LaunchJob, args: CreateInstanceRequest, admission: Admission):
+        self.__executor.submit(self.__run, job, args, admission)
+
+    def __run(self, job: LaunchJob, args: CreateInstanceRequest, admission: Admission):
+        logging.info("launching new instance: %s", job.instance_id)
+
+        result, error = None, None
+        try:
+            result = self.__backend.launch_instance(args, job.record)
+            logging.info("launched new instance: %s", job.instance_id)
+        except InstanceExists:
+            logging.warning("instance already exists: %s", job.instance_id)
+            error = "instance already exists"
+        except Exception as e:
+            logging.error("failed to launch instance: %s", job.instance_id, exc_info=e)
+            error = "an internal error occurred"
+        finally:
+            # frees the worker and, if the launch failed, its capacity
+            self.__admission.finish(admission, launched=error is None)
+
+        with self.__lock:
+            self.__launching.pop(job.instance_id, None)
+            if error is None:
+                self.__stats.succeeded += 1
+            else:
+                self.__stats.failed += 1
+
+        job.finish(result, error)
+
+    def __prune(self):
+        cutoff = time.time() - self.__retention
+        for job_id in [
+            job_id
+            for job_id, job in self.__jobs.items()
+            if job.finished and job.finished_at < cutoff
+        ]:
+            del self.__jobs[job_id]
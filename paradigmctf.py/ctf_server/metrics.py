@@ -0,0 +1,237 @@
+import abc
+import bisect
+import math
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+Labels = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+OTHER = "other"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+
+    return (
+        "{"
+        + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+        + "}"
+    )
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class BoundedLabel:
+    # caps the distinct values of a label so player-controlled input such as
+    # method names can't blow up the number of series
+    def __init__(self, max_values: int):
+        self.__max_values = max_values
+        self.__values: Dict[str, str] = {}
+
+    def __call__(self, value: str) -> str:
+        known = self.__values.get(value)
+        if known is not None:
+            return known
+
+        if len(self.__values) >= self.__max_values:
+            return OTHER
+
+        self.__values[value] = value
+        return value
+
+
+class Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[Tuple[str, Sequence[str], Sequence[str], float]]:
+        pass
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{format_labels(names, values)} {format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], Dict[Labels, float]]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+
+        # when set, the values are collected at scrape time instead
+        self.__function = function
+        self.__values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        # everything runs on the event loop, so plain dict updates are safe
+        self.__values[labels] = self.__values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self.__values.get(labels, 0)
+
+    def samples(self):
+        values = self.__function() if self.__function is not None else self.__values
+        for labels, value in list(values.items()):
+            yield "_total", self.labelnames, labels, value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], Dict[Labels, float]]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+
+        # when set, the values are collected at scrape time instead
+        self.__function = function
+        self.__values: Dict[Labels, float] = {}
+
+    def set(self, value: float, *labels: str):
+        self.__values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.__values[labels] = self.__values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def get(self, *labels: str) -> float:
+        return self.__values.get(labels, 0)
+
+    def samples(self):
+        values = self.__function() if self.__function is not None else self.__values
+        for labels, value in list(values.items()):
+            yield "", self.labelnames, labels, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+
+        self.__buckets = tuple(sorted(buckets))
+        # labels -> per-bucket counts (not cumulative, plus +Inf), sum
+        self.__values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self.__values.get(labels)
+        if entry is None:
+            entry = ([0] * (len(self.__buckets) + 1), [0.0])
+            self.__values[labels] = entry
+
+        entry[0][bisect.bisect_left(self.__buckets, value)] += 1
+        entry[1][0] += value
+
+    def samples(self):
+        bucket_names = self.labelnames + ("le",)
+        for labels, (counts, total) in list(self.__values.items()):
+            cumulative = 0
+            for bound, count in zip(self.__buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", bucket_names, labels + (format_value(bound),), cumulative
+            yield "_sum", self.labelnames, labels, total[0]
+            yield "_count", self.labelnames, labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.__metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.__metrics:
+            raise ValueError(f"duplicate metric {metric.name}")
+
+        self.__metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], Dict[Labels, float]]] = None,
+    ) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, function))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], Dict[Labels, float]]] = None,
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.__metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
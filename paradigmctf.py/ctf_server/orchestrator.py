@@ -1,59 +1,247 @@
+import json
 import logging
+import os
+import secrets
 import sys
 import traceback
 from contextlib import asynccontextmanager
-from typing import Dict
+from typing import AsyncIterator, Dict, Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Response
+from fastapi.responses import StreamingResponse
 
-from .backends.backend import InstanceExists
-from .types import CreateInstanceRequest
+from .admission import (
+    DEFAULT_PRIORITY,
+    HEALTHCHECK_PRIORITY,
+    AdmissionController,
+    Cost,
+    QuotaExceeded,
+)
+from .backends.locks import LockTimeout
+from .jobs import LaunchJob, LaunchJobs, LaunchQueueFull
+from .metrics import CONTENT_TYPE, Registry
+from .types import CreateInstanceRequest, WarmPoolArgs
 from .utils import load_backend, load_database
 
+# launches running at once, and launches allowed to wait for a worker
+LAUNCH_WORKERS = int(os.getenv("LAUNCH_WORKERS", "8"))
+LAUNCH_QUEUE_SIZE = int(os.getenv("LAUNCH_QUEUE_SIZE", "256"))
+# how long finished jobs can still be looked up
+LAUNCH_JOB_RETENTION = float(os.getenv("LAUNCH_JOB_RETENTION", "600"))
+
+# upper bound on a single long-poll, and the keepalive interval of event streams
+MAX_POLL_TIMEOUT = 60
+EVENT_STREAM_KEEPALIVE = 15
+
+# pre-booted nodes per launch profile, as json mapping a pool name to its
+# WarmPoolArgs; pools can also be changed at runtime through /warm-pools
+WARM_POOLS = json.loads(os.getenv("WARM_POOLS", "{}"))
+
+# what each node and daemon is expected to use, in cpus and MiB of memory
+ANVIL_COST = Cost(
+    cpu=float(os.getenv("ANVIL_CPU", "0.5")),
+    memory=float(os.getenv("ANVIL_MEMORY", "512")),
+)
+DAEMON_COST = Cost(
+    cpu=float(os.getenv("DAEMON_CPU", "0.25")),
+    memory=float(os.getenv("DAEMON_MEMORY", "256")),
+)
+# what the docker host or cluster can run; launches past it wait their turn,
+# and an unset budget is unlimited
+CAPACITY_CPU = float(os.environ["CAPACITY_CPU"]) if "CAPACITY_CPU" in os.environ else None
+CAPACITY_MEMORY = (
+    float(os.environ["CAPACITY_MEMORY"]) if "CAPACITY_MEMORY" in os.environ else None
+)
+# instances a team may have at once across all challenges, unlimited if unset
+TEAM_INSTANCE_QUOTA = (
+    int(os.environ["TEAM_INSTANCE_QUOTA"]) if "TEAM_INSTANCE_QUOTA" in os.environ else None
+)
+# teams whose launches jump the queue and aren't held to the quota
+HEALTHCHECK_TEAMS = set(os.getenv("HEALTHCHECK_TEAMS", "healthcheck-team").split(","))
+
+# when set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global database, backend
+    global database, backend, jobs, metrics
     database = load_database()
     backend = load_backend(database)
+    admission = AdmissionController(
+        database,
+        anvil_cost=ANVIL_COST,
+        daemon_cost=DAEMON_COST,
+        cpu_budget=CAPACITY_CPU,
+        memory_budget=CAPACITY_MEMORY,
+        max_launching=LAUNCH_WORKERS,
+        team_quota=TEAM_INSTANCE_QUOTA,
+    )
+    jobs = LaunchJobs(
+        backend,
+        admission,
+        workers=LAUNCH_WORKERS,
+        max_queue=LAUNCH_QUEUE_SIZE,
+        retention=LAUNCH_JOB_RETENTION,
+    )
 
     logging.root.setLevel(logging.INFO)
 
+    if len(WARM_POOLS) > 0:
+        if backend.warm_pools is None:
+            logging.warning("warm pools are not supported by this backend")
+        else:
+            for name, args in WARM_POOLS.items():
+                backend.warm_pools.configure(name, args)
+
+    metrics = Registry()
+    metrics.gauge(
+        "ctf_launch_jobs",
+        "Launch job counters",
+        ["stat"],
+        function=lambda: {(stat,): value for stat, value in jobs.get_stats().items()},
+    )
+    metrics.gauge(
+        "ctf_expiry_scheduler",
+        "Instance expiry counters, leader is 1 on the replica that reaps",
+        ["stat"],
+        function=lambda: {(stat,): value for stat, value in backend.expiry.get_stats().items()},
+    )
+    metrics.gauge(
+        "ctf_deletion_queue",
+        "Instance teardown counters, backlog is the number not yet deleted",
+        ["stat"],
+        function=lambda: {
+            (stat,): value for stat, value in backend.deletions.get_stats().items()
+        },
+    )
+    metrics.gauge(
+        "ctf_admission",
+        "Admission control counters, cpu_used and memory_used include launches in progress",
+        ["stat"],
+        function=lambda: {(stat,): value for stat, value in admission.get_stats().items()},
+    )
+    metrics.gauge(
+        "ctf_instance_locks",
+        "Per-instance lock counters, wait_seconds is the total time spent acquiring",
+        ["stat"],
+        function=lambda: {(stat,): value for stat, value in backend.locks.get_stats().items()},
+    )
+    if backend.warm_pools is not None:
+        metrics.gauge(
+            "ctf_warm_pool",
+            "Pre-booted node pools",
+            ["pool", "stat"],
+            function=lambda: {
+                (name, stat): value
+                for name, stats in backend.warm_pools.get_stats().items()
+                for stat, value in stats.items()
+            },
+        )
+
     yield
 
+    jobs.shutdown()
+
 
 app = FastAPI(lifespan=lifespan)
 
 
 @app.post("/instances")
 def create_instance(args: CreateInstanceRequest):
-    logging.info("launching new instance: %s", args["instance_id"])
-
-    try:
-        user_data = backend.launch_instance(args)
-    except InstanceExists:
+    if database.get_instance(args["instance_id"]) is not None:
         logging.warning("instance already exists: %s", args["instance_id"])
 
         return {
             "ok": False,
             "message": "instance already exists",
         }
-    except Exception as e:
-        logging.error(
-            "failed to launch instance: %s", args["instance_id"], exc_info=e
-        )
+
+    team_id, priority = args.get("team_id"), DEFAULT_PRIORITY
+    if team_id in HEALTHCHECK_TEAMS:
+        # healthchecks go first and may run any number of challenges at once
+        team_id, priority = None, HEALTHCHECK_PRIORITY
+
+    try:
+        job, created = jobs.submit(args, team_id, priority)
+    except QuotaExceeded:
+        logging.warning("team instance quota reached: %s", args["instance_id"])
+
         return {
-            'ok': False,
-            'message': 'an internal error occurred',
+            "ok": False,
+            "message": "your team has too many instances running, kill one first",
         }
+    except LaunchQueueFull:
+        logging.warning("launch queue is full: %s", args["instance_id"])
+
+        return {
+            "ok": False,
+            "message": "too many instances are launching, try again later",
+        }
+
+    return {
+        "ok": True,
+        "message": "instance launch queued" if created else "instance already launching",
+        "data": job.get_info(),
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, after: int = 0, timeout: float = 0):
+    # with a timeout, long-polls until there are events past `after`
+    job = jobs.get(job_id)
+    if job is None:
+        return {
+            "ok": False,
+            "message": "job does not exist",
+        }
+
+    if timeout > 0:
+        await job.wait(after, min(timeout, MAX_POLL_TIMEOUT))
 
-    logging.info("launched new instance: %s", args["instance_id"])
     return {
         "ok": True,
-        "message": "instance launched",
-        "data": user_data,
+        "message": "fetched job",
+        "data": job.get_info(after),
     }
 
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, last_event_id: Optional[str] = Header(None)):
+    job = jobs.get(job_id)
+    if job is None:
+        return {
+            "ok": False,
+            "message": "job does not exist",
+        }
+
+    after = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+    return StreamingResponse(
+        format_job_events(job, after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+async def format_job_events(job: LaunchJob, after: int) -> AsyncIterator[str]:
+    while True:
+        events = await job.wait(after, EVENT_STREAM_KEEPALIVE)
+        if len(events) == 0:
+            yield ": keepalive\n\n"
+            continue
+
+        for event in events:
+            after += 1
+            data = event
+            if event["phase"] in ("succeeded", "failed"):
+                # the last event carries the outcome
+                data = job.get_info(after)
+            yield f"id: {after}\nevent: {event['phase']}\ndata: {json.dumps(data)}\n\n"
+
+        if job.finished and after >= len(job.events()):
+            return
+
+
 @app.get("/instances/{instance_id}")
 def get_instance(instance_id: str):
     user_data = database.get_instance(instance_id)
@@ -72,7 +260,12 @@ def get_instance(instance_id: str):
 @app.post("/instances/{instance_id}/metadata")
 def update_metadata(instance_id: str, metadata: Dict[str, str]):
     try:
-        database.update_metadata(instance_id, metadata)
+        backend.update_metadata(instance_id, metadata)
+    except LockTimeout:
+        return {
+            'ok': False,
+            'message': 'instance is busy, try again later'
+        }
     except:
         return {
             'ok': False,
@@ -89,7 +282,14 @@ def update_metadata(instance_id: str, metadata: Dict[str, str]):
 def delete_instance(instance_id: str):
     logging.info("killing instance: %s", instance_id)
 
-    instance = backend.kill_instance(instance_id)
+    try:
+        instance = backend.kill_instance(instance_id)
+    except LockTimeout:
+        return {
+            "ok": False,
+            "message": "instance is busy, try again later",
+        }
+
     if instance is None:
         return {
             "ok": False,
@@ -100,3 +300,58 @@ def delete_instance(instance_id: str):
         "ok": True,
         "message": "instance deleted",
     }
+
+
+@app.get("/warm-pools")
+def get_warm_pools():
+    if backend.warm_pools is None:
+        return {
+            "ok": False,
+            "message": "warm pools are not supported",
+        }
+
+    return {
+        "ok": True,
+        "message": "fetched warm pools",
+        "data": backend.warm_pools.get_pools(),
+    }
+
+
+@app.put("/warm-pools/{name}")
+def configure_warm_pool(name: str, args: WarmPoolArgs):
+    # a new profile replaces the pool, otherwise only the size and age change
+    if backend.warm_pools is None:
+        return {
+            "ok": False,
+            "message": "warm pools are not supported",
+        }
+
+    return {
+        "ok": True,
+        "message": "warm pool configured",
+        "data": backend.warm_pools.configure(name, args),
+    }
+
+
+@app.delete("/warm-pools/{name}")
+def delete_warm_pool(name: str):
+    if backend.warm_pools is None or not backend.warm_pools.remove(name):
+        return {
+            "ok": False,
+            "message": "no warm pool found",
+        }
+
+    return {
+        "ok": True,
+        "message": "warm pool deleted",
+    }
+
+
+@app.get("/metrics")
+def get_metrics(authorization: Optional[str] = Header(default=None)):
+    if METRICS_TOKEN is not None and not secrets.compare_digest(
+        authorization or "", f"Bearer {METRICS_TOKEN}"
+    ):
+        return Response(status_code=401)
+
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,26 @@
+from .policy import DEFAULT_POLICY, RpcPolicy, compile_policy
+from .routing import Route, RoutingTable
+from .upstream import PoolStats, UpstreamPool, UpstreamPools
+from .health import HealthStats, UpstreamHealth
+from .cache import CacheStats, ResponseCache, canonical_params
+from .compression import CompressionStats, ResponseCompressor
+from .singleflight import SingleFlight, SingleFlightStats
+from .ratelimit import RateLimited, RateLimiter, RateLimiterStats
+from .metrics import InstanceUsage, ProxyMetrics
+from .logs import (
+    ChunkedLogs,
+    LogQueryError,
+    LogQueryStats,
+    get_log_filter,
+    needs_head,
+    resolve_range,
+    too_large_error,
+)
+from .capture import TrafficCapture, read_capture, read_captures
+from .snapshot import (
+    RoutePublisher,
+    RouteSnapshotReader,
+    RouteSnapshotWriter,
+    SnapshotRoutingTable,
+)
+from .websocket import WebSocketClient, WebSocketMultiplexer, WebSocketStats
@@ -0,0 +1,255 @@
+import re
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+import orjson
+
+from ctf_server.types import InstanceEvent
+
+# (external_id, anvil_id, method, canonical params)
+CacheKey = Tuple[str, str, str, bytes]
+
+# rough per-entry bookkeeping cost on top of the key and value bytes
+ENTRY_OVERHEAD = 256
+
+BLOCK_HASH = re.compile(r"^0x[0-9a-fA-F]{64}$")
+BLOCK_NUMBER = re.compile(r"^0x[0-9a-fA-F]+$")
+
+
+def canonical_params(params: Any) -> Optional[bytes]:
+    try:
+        return orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        return None
+
+
+def is_mined(result: Any) -> bool:
+    return isinstance(result, dict) and result.get("blockHash") is not None
+
+
+def is_present(result: Any) -> bool:
+    return result is not None
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+
+class ResponseCache:
+    # answers that never change for the lifetime of a node
+    IMMUTABLE_METHODS = {"eth_chainId", "net_version", "web3_clientVersion"}
+
+    # method -> predicate on the result; the answer is final once it holds
+    RESULT_BOUND_METHODS: Dict[str, Callable[[Any], bool]] = {
+        "eth_getTransactionReceipt": is_mined,
+        "eth_getTransactionByHash": is_mined,
+        "eth_getBlockByHash": is_present,
+        "eth_getBlockTransactionCountByHash": is_present,
+        "eth_getTransactionByBlockHashAndIndex": is_present,
+        "eth_getUncleCountByBlockHash": is_present,
+        "eth_getUncleByBlockHashAndIndex": is_present,
+    }
+
+    # method -> index of the block parameter; cacheable when pinned to a hash or
+    # to a block below the head we've observed
+    BLOCK_PINNED_METHODS = {
+        "eth_getBalance": 1,
+        "eth_getCode": 1,
+        "eth_getTransactionCount": 1,
+        "eth_getStorageAt": 2,
+        "eth_call": 1,
+        "eth_getProof": 2,
+        "eth_getBlockByNumber": 0,
+        "eth_getBlockTransactionCountByNumber": 0,
+        "eth_getTransactionByBlockNumberAndIndex": 0,
+    }
+
+    # not cacheable, but their results tell us where the head is
+    HEAD_METHODS = {"eth_blockNumber"}
+
+    # can revert, reset or rewrite the chain, possibly back to the same height
+    STATE_METHOD_PREFIXES = ("evm_", "anvil_", "hardhat_")
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entry_bytes: int = 1024 * 1024):
+        self.__max_bytes = max_bytes
+        self.__max_entry_bytes = max_entry_bytes
+
+        self.__entries: OrderedDict[CacheKey, bytes] = OrderedDict()
+        self.__keys_by_instance: Dict[str, Set[CacheKey]] = {}
+        # (external_id, anvil_id) -> highest block number observed
+        self.__heads: Dict[Tuple[str, str], int] = {}
+
+        self.stats = CacheStats()
+
+    def is_candidate(self, method: str) -> bool:
+        return (
+            method in self.IMMUTABLE_METHODS
+            or method in self.RESULT_BOUND_METHODS
+            or method in self.BLOCK_PINNED_METHODS
+            or method in self.HEAD_METHODS
+        )
+
+    def make_key(
+        self, external_id: str, anvil_id: str, method: str, params: Any
+    ) -> Optional[CacheKey]:
+        if method in self.HEAD_METHODS:
+            return None
+
+        if method in self.BLOCK_PINNED_METHODS and not self.__is_pinned(
+            external_id, anvil_id, method, params
+        ):
+            return None
+
+        canonical = canonical_params(params)
+        if canonical is None:
+            return None
+
+        return (external_id, anvil_id, method, canonical)
+
+    def get(self, key: CacheKey) -> Optional[bytes]:
+        result = self.__entries.get(key)
+        if result is None:
+            self.stats.misses += 1
+            return None
+
+        self.__entries.move_to_end(key)
+        self.stats.hits += 1
+        return result
+
+    def observe_request(self, external_id: str, anvil_id: str, method: str):
+        if method.startswith(self.STATE_METHOD_PREFIXES):
+            self.drop_node(external_id, anvil_id)
+
+    def observe(
+        self,
+        external_id: str,
+        anvil_id: str,
+        method: str,
+        key: Optional[CacheKey],
+        response: Any,
+    ):
+        if not isinstance(response, dict) or "result" not in response:
+            return
+
+        result = response["result"]
+        if method in self.HEAD_METHODS:
+            self.__observe_head(external_id, anvil_id, result)
+            return
+
+        if key is None:
+            return
+
+        predicate = self.RESULT_BOUND_METHODS.get(method)
+        if predicate is not None and not predicate(result):
+            return
+
+        if method in self.BLOCK_PINNED_METHODS and result is None:
+            return
+
+        self.__store(key, orjson.dumps(result))
+
+    def drop_instance(self, external_id: str):
+        keys = list(self.__keys_by_instance.get(external_id, ()))
+        for key in keys:
+            self.__remove(key)
+        self.stats.invalidations += len(keys)
+
+        for head in [head for head in self.__heads if head[0] == external_id]:
+            del self.__heads[head]
+
+    def drop_node(self, external_id: str, anvil_id: str):
+        keys = [key for key in self.__keys_by_instance.get(external_id, ()) if key[1] == anvil_id]
+        for key in keys:
+            self.__remove(key)
+        self.stats.invalidations += len(keys)
+
+        self.__heads.pop((external_id, anvil_id), None)
+
+    def on_instance_event(self, event: InstanceEvent):
+        # a re-registered route may point at nodes restarted from an older state
+        if event["type"] in ("register", "unregister"):
+            self.drop_instance(event["external_id"])
+
+    def get_stats(self) -> Dict[str, int]:
+        self.stats.entries = len(self.__entries)
+        return asdict(self.stats)
+
+    def __is_pinned(self, external_id: str, anvil_id: str, method: str, params: Any) -> bool:
+        idx = self.BLOCK_PINNED_METHODS[method]
+        if not isinstance(params, list) or len(params) <= idx:
+            # the block parameter defaults to latest
+            return False
+
+        block = params[idx]
+        if isinstance(block, dict):
+            # eip-1898
+            if "blockHash" in block:
+                return isinstance(block["blockHash"], str) and BLOCK_HASH.match(block["blockHash"]) is not None
+            block = block.get("blockNumber")
+
+        if not isinstance(block, str):
+            return False
+
+        if BLOCK_HASH.match(block) is not None:
+            return True
+
+        if BLOCK_NUMBER.match(block) is None:
+            # latest, pending, safe, finalized, earliest
+            return False
+
+        head = self.__heads.get((external_id, anvil_id))
+        return head is not None and int(block, 16) < head
+
+    def __observe_head(self, external_id: str, anvil_id: str, result: Any):
+        if not isinstance(result, str) or BLOCK_NUMBER.match(result) is None:
+            return
+
+        number = int(result, 16)
+        head = self.__heads.get((external_id, anvil_id))
+        if head is not None and number < head:
+            # the chain went backwards, so it was reverted or restarted from an
+            # older state snapshot and anything we know about it may be wrong;
+            # this only catches what the other invalidations missed
+            self.drop_node(external_id, anvil_id)
+
+        self.__heads[(external_id, anvil_id)] = number
+
+    def __store(self, key: CacheKey, result: bytes):
+        size = self.__entry_size(key, result)
+        if size > self.__max_entry_bytes:
+            return
+
+        if key in self.__entries:
+            self.__remove(key)
+
+        self.__entries[key] = result
+        self.__keys_by_instance.setdefault(key[0], set()).add(key)
+        self.stats.bytes += size
+        self.stats.stores += 1
+
+        while self.stats.bytes > self.__max_bytes:
+            self.__remove(next(iter(self.__entries)))
+            self.stats.evictions += 1
+
+    def __remove(self, key: CacheKey):
+        result = self.__entries.pop(key, None)
+        if result is None:
+            return
+
+        self.stats.bytes -= self.__entry_size(key, result)
+
+        keys = self.__keys_by_instance[key[0]]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self.__keys_by_instance[key[0]]
+
+    def __entry_size(self, key: CacheKey, result: bytes) -> int:
+        return ENTRY_OVERHEAD + len(key[0]) + len(key[1]) + len(key[2]) + len(key[3]) + len(result)
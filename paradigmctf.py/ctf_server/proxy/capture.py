@@ -0,0 +1,331 @@
+import asyncio
+import glob
+import hashlib
+import logging
+import os
+import secrets
+import struct
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import orjson
+
+MAGIC = b"APCAP1\n"
+
+# record type, then the record
+RECORD_TYPE = struct.Struct("<B")
+METHOD_RECORD = 0
+REQUEST_RECORD = 1
+
+# method id, name length, then the name
+METHOD_HEADER = struct.Struct("<HH")
+# flags, unix timestamp of arrival, instance, node, duration in ms,
+# response bytes, number of calls
+REQUEST_HEADER = struct.Struct("<BdIIfIH")
+# method id, params bytes
+CALL = struct.Struct("<HI")
+
+FLAG_BATCH = 1
+FLAG_WEBSOCKET = 2
+
+MAX_METHODS = 0xFFFF
+
+
+@dataclass
+class CapturedCall:
+    method: str
+    params_size: int
+
+
+@dataclass
+class CapturedRequest:
+    timestamp: float
+    instance: int
+    node: int
+    duration: float
+    response_size: int
+    batch: bool
+    websocket: bool
+    calls: List[CapturedCall] = field(default_factory=list)
+
+
+@dataclass
+class CaptureStats:
+    records: int = 0
+    dropped: int = 0
+    bytes_written: int = 0
+    files: int = 0
+
+
+def params_size(request: Any) -> int:
+    if not isinstance(request, dict) or "params" not in request:
+        return 0
+
+    try:
+        return len(orjson.dumps(request["params"]))
+    except TypeError:
+        return 0
+
+
+class TrafficCapture:
+    def __init__(
+        self,
+        directory: str,
+        max_file_bytes: int = 64 * 1024 * 1024,
+        max_files: int = 8,
+        max_buffer_bytes: int = 16 * 1024 * 1024,
+        flush_interval: float = 1,
+        salt: Optional[bytes] = None,
+    ):
+        self.__directory = directory
+        self.__max_file_bytes = max_file_bytes
+        self.__max_files = max_files
+        self.__max_buffer_bytes = max_buffer_bytes
+        self.__flush_interval = flush_interval
+
+        # instance and node ids are hashed with a salt that is never written out,
+        # so a capture can be shared without revealing who played what
+        self.__salt = salt or secrets.token_bytes(16)
+        self.__hashes: Dict[str, int] = {}
+
+        self.__started_at = time.time()
+        self.__buffer: List[Tuple[bytes, List[Tuple[Optional[str], int]]]] = []
+        self.__buffered = 0
+
+        # methods get a small id per file, defined the first time they're used
+        self.__methods: Dict[str, int] = {}
+        self.__file: Optional[BinaryIO] = None
+        self.__file_bytes = 0
+        self.__sequence = 0
+
+        self.__flusher: Optional[asyncio.Task] = None
+        # writes run on worker threads, which keep going even if the flush that
+        # started them is cancelled
+        self.__write_lock = threading.Lock()
+
+        self.stats = CaptureStats()
+
+    def start(self):
+        os.makedirs(self.__directory, exist_ok=True)
+        self.__flusher = asyncio.create_task(self.__flush_periodically())
+
+    async def close(self):
+        if self.__flusher is not None:
+            self.__flusher.cancel()
+            try:
+                await self.__flusher
+            except asyncio.CancelledError:
+                pass
+
+        await self.__flush()
+        await asyncio.to_thread(self.__close_file)
+
+    def record(
+        self,
+        instance_id: str,
+        anvil_id: str,
+        body: Any,
+        arrived_at: float,
+        duration: float,
+        response_size: int,
+        websocket: bool = False,
+    ):
+        # arrived_at is the request's wall clock arrival, which replays schedule by
+        if self.__buffered >= self.__max_buffer_bytes:
+            # the disk can't keep up, losing samples beats slowing down requests
+            self.stats.dropped += 1
+            return
+
+        calls = body if isinstance(body, list) else [body]
+        flags = (FLAG_BATCH if isinstance(body, list) else 0) | (
+            FLAG_WEBSOCKET if websocket else 0
+        )
+
+        # methods are resolved when the buffer is flushed, since ids are per file
+        record = (
+            REQUEST_HEADER.pack(
+                flags,
+                arrived_at,
+                self.__anonymize(instance_id),
+                self.__anonymize(anvil_id),
+                duration * 1000,
+                min(response_size, 0xFFFFFFFF),
+                min(len(calls), 0xFFFF),
+            ),
+            [
+                (
+                    call.get("method") if isinstance(call, dict) else None,
+                    min(params_size(call), 0xFFFFFFFF),
+                )
+                for call in calls[:0xFFFF]
+            ],
+        )
+        self.__buffer.append(record)
+        self.__buffered += REQUEST_HEADER.size + CALL.size * len(record[1])
+        self.stats.records += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        return asdict(self.stats)
+
+    def __anonymize(self, value: str) -> int:
+        hashed = self.__hashes.get(value)
+        if hashed is None:
+            digest = hashlib.blake2b(value.encode(), key=self.__salt, digest_size=4).digest()
+            hashed = int.from_bytes(digest, "little")
+            self.__hashes[value] = hashed
+        return hashed
+
+    async def __flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.__flush_interval)
+            try:
+                await self.__flush()
+            except Exception as e:
+                logging.error("failed to write traffic capture", exc_info=e)
+
+    async def __flush(self):
+        if len(self.__buffer) == 0:
+            return
+
+        records, self.__buffer, self.__buffered = self.__buffer, [], 0
+        await asyncio.to_thread(self.__write, records)
+
+    def __write(self, records: List[Tuple[bytes, List[Tuple[Optional[str], int]]]]):
+        with self.__write_lock:
+            self.__write_locked(records)
+
+    def __close_file(self):
+        with self.__write_lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def __write_locked(self, records: List[Tuple[bytes, List[Tuple[Optional[str], int]]]]):
+        for header, calls in records:
+            if self.__file is None or self.__file_bytes >= self.__max_file_bytes:
+                self.__rotate()
+
+            # resolving the methods first writes any new method definitions
+            data = b"".join(CALL.pack(self.__method_id(method), size) for method, size in calls)
+
+            chunk = RECORD_TYPE.pack(REQUEST_RECORD) + header + data
+            self.__file.write(chunk)
+            self.__file_bytes += len(chunk)
+            self.stats.bytes_written += len(chunk)
+
+        self.__file.flush()
+
+    def __method_id(self, method: Optional[str]) -> int:
+        if not isinstance(method, str):
+            method = ""
+
+        method_id = self.__methods.get(method)
+        if method_id is not None:
+            return method_id
+
+        if len(self.__methods) >= MAX_METHODS:
+            # the file is out of ids, lump the rest in with unknown methods
+            return self.__methods[""]
+
+        method_id = len(self.__methods)
+        self.__methods[method] = method_id
+
+        encoded = method.encode()[:0xFFFF]
+        definition = (
+            RECORD_TYPE.pack(METHOD_RECORD)
+            + METHOD_HEADER.pack(method_id, len(encoded))
+            + encoded
+        )
+        self.__file.write(definition)
+        self.__file_bytes += len(definition)
+        return method_id
+
+    def __rotate(self):
+        if self.__file is not None:
+            self.__file.close()
+
+        self.__sequence += 1
+        path = os.path.join(
+            self.__directory,
+            f"capture-{os.getpid()}-{int(self.__started_at)}-{self.__sequence:06d}.bin",
+        )
+        self.__file = open(path, "wb")
+        self.__file.write(MAGIC)
+        self.__file_bytes = len(MAGIC)
+        self.__methods = {}
+        # unknown methods are always id 0, so running out of ids has a fallback
+        self.__method_id("")
+        self.stats.files += 1
+
+        # keep the newest files only, counting those of other workers and of
+        # earlier runs, which nobody else would clean up
+        files = []
+        for other in glob.glob(os.path.join(self.__directory, "capture-*.bin")):
+            try:
+                files.append((os.path.getmtime(other), other))
+            except FileNotFoundError:
+                # pruned by another worker
+                continue
+        files.sort()
+        for _, old in files[: max(0, len(files) - self.__max_files)]:
+            if old == path:
+                continue
+            try:
+                os.unlink(old)
+            except FileNotFoundError:
+                pass
+
+
+def read_capture(path: str) -> Iterator[CapturedRequest]:
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a traffic capture")
+
+        methods: Dict[int, str] = {}
+        while True:
+            record_type = f.read(RECORD_TYPE.size)
+            if len(record_type) == 0:
+                return
+
+            (record_type,) = RECORD_TYPE.unpack(record_type)
+            if record_type == METHOD_RECORD:
+                method_id, length = METHOD_HEADER.unpack(f.read(METHOD_HEADER.size))
+                methods[method_id] = f.read(length).decode()
+                continue
+
+            header = f.read(REQUEST_HEADER.size)
+            if len(header) < REQUEST_HEADER.size:
+                # the proxy was stopped mid-write
+                return
+
+            flags, timestamp, instance, node, duration, response_size, count = (
+                REQUEST_HEADER.unpack(header)
+            )
+            request = CapturedRequest(
+                timestamp=timestamp,
+                instance=instance,
+                node=node,
+                duration=duration / 1000,
+                response_size=response_size,
+                batch=bool(flags & FLAG_BATCH),
+                websocket=bool(flags & FLAG_WEBSOCKET),
+            )
+
+            for _ in range(count):
+                call = f.read(CALL.size)
+                if len(call) < CALL.size:
+                    return
+
+                method_id, size = CALL.unpack(call)
+                request.calls.append(CapturedCall(methods.get(method_id, ""), size))
+
+            yield request
+
+
+def read_captures(paths: List[str]) -> List[CapturedRequest]:
+    # files from several workers are merged by time
+    requests = [request for path in paths for request in read_capture(path)]
+    requests.sort(key=lambda request: request.timestamp)
+    return requests
@@ -0,0 +1,209 @@
+import asyncio
+import zlib
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+from websockets.frames import CTRL_OPCODES, OP_CONT, Frame
+
+# optional, pip install paradigmctf.py[compression]
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# in order of preference when the client accepts several equally
+SUPPORTED_ENCODINGS = [
+    encoding
+    for encoding, available in (("br", brotli), ("zstd", zstandard), ("gzip", zlib))
+    if available is not None
+]
+
+
+@lru_cache(maxsize=256)
+def parse_accept_encoding(header: str) -> Tuple[Tuple[str, float], ...]:
+    # clients send the same few headers over and over, so parse each once
+    accepted = []
+    for entry in header.split(","):
+        coding, _, params = entry.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        if coding:
+            accepted.append((coding.strip().lower(), quality))
+    return tuple(accepted)
+
+
+def negotiate(header: Optional[str], encodings: List[str]) -> Optional[str]:
+    if not header:
+        return None
+
+    accepted = dict(parse_accept_encoding(header))
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class StreamEncoder:
+    # incremental compression of a body that arrives in chunks
+    def __init__(self, encoding: str, level: int):
+        self.__encoding = encoding
+        if encoding == "br":
+            self.__encoder = brotli.Compressor(quality=level)
+        elif encoding == "zstd":
+            self.__encoder = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self.__encoder = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.__encoding == "br":
+            return self.__encoder.process(chunk)
+        return self.__encoder.compress(chunk)
+
+    def flush(self) -> bytes:
+        if self.__encoding == "br":
+            return self.__encoder.finish()
+        return self.__encoder.flush()
+
+
+@dataclass
+class CompressionStats:
+    compressed: int = 0
+    skipped_small: int = 0
+    offloaded: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+
+
+class ResponseCompressor:
+    def __init__(
+        self,
+        encodings: Optional[List[str]] = None,
+        min_size: int = 1024,
+        offload_size: int = 16 * 1024,
+        levels: Optional[Dict[str, int]] = None,
+    ):
+        self.__encodings = [
+            encoding
+            for encoding in (encodings if encodings is not None else SUPPORTED_ENCODINGS)
+            if encoding in SUPPORTED_ENCODINGS
+        ]
+        # below this the framing overhead isn't worth it
+        self.__min_size = min_size
+        # bodies at least this large are compressed on a worker thread so the event
+        # loop keeps serving; zlib, brotli and zstd all release the gil
+        self.__offload_size = offload_size
+        # fast settings, hex json compresses well even at low levels
+        self.__levels = {"br": 4, "zstd": 3, "gzip": 4, **(levels or {})}
+
+        self.__stats = CompressionStats()
+
+    def choose(self, accept_encoding: Optional[str], size: Optional[int]) -> Optional[str]:
+        if size is not None and size < self.__min_size:
+            self.__stats.skipped_small += 1
+            return None
+
+        return negotiate(accept_encoding, self.__encodings)
+
+    async def compress(self, body: bytes, encoding: str) -> bytes:
+        encoder = StreamEncoder(encoding, self.__levels[encoding])
+        compressed = await self.__run(encoder, body, final=True)
+
+        self.__stats.compressed += 1
+        self.__stats.bytes_in += len(body)
+        self.__stats.bytes_out += len(compressed)
+        return compressed
+
+    async def compress_stream(
+        self, chunks: AsyncIterator[Any], encoding: str
+    ) -> AsyncIterator[bytes]:
+        encoder = StreamEncoder(encoding, self.__levels[encoding])
+        self.__stats.compressed += 1
+
+        try:
+            async for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+
+                compressed = await self.__run(encoder, chunk, final=False)
+                self.__stats.bytes_in += len(chunk)
+                self.__stats.bytes_out += len(compressed)
+                if len(compressed) > 0:
+                    yield compressed
+        finally:
+            # let the source release its upstream connection if the client went away
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+
+        tail = encoder.flush()
+        self.__stats.bytes_out += len(tail)
+        yield tail
+
+    def get_stats(self) -> Dict[str, int]:
+        return asdict(self.__stats)
+
+    async def __run(self, encoder: StreamEncoder, data: bytes, final: bool) -> bytes:
+        def work() -> bytes:
+            compressed = encoder.compress(data)
+            return compressed + encoder.flush() if final else compressed
+
+        if len(data) < self.__offload_size:
+            return work()
+
+        self.__stats.offloaded += 1
+        return await asyncio.to_thread(work)
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    # permessage-deflate that sends small messages uncompressed, which rfc 7692
+    # allows per message by leaving rsv1 unset
+    def __init__(self, *args: Any, min_size: int = 1024, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.__min_size = min_size
+        self.__skipping = False
+
+    def encode(self, frame: Frame) -> Frame:
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+
+        if frame.opcode is not OP_CONT:
+            self.__skipping = frame.fin and len(frame.data) < self.__min_size
+
+        if self.__skipping:
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, min_size: int = 1024, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.__min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.__min_size,
+        )
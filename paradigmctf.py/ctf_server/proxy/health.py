@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+from ctf_server.types import InstanceEvent
+
+from .routing import RoutingTable
+
+
+@dataclass
+class HealthStats:
+    outages: int = 0
+    recoveries: int = 0
+    held_requests: int = 0
+    rejected_requests: int = 0
+    endpoint_refreshes: int = 0
+    unhealthy_nodes: int = 0
+
+
+class NodeOutage:
+    __slots__ = ("started_at", "recovered", "prober")
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.recovered = asyncio.Event()
+        self.prober: Optional[asyncio.Task] = None
+
+
+class UpstreamHealth:
+    # Anvil runs in a restart loop, so a node that refuses connections is
+    # usually a second or two away from coming back. Requests to it are held for
+    # up to hold_seconds while a prober waits for the port to open; after that
+    # the circuit is open and requests fail fast until the prober sees the node
+    # again or gives up.
+    def __init__(
+        self,
+        routing_table: RoutingTable,
+        hold_seconds: float = 3,
+        probe_interval: float = 0.1,
+        max_probe_interval: float = 2,
+        refresh_interval: float = 1,
+        give_up_after: float = 300,
+        on_outage_end: Optional[Callable[[str, str], None]] = None,
+    ):
+        self.__routing_table = routing_table
+        self.__hold_seconds = hold_seconds
+        self.__probe_interval = probe_interval
+        self.__max_probe_interval = max_probe_interval
+        # the node may have come back somewhere else, re-read its route this often
+        self.__refresh_interval = refresh_interval
+        self.__give_up_after = give_up_after
+        # called with the node once it's back or no longer watched
+        self.__on_outage_end = on_outage_end
+
+        # (external_id, anvil_id) -> ongoing outage; healthy nodes have no entry
+        self.__outages: Dict[Tuple[str, str], NodeOutage] = {}
+
+        self.stats = HealthStats()
+
+    async def wait_ready(self, external_id: str, anvil_id: str) -> bool:
+        outage = self.__outages.get((external_id, anvil_id))
+        if outage is None:
+            return True
+
+        remaining = outage.started_at + self.__hold_seconds - time.monotonic()
+        if remaining <= 0:
+            self.stats.rejected_requests += 1
+            return False
+
+        self.stats.held_requests += 1
+        try:
+            await asyncio.wait_for(outage.recovered.wait(), remaining)
+            return True
+        except asyncio.TimeoutError:
+            self.stats.rejected_requests += 1
+            return False
+
+    def record_failure(self, external_id: str, anvil_id: str):
+        key = (external_id, anvil_id)
+        if key in self.__outages:
+            return
+
+        logging.warning("anvil %s/%s is unreachable, holding requests", external_id, anvil_id)
+        outage = NodeOutage()
+        outage.prober = asyncio.create_task(self.__probe(key, outage))
+        self.__outages[key] = outage
+        self.stats.outages += 1
+
+    async def close(self):
+        outages = list(self.__outages.values())
+        self.__outages.clear()
+        for outage in outages:
+            outage.prober.cancel()
+        await asyncio.gather(*[outage.prober for outage in outages], return_exceptions=True)
+
+    def on_instance_event(self, event: InstanceEvent):
+        if event["type"] == "unregister":
+            for key in [key for key in self.__outages if key[0] == event["external_id"]]:
+                self.__end(key, recovered=False)
+        elif event["type"] == "register":
+            # the backend moved the node, try the new endpoint right away
+            for key, outage in self.__outages.items():
+                if key[0] == event["external_id"]:
+                    outage.prober.cancel()
+                    outage.prober = asyncio.create_task(self.__probe(key, outage))
+
+    def get_stats(self) -> Dict[str, int]:
+        self.stats.unhealthy_nodes = len(self.__outages)
+        return asdict(self.stats)
+
+    async def __probe(self, key: Tuple[str, str], outage: NodeOutage):
+        external_id, anvil_id = key
+        interval = self.__probe_interval
+        refreshed_at = time.monotonic()
+        try:
+            while time.monotonic() - outage.started_at < self.__give_up_after:
+                if time.monotonic() - refreshed_at >= self.__refresh_interval:
+                    self.__routing_table.invalidate(external_id)
+                    self.stats.endpoint_refreshes += 1
+                    refreshed_at = time.monotonic()
+
+                route = await self.__routing_table.lookup(external_id)
+                upstream = route.upstreams.get(anvil_id) if route is not None else None
+                if upstream is None:
+                    # the instance is gone, requests will fail the route lookup
+                    self.__end(key, recovered=False)
+                    return
+
+                if await self.__is_listening(upstream):
+                    logging.info("anvil %s/%s is reachable again", external_id, anvil_id)
+                    self.__end(key, recovered=True)
+                    return
+
+                await asyncio.sleep(interval)
+                # poll quickly through a normal restart, back off once it takes longer
+                if time.monotonic() - outage.started_at > self.__hold_seconds:
+                    interval = min(interval * 2, self.__max_probe_interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("failed to probe anvil %s/%s", external_id, anvil_id, exc_info=e)
+
+        # forget the outage so the next failure starts over
+        self.__end(key, recovered=False)
+
+    async def __is_listening(self, upstream: str) -> bool:
+        host, _, port = upstream.rpartition(":")
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, int(port)), self.__probe_interval * 5
+            )
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+        writer.close()
+        return True
+
+    def __end(self, key: Tuple[str, str], recovered: bool):
+        outage = self.__outages.pop(key, None)
+        if outage is None:
+            return
+
+        if recovered:
+            self.stats.recoveries += 1
+        if self.__on_outage_end is not None:
+            self.__on_outage_end(*key)
+        # wake held requests either way; a recovered node is retried, a removed
+        # instance fails its route lookup
+        outage.recovered.set()
+        if outage.prober is not asyncio.current_task():
+            outage.prober.cancel()
@@ -0,0 +1,178 @@
+import asyncio
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import orjson
+
+# tags that mean "the current head" on anvil
+HEAD_TAGS = {"latest", "pending", "safe", "finalized"}
+
+
+class LogQueryError(Exception):
+    def __init__(self, error: Dict):
+        super().__init__(error.get("message"))
+        self.error = error
+
+
+def too_large_error(max_size: int) -> Dict:
+    return {
+        "code": -32005,
+        "message": f"query returned more than {max_size} bytes, narrow the block range",
+    }
+
+
+def get_log_filter(params: Any) -> Optional[Dict]:
+    if not isinstance(params, list) or len(params) != 1 or not isinstance(params[0], dict):
+        return None
+
+    log_filter = params[0]
+    if log_filter.get("blockHash") is not None:
+        # a single block, nothing to split
+        return None
+    return log_filter
+
+
+def needs_head(log_filter: Dict) -> bool:
+    # only a range from a fixed block up to the head can be wide enough to
+    # split; one starting at the head is a single block
+    from_block = log_filter.get("fromBlock", "latest")
+    to_block = log_filter.get("toBlock", "latest")
+    return (
+        isinstance(from_block, str)
+        and from_block not in HEAD_TAGS
+        and isinstance(to_block, str)
+        and to_block in HEAD_TAGS
+    )
+
+
+def parse_block(value: Any, head: Optional[int]) -> Optional[int]:
+    if not isinstance(value, str):
+        return None
+    if value in HEAD_TAGS:
+        return head
+    if value == "earliest":
+        return 0
+    if value.startswith("0x"):
+        try:
+            return int(value, 16)
+        except ValueError:
+            return None
+    return None
+
+
+def resolve_range(log_filter: Dict, head: Optional[int]) -> Optional[Tuple[int, int]]:
+    from_block = parse_block(log_filter.get("fromBlock", "latest"), head)
+    to_block = parse_block(log_filter.get("toBlock", "latest"), head)
+    if from_block is None or to_block is None or from_block > to_block:
+        # let anvil report whatever is wrong with it
+        return None
+    return from_block, to_block
+
+
+@dataclass
+class LogQueryStats:
+    queries: int = 0
+    chunks: int = 0
+    bytes: int = 0
+    too_large: int = 0
+    failed: int = 0
+
+
+class ChunkedLogs:
+    # Splits a wide eth_getLogs into block ranges fetched a few at a time, and
+    # yields the logs in order as comma-separated json, without the brackets.
+    # Chunk sizes adapt to the results, so sparse ranges are covered in few
+    # requests and dense ranges never make anvil build one huge reply.
+    def __init__(
+        self,
+        chunk_blocks: int = 2000,
+        max_chunk_blocks: int = 1_000_000,
+        target_chunk_size: int = 1024 * 1024,
+        concurrency: int = 4,
+        max_size: int = 128 * 1024 * 1024,
+    ):
+        self.__chunk_blocks = chunk_blocks
+        self.__max_chunk_blocks = max_chunk_blocks
+        self.__target_chunk_size = target_chunk_size
+        self.__concurrency = concurrency
+        self.__max_size = max_size
+        self.__stats = LogQueryStats()
+
+    def should_split(self, block_range: Tuple[int, int]) -> bool:
+        return block_range[1] - block_range[0] + 1 > self.__chunk_blocks
+
+    async def query(
+        self,
+        fetch: Callable[[Dict], Awaitable[Any]],
+        log_filter: Dict,
+        block_range: Tuple[int, int],
+    ) -> AsyncIterator[bytes]:
+        self.__stats.queries += 1
+
+        next_block, last_block = block_range
+        chunk_blocks = self.__chunk_blocks
+        size = 0
+        # in dispatch order, so results come out in block order
+        pending: Deque[asyncio.Task] = deque()
+        try:
+            while len(pending) > 0 or next_block <= last_block:
+                while next_block <= last_block and len(pending) < self.__concurrency:
+                    end = min(last_block, next_block + chunk_blocks - 1)
+                    pending.append(
+                        asyncio.create_task(
+                            self.__fetch_chunk(fetch, log_filter, next_block, end)
+                        )
+                    )
+                    next_block = end + 1
+
+                logs = await pending.popleft()
+                chunk_blocks = self.__next_chunk_blocks(chunk_blocks, len(logs))
+
+                size += len(logs)
+                self.__stats.bytes += len(logs)
+                if size > self.__max_size:
+                    self.__stats.too_large += 1
+                    raise LogQueryError(too_large_error(self.__max_size))
+
+                if len(logs) > 0:
+                    yield logs
+        except LogQueryError:
+            self.__stats.failed += 1
+            raise
+        finally:
+            for task in pending:
+                if task.done() and not task.cancelled():
+                    # the query was abandoned, nobody else will look at this
+                    task.exception()
+                task.cancel()
+
+    def get_stats(self) -> Dict[str, int]:
+        return asdict(self.__stats)
+
+    async def __fetch_chunk(
+        self,
+        fetch: Callable[[Dict], Awaitable[Any]],
+        log_filter: Dict,
+        from_block: int,
+        to_block: int,
+    ) -> bytes:
+        self.__stats.chunks += 1
+        response = await fetch(
+            {**log_filter, "fromBlock": hex(from_block), "toBlock": hex(to_block)}
+        )
+
+        if not isinstance(response, dict) or not isinstance(response.get("result"), list):
+            error = response.get("error") if isinstance(response, dict) else None
+            if not isinstance(error, dict):
+                error = {"code": -32603, "message": "invalid upstream response"}
+            raise LogQueryError(error)
+
+        return orjson.dumps(response["result"])[1:-1]
+
+    def __next_chunk_blocks(self, chunk_blocks: int, size: int) -> int:
+        if size < self.__target_chunk_size // 4:
+            return min(chunk_blocks * 2, self.__max_chunk_blocks)
+        if size > self.__target_chunk_size:
+            return max(chunk_blocks // 2, 1)
+        return chunk_blocks
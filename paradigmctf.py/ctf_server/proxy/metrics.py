@@ -0,0 +1,177 @@
+import heapq
+from typing import Callable, Dict, Set
+
+from ctf_server.metrics import OTHER, BoundedLabel, Registry
+from ctf_server.types import InstanceEvent
+
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+DATABASE_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    1,
+)
+
+
+class InstanceUsage:
+    __slots__ = ("instance_id", "requests", "bytes_in", "bytes_out", "seconds")
+
+    FIELDS = ("requests", "bytes_in", "bytes_out", "seconds")
+
+    def __init__(self, instance_id: str):
+        self.instance_id = instance_id
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def add(self, requests: int, bytes_in: int, bytes_out: int, seconds: float):
+        self.requests += requests
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds += seconds
+
+
+class ProxyMetrics:
+    def __init__(self, registry: Registry, top_instances: int = 20, max_methods: int = 128):
+        self.registry = registry
+        self.__top_instances = top_instances
+
+        # method names come from players, only the first few distinct ones get a series
+        self.method_label = BoundedLabel(max_methods)
+
+        self.requests = registry.counter(
+            "anvil_proxy_requests", "JSON-RPC requests handled", ["transport", "method"]
+        )
+        self.request_seconds = registry.histogram(
+            "anvil_proxy_request_duration_seconds",
+            "Time spent answering a request, including the upstream",
+            ["method"],
+        )
+        self.upstream_seconds = registry.histogram(
+            "anvil_proxy_upstream_duration_seconds",
+            "Time spent waiting on anvil for a response",
+            ["method"],
+        )
+        self.batch_size = registry.histogram(
+            "anvil_proxy_batch_size",
+            "Number of requests in a JSON-RPC batch",
+            buckets=BATCH_SIZE_BUCKETS,
+        )
+        self.bytes_received = registry.counter(
+            "anvil_proxy_received_bytes", "Request bytes received from clients", ["transport"]
+        )
+        self.bytes_sent = registry.counter(
+            "anvil_proxy_sent_bytes", "Response bytes sent to clients", ["transport"]
+        )
+        self.rejections = registry.counter(
+            "anvil_proxy_rejected_requests",
+            "Requests answered by the proxy without reaching anvil",
+            ["reason"],
+        )
+        self.upstream_failures = registry.counter(
+            "anvil_proxy_upstream_failures", "Upstream requests that failed", ["reason"]
+        )
+        self.database_seconds = registry.histogram(
+            "anvil_proxy_database_lookup_duration_seconds",
+            "Time spent looking up a route in the database",
+            buckets=DATABASE_BUCKETS,
+        )
+        self.websockets = registry.gauge(
+            "anvil_proxy_websocket_connections", "Client websockets currently open"
+        )
+        registry.counter(
+            "anvil_proxy_instance_usage",
+            f"Usage of the {top_instances} busiest instances, the rest are counted as other",
+            ["instance_id", "field"],
+            function=self.__collect_instance_usage,
+        )
+
+        # external_id -> usage; only the busiest are exported to bound cardinality,
+        # and they're labelled by instance id since the external id is a secret
+        self.__instances: Dict[str, InstanceUsage] = {}
+        # usage is counted under an instance's own label only while it's among
+        # the busiest and under other the rest of the time, so that every series
+        # only ever goes up as instances move in and out of the top
+        self.__busiest: Set[str] = set()
+        self.__labelled: Dict[str, InstanceUsage] = {}
+        self.__other = InstanceUsage(OTHER)
+
+    def add_stats(self, name: str, documentation: str, get_stats: Callable[[], Dict]):
+        # exports a component's get_stats() as one gauge labelled by stat name
+        def collect():
+            return {
+                (stat,): value
+                for stat, value in get_stats().items()
+                if isinstance(value, (int, float))
+            }
+
+        self.registry.gauge(f"anvil_proxy_{name}", documentation, ["stat"], function=collect)
+
+    def observe_instance(
+        self,
+        external_id: str,
+        instance_id: str,
+        bytes_in: int = 0,
+        bytes_out: int = 0,
+        seconds: float = 0,
+    ):
+        usage = self.__instances.get(external_id)
+        if usage is None:
+            usage = InstanceUsage(instance_id)
+            self.__instances[external_id] = usage
+            if len(self.__busiest) < self.__top_instances:
+                # there's room, no need to wait for the next scrape
+                self.__busiest.add(external_id)
+                self.__labelled.setdefault(external_id, InstanceUsage(instance_id))
+
+        usage.add(1, bytes_in, bytes_out, seconds)
+        self.__exported_usage(external_id).add(1, bytes_in, bytes_out, seconds)
+
+    def observe_instance_bytes_out(self, external_id: str, bytes_out: int):
+        usage = self.__instances.get(external_id)
+        if usage is not None:
+            usage.bytes_out += bytes_out
+            self.__exported_usage(external_id).bytes_out += bytes_out
+
+    def on_instance_event(self, event: InstanceEvent):
+        if event["type"] == "unregister":
+            self.__instances.pop(event["external_id"], None)
+            self.__busiest.discard(event["external_id"])
+            self.__labelled.pop(event["external_id"], None)
+
+    def render(self) -> str:
+        return self.registry.render()
+
+    def __exported_usage(self, external_id: str) -> InstanceUsage:
+        if external_id in self.__busiest:
+            return self.__labelled[external_id]
+        return self.__other
+
+    def __collect_instance_usage(self) -> Dict:
+        top = heapq.nlargest(
+            self.__top_instances,
+            self.__instances.items(),
+            key=lambda item: item[1].requests,
+        )
+
+        # newcomers start from zero, what they used before was counted as other;
+        # instances that drop out keep their count in case they come back
+        self.__busiest = {external_id for external_id, _ in top}
+        for external_id, usage in top:
+            if external_id not in self.__labelled:
+                self.__labelled[external_id] = InstanceUsage(usage.instance_id)
+
+        values = {}
+        for usage in [self.__labelled[external_id] for external_id, _ in top] + [self.__other]:
+            for field in InstanceUsage.FIELDS:
+                values[(usage.instance_id, field)] = getattr(usage, field)
+        return values
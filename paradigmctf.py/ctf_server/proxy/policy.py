@@ -0,0 +1,103 @@
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Optional
+
+import orjson
+
+from ctf_server.types import RpcPolicyArgs
+
+DEFAULT_ALLOWED_NAMESPACES = ["web3", "eth", "net"]
+DEFAULT_DISALLOWED_METHODS = [
+    "eth_sign",
+    "eth_signTransaction",
+    "eth_signTypedData",
+    "eth_signTypedData_v3",
+    "eth_signTypedData_v4",
+    "eth_sendTransaction",
+    "eth_sendUnsignedTransaction",
+]
+
+# decisions remembered per policy; method names come from players, so bound it
+MAX_DECISIONS = 1024
+
+
+class RpcPolicy:
+    def __init__(
+        self,
+        allowed_namespaces: Iterable[str],
+        allowed_methods: Iterable[str],
+        disallowed_methods: Iterable[str],
+    ):
+        self.__allowed_namespaces: FrozenSet[str] = frozenset(allowed_namespaces)
+        self.__allowed_methods: FrozenSet[str] = frozenset(allowed_methods)
+        self.__disallowed_methods: FrozenSet[str] = frozenset(disallowed_methods)
+
+        # method -> decision, so known methods cost a single dict lookup
+        self.__decisions: Dict[str, bool] = {}
+
+    def is_allowed(self, method: str) -> bool:
+        decision = self.__decisions.get(method)
+        if decision is None:
+            decision = self.__decide(method)
+            if len(self.__decisions) < MAX_DECISIONS:
+                self.__decisions[method] = decision
+        return decision
+
+    def __decide(self, method: str) -> bool:
+        if method in self.__disallowed_methods:
+            return False
+
+        if method in self.__allowed_methods:
+            return True
+
+        return method.split("_", 1)[0] in self.__allowed_namespaces
+
+
+def merge_policies(*policies: Optional[RpcPolicyArgs]) -> Optional[RpcPolicyArgs]:
+    # later policies override earlier ones field by field
+    merged: RpcPolicyArgs = {}
+    for policy in policies:
+        if policy is None:
+            continue
+
+        for key, value in policy.items():
+            if value is not None:
+                merged[key] = value
+
+    return merged if len(merged) > 0 else None
+
+
+def compile_policy(policy: Optional[RpcPolicyArgs]) -> RpcPolicy:
+    if policy is None:
+        return DEFAULT_POLICY
+
+    # instances launched from the same challenge share one compiled policy
+    return _compile_policy_json(orjson.dumps(policy, option=orjson.OPT_SORT_KEYS))
+
+
+@lru_cache(maxsize=256)
+def _compile_policy_json(policy_json: bytes) -> RpcPolicy:
+    policy: RpcPolicyArgs = orjson.loads(policy_json)
+
+    allowed_namespaces = policy.get("allowed_namespaces")
+    if allowed_namespaces is None:
+        allowed_namespaces = DEFAULT_ALLOWED_NAMESPACES
+
+    allowed_methods = policy.get("allowed_methods") or []
+
+    # explicitly allowing a default-disallowed method lifts the default ban
+    disallowed_methods = [
+        method for method in DEFAULT_DISALLOWED_METHODS if method not in allowed_methods
+    ] + (policy.get("disallowed_methods") or [])
+
+    return RpcPolicy(
+        allowed_namespaces=allowed_namespaces,
+        allowed_methods=allowed_methods,
+        disallowed_methods=disallowed_methods,
+    )
+
+
+DEFAULT_POLICY = RpcPolicy(
+    allowed_namespaces=DEFAULT_ALLOWED_NAMESPACES,
+    allowed_methods=[],
+    disallowed_methods=DEFAULT_DISALLOWED_METHODS,
+)
@@ -0,0 +1,161 @@
+import asyncio
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Optional
+
+from ctf_server.types import InstanceEvent, RateLimitArgs
+
+DEFAULT_METHOD_COSTS = {
+    "eth_call": 10,
+    "eth_estimateGas": 10,
+    "eth_createAccessList": 10,
+    "eth_getProof": 10,
+    "eth_getLogs": 20,
+    "eth_getBlockByNumber": 2,
+    "eth_getBlockByHash": 2,
+    "eth_getBlockReceipts": 10,
+    "eth_sendRawTransaction": 5,
+    "eth_feeHistory": 2,
+}
+
+
+class RateLimited(Exception):
+    pass
+
+
+@dataclass
+class RateLimiterStats:
+    admitted: int = 0
+    delayed: int = 0
+    rejected: int = 0
+    cost: int = 0
+    wait_seconds: float = 0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.waiters = 0
+        self.queued_cost = 0
+        # asyncio locks wake waiters in fifo order
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        rate: float = 0,
+        burst: float = 1000,
+        max_queue: int = 64,
+        max_wait: float = 5,
+        method_costs: Dict[str, int] = DEFAULT_METHOD_COSTS,
+    ):
+        self.__defaults = RateLimitArgs(
+            rate=rate,
+            burst=burst,
+            max_queue=max_queue,
+            max_wait=max_wait,
+        )
+        self.__method_costs = method_costs
+
+        # external_id -> bucket
+        self.__buckets: Dict[str, TokenBucket] = {}
+
+        self.stats = RateLimiterStats()
+
+    def cost(self, request: Any, limits: Optional[RateLimitArgs] = None) -> int:
+        method_costs = self.__method_costs
+        if limits is not None and limits.get("method_costs") is not None:
+            method_costs = method_costs | limits["method_costs"]
+
+        if isinstance(request, list):
+            return max(1, sum(self.__method_cost(method_costs, r) for r in request))
+
+        return self.__method_cost(method_costs, request)
+
+    async def acquire(
+        self, external_id: str, cost: int, limits: Optional[RateLimitArgs] = None
+    ):
+        config = self.__config(limits)
+        if config["rate"] <= 0:
+            return
+
+        bucket = self.__buckets.get(external_id)
+        if bucket is None or bucket.rate != config["rate"] or bucket.burst != config["burst"]:
+            bucket = TokenBucket(config["rate"], config["burst"])
+            self.__buckets[external_id] = bucket
+
+        # a request bigger than the bucket just has to wait for a full one
+        cost = min(cost, bucket.burst)
+
+        bucket.refill()
+        if bucket.waiters == 0 and bucket.tokens >= cost:
+            bucket.tokens -= cost
+            self.stats.admitted += 1
+            self.stats.cost += cost
+            return
+
+        # queue behind this tenant's earlier requests rather than failing outright,
+        # but only while the wait stays bounded
+        if bucket.waiters >= config["max_queue"]:
+            self.stats.rejected += 1
+            raise RateLimited()
+
+        backlog = bucket.queued_cost + cost - bucket.tokens
+        if backlog / bucket.rate > config["max_wait"]:
+            self.stats.rejected += 1
+            raise RateLimited()
+
+        started_at = time.monotonic()
+        bucket.waiters += 1
+        bucket.queued_cost += cost
+        try:
+            async with bucket.lock:
+                bucket.refill()
+                if bucket.tokens < cost:
+                    await asyncio.sleep((cost - bucket.tokens) / bucket.rate)
+                    bucket.refill()
+
+                bucket.tokens -= cost
+        finally:
+            bucket.waiters -= 1
+            bucket.queued_cost -= cost
+
+        self.stats.admitted += 1
+        self.stats.delayed += 1
+        self.stats.cost += cost
+        self.stats.wait_seconds += time.monotonic() - started_at
+
+    def queued(self) -> Dict[str, int]:
+        return {
+            external_id: bucket.waiters
+            for external_id, bucket in self.__buckets.items()
+            if bucket.waiters > 0
+        }
+
+    def on_instance_event(self, event: InstanceEvent):
+        if event["type"] == "unregister":
+            self.__buckets.pop(event["external_id"], None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return asdict(self.stats)
+
+    def __config(self, limits: Optional[RateLimitArgs]) -> RateLimitArgs:
+        if limits is None:
+            return self.__defaults
+
+        return self.__defaults | {k: v for k, v in limits.items() if v is not None}
+
+    def __method_cost(self, method_costs: Dict[str, int], request: Any) -> int:
+        if not isinstance(request, dict):
+            return 1
+
+        return method_costs.get(request.get("method"), 1)
@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from ctf_server.databases.asyncdatabase import AsyncDatabase
+from ctf_server.metrics import Histogram
+from ctf_server.types import InstanceEvent, InstanceRoute, RateLimitArgs
+
+from .policy import DEFAULT_POLICY, RpcPolicy, compile_policy, merge_policies
+from .singleflight import Flight
+
+
+@dataclass
+class Route:
+    instance_id: str
+    # anvil_id -> "ip:port"
+    upstreams: Dict[str, str]
+    rate_limit: Optional[RateLimitArgs] = None
+    # anvil_id -> compiled rpc policy for that node
+    policies: Dict[str, RpcPolicy] = field(default_factory=dict)
+
+    def get_policy(self, anvil_id: str) -> RpcPolicy:
+        return self.policies.get(anvil_id, DEFAULT_POLICY)
+
+
+def make_route(route: Optional[InstanceRoute]) -> Optional[Route]:
+    if route is None:
+        return None
+
+    return Route(
+        instance_id=route["instance_id"],
+        upstreams={
+            anvil_id: f"{anvil_instance['ip']}:{anvil_instance['port']}"
+            for anvil_id, anvil_instance in route["anvil_instances"].items()
+        },
+        rate_limit=route.get("rate_limit"),
+        policies={
+            anvil_id: compile_policy(
+                merge_policies(route.get("rpc_policy"), anvil_instance.get("rpc_policy"))
+            )
+            for anvil_id, anvil_instance in route["anvil_instances"].items()
+        },
+    )
+
+
+class RoutingTable:
+    def __init__(
+        self,
+        database: AsyncDatabase,
+        max_size: int = 4096,
+        ttl: float = 60,
+        negative_ttl: float = 1,
+        lookup_seconds: Optional[Histogram] = None,
+    ):
+        self.__database = database
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__lookup_seconds = lookup_seconds
+
+        # external_id -> (deadline, route or None if the instance doesn't exist)
+        self.__entries: OrderedDict[str, Tuple[float, Optional[Route]]] = OrderedDict()
+        # concurrent misses for the same external_id share a single database lookup
+        self.__pending: Dict[str, Flight[Optional[Route]]] = {}
+
+        database.subscribe_instance_events(self.__on_instance_event)
+
+    async def lookup(self, external_id: str) -> Optional[Route]:
+        entry = self.__entries.get(external_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.__entries.move_to_end(external_id)
+            return entry[1]
+
+        flight = self.__pending.get(external_id)
+        if flight is None:
+            flight = Flight(self.__fetch(external_id))
+            self.__pending[external_id] = flight
+            flight.task.add_done_callback(
+                lambda task: self.__on_fetched(external_id, flight, task)
+            )
+        return await flight.wait()
+
+    async def __fetch(self, external_id: str) -> Optional[Route]:
+        started_at = time.perf_counter()
+        route = make_route(await self.__database.get_route_by_external_id(external_id))
+        if self.__lookup_seconds is not None:
+            self.__lookup_seconds.observe(time.perf_counter() - started_at)
+        return route
+
+    def __on_fetched(
+        self, external_id: str, flight: Flight[Optional[Route]], task: asyncio.Future
+    ):
+        # an invalidation that raced the lookup wins, don't cache stale data
+        if self.__pending.get(external_id) is not flight:
+            return
+
+        del self.__pending[external_id]
+        if not task.cancelled() and task.exception() is None:
+            self.__store(external_id, task.result())
+
+    def invalidate(self, external_id: str):
+        self.__entries.pop(external_id, None)
+        self.__pending.pop(external_id, None)
+
+    def clear(self):
+        self.__entries.clear()
+        self.__pending.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __store(self, external_id: str, route: Optional[Route]):
+        ttl = self.__ttl if route is not None else self.__negative_ttl
+        self.__entries[external_id] = (time.monotonic() + ttl, route)
+        self.__entries.move_to_end(external_id)
+
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+
+    def __on_instance_event(self, event: InstanceEvent):
+        if event["type"] == "resync":
+            self.clear()
+        elif "external_id" in event:
+            self.invalidate(event["external_id"])
@@ -0,0 +1,112 @@
+import asyncio
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Tuple, TypeVar
+
+from ctf_server.types import InstanceEvent
+
+
+T = TypeVar("T")
+
+
+class Flight(Generic[T]):
+    # A call shared by several callers. It runs as its own task so it outlives
+    # any one of them, and is only cancelled once every caller has gone.
+    def __init__(self, call: Awaitable[T]):
+        self.task: asyncio.Future[T] = asyncio.ensure_future(call)
+        self.__waiters = 0
+
+    async def wait(self) -> T:
+        self.__waiters += 1
+        try:
+            return await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if self.__waiters == 1:
+                self.task.cancel()
+            raise
+        finally:
+            self.__waiters -= 1
+
+
+@dataclass
+class SingleFlightStats:
+    leaders: int = 0
+    followers: int = 0
+
+
+class SingleFlight:
+    # side-effect free reads whose answer can be shared by callers that overlap
+    COALESCABLE_METHODS = {
+        "web3_clientVersion",
+        "net_version",
+        "net_listening",
+        "eth_chainId",
+        "eth_syncing",
+        "eth_blockNumber",
+        "eth_gasPrice",
+        "eth_maxPriorityFeePerGas",
+        "eth_blobBaseFee",
+        "eth_feeHistory",
+        "eth_getBalance",
+        "eth_getCode",
+        "eth_getStorageAt",
+        "eth_getTransactionCount",
+        "eth_getProof",
+        "eth_call",
+        "eth_estimateGas",
+        "eth_getBlockByNumber",
+        "eth_getBlockByHash",
+        "eth_getTransactionByHash",
+        "eth_getTransactionReceipt",
+    }
+
+    def __init__(self):
+        self.__in_flight: Dict[Hashable, Flight] = {}
+        # (external_id, anvil_id) -> number of writes seen
+        self.__epochs: Dict[Tuple[str, str], int] = {}
+
+        self.stats = SingleFlightStats()
+
+    def is_coalescable(self, method: str) -> bool:
+        return method in self.COALESCABLE_METHODS
+
+    def observe_write(self, external_id: str, anvil_id: str, method: str):
+        # anything that isn't a known read may change node state (transactions,
+        # evm_*, anvil_*, ...); a read that starts after it must not be answered
+        # by a read that started before it
+        if method not in self.COALESCABLE_METHODS:
+            node = (external_id, anvil_id)
+            self.__epochs[node] = self.__epochs.get(node, 0) + 1
+
+    def make_key(
+        self, external_id: str, anvil_id: str, method: str, params: bytes
+    ) -> Hashable:
+        return (
+            external_id,
+            anvil_id,
+            self.__epochs.get((external_id, anvil_id), 0),
+            method,
+            params,
+        )
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        flight = self.__in_flight.get(key)
+        if flight is not None:
+            self.stats.followers += 1
+            return await flight.wait(), False
+
+        self.stats.leaders += 1
+        flight = Flight(fn())
+        self.__in_flight[key] = flight
+        flight.task.add_done_callback(lambda _: self.__in_flight.pop(key, None))
+        return await flight.wait(), True
+
+    def drop_instance(self, external_id: str):
+        for node in [node for node in self.__epochs if node[0] == external_id]:
+            del self.__epochs[node]
+
+    def on_instance_event(self, event: InstanceEvent):
+        if event["type"] == "unregister":
+            self.drop_instance(event["external_id"])
+
+    def get_stats(self) -> Dict[str, int]:
+        return asdict(self.stats)
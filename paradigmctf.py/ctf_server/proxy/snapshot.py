@@ -0,0 +1,230 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+import orjson
+
+from ctf_server.databases.asyncdatabase import AsyncDatabase
+from ctf_server.databases.database import Database
+from ctf_server.types import InstanceEvent, InstanceRoute
+
+from .routing import Route, RoutingTable, make_route
+
+# generation, then the payload length of each of the two slots
+HEADER = struct.Struct("<QQQ")
+HEADER_SIZE = 64
+
+DEFAULT_SNAPSHOT_SIZE = 64 * 1024 * 1024
+
+
+# The snapshot is a file (normally in /dev/shm) holding every route as one json
+# document. The writer fills whichever slot readers aren't using and then bumps
+# the generation, whose parity names the live slot. Readers copy the live slot
+# and keep it only if the generation didn't move meanwhile, so neither side
+# ever takes a lock.
+class RouteSnapshotWriter:
+    def __init__(self, path: str, size: int = DEFAULT_SNAPSHOT_SIZE):
+        self.__slot_size = (size - HEADER_SIZE) // 2
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.__mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.__generation = 0
+
+    def publish(self, routes: Dict[str, InstanceRoute]):
+        data = orjson.dumps(routes)
+        if len(data) > self.__slot_size:
+            raise ValueError(
+                f"route snapshot is {len(data)} bytes, only {self.__slot_size} fit"
+            )
+
+        slot = (self.__generation + 1) % 2
+        offset = HEADER_SIZE + slot * self.__slot_size
+        self.__mm[offset : offset + len(data)] = data
+        struct.pack_into("<Q", self.__mm, 8 + slot * 8, len(data))
+
+        self.__generation += 1
+        struct.pack_into("<Q", self.__mm, 0, self.__generation)
+
+    def close(self):
+        self.__mm.close()
+
+
+class RouteSnapshotReader:
+    def __init__(self, path: str):
+        self.__path = path
+        self.__mm: Optional[mmap.mmap] = None
+        self.__slot_size = 0
+
+        self.generation = 0
+        self.routes: Dict[str, InstanceRoute] = {}
+
+    def refresh(self) -> bool:
+        # returns whether a snapshot is available; only parses when it changed
+        if self.__mm is None and not self.__open():
+            return False
+
+        generation = struct.unpack_from("<Q", self.__mm, 0)[0]
+        if generation == self.generation:
+            return generation != 0
+
+        for _ in range(8):
+            generation, *lengths = HEADER.unpack_from(self.__mm, 0)
+            slot = generation % 2
+            offset = HEADER_SIZE + slot * self.__slot_size
+            data = self.__mm[offset : offset + lengths[slot]]
+
+            if struct.unpack_from("<Q", self.__mm, 0)[0] == generation:
+                self.routes = orjson.loads(data)
+                self.generation = generation
+                return True
+
+        # the writer kept moving under us, try again on the next lookup
+        return self.generation != 0
+
+    def __open(self) -> bool:
+        try:
+            fd = os.open(self.__path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+
+        try:
+            size = os.fstat(fd).st_size
+            if size <= HEADER_SIZE:
+                return False
+
+            self.__mm = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+            self.__slot_size = (size - HEADER_SIZE) // 2
+            return True
+        finally:
+            os.close(fd)
+
+
+class SnapshotRoutingTable(RoutingTable):
+    def __init__(self, database: AsyncDatabase, snapshot: RouteSnapshotReader, **kwargs):
+        super().__init__(database, **kwargs)
+
+        self.__snapshot = snapshot
+        # routes built from the current snapshot generation
+        self.__generation = 0
+        self.__routes: Dict[str, Route] = {}
+        # unregistered instances the snapshot may still list, until it's
+        # republished without them; their containers are already going away
+        self.__unregistered: Set[str] = set()
+
+        database.subscribe_instance_events(self.__on_instance_event)
+
+    async def lookup(self, external_id: str) -> Optional[Route]:
+        if self.__snapshot.refresh():
+            if self.__snapshot.generation != self.__generation:
+                self.__generation = self.__snapshot.generation
+                self.__routes = {}
+                self.__unregistered = {
+                    unregistered
+                    for unregistered in self.__unregistered
+                    if unregistered in self.__snapshot.routes
+                }
+
+            if external_id in self.__unregistered:
+                return await super().lookup(external_id)
+
+            route = self.__routes.get(external_id)
+            if route is not None:
+                return route
+
+            instance_route = self.__snapshot.routes.get(external_id)
+            if instance_route is not None:
+                route = make_route(instance_route)
+                self.__routes[external_id] = route
+                return route
+
+        # the instance may be newer than the snapshot, ask the database
+        return await super().lookup(external_id)
+
+    def __on_instance_event(self, event: InstanceEvent):
+        if event["type"] == "unregister":
+            self.__unregistered.add(event["external_id"])
+            self.__routes.pop(event["external_id"], None)
+        elif event["type"] == "register":
+            # registered again, whatever the snapshot says next is current
+            self.__unregistered.discard(event["external_id"])
+
+
+class RoutePublisher:
+    def __init__(
+        self,
+        database: Database,
+        writer: RouteSnapshotWriter,
+        refresh_interval: float = 30,
+        debounce: float = 0.01,
+    ):
+        self.__database = database
+        self.__writer = writer
+        self.__refresh_interval = refresh_interval
+        self.__debounce = debounce
+
+        self.__routes: Dict[str, InstanceRoute] = {}
+        self.__lock = threading.Lock()
+        self.__pending: List[InstanceEvent] = []
+        self.__wakeup = threading.Event()
+
+        database.subscribe_instance_events(self.__on_instance_event)
+
+    def start(self):
+        self.__reload()
+
+        threading.Thread(
+            target=self.__publisher_thread,
+            name="Route Snapshot Publisher",
+            daemon=True,
+        ).start()
+
+    def __on_instance_event(self, event: InstanceEvent):
+        with self.__lock:
+            self.__pending.append(event)
+        self.__wakeup.set()
+
+    def __publisher_thread(self):
+        while True:
+            woken = self.__wakeup.wait(self.__refresh_interval)
+            if woken:
+                # let a burst of launches land in a single snapshot
+                time.sleep(self.__debounce)
+            self.__wakeup.clear()
+
+            with self.__lock:
+                events, self.__pending = self.__pending, []
+
+            try:
+                if not woken or any(event["type"] == "resync" for event in events):
+                    self.__reload()
+                else:
+                    self.__apply(events)
+            except Exception as e:
+                logging.error("failed to publish route snapshot", exc_info=e)
+                # start from scratch next time
+                self.__on_instance_event(InstanceEvent(type="resync"))
+                time.sleep(1)
+
+    def __apply(self, events: List[InstanceEvent]):
+        for event in events:
+            if event["type"] == "register":
+                route = self.__database.get_route_by_external_id(event["external_id"])
+                if route is not None:
+                    self.__routes[event["external_id"]] = route
+            elif event["type"] == "unregister":
+                self.__routes.pop(event["external_id"], None)
+
+        self.__writer.publish(self.__routes)
+
+    def __reload(self):
+        self.__routes = self.__database.get_all_routes()
+        self.__writer.publish(self.__routes)
@@ -0,0 +1,77 @@
+import logging
+import os
+import secrets
+import tempfile
+
+import uvicorn
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+
+from ctf_server.databases.database import Database
+from ctf_server.utils import load_database
+
+from .compression import ThresholdPerMessageDeflateFactory
+from .snapshot import DEFAULT_SNAPSHOT_SIZE, RoutePublisher, RouteSnapshotWriter
+
+# websocket messages smaller than this are sent uncompressed
+WS_COMPRESSION_MIN_SIZE = int(os.getenv("WS_COMPRESSION_MIN_SIZE", "1024"))
+# websockets deflates inline while writing the frame, so keep it cheap
+WS_COMPRESSION_LEVEL = int(os.getenv("WS_COMPRESSION_LEVEL", "1"))
+
+
+def default_snapshot_path() -> str:
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, f"anvil-proxy-routes-{os.getpid()}")
+
+
+class ProxyWebSocketProtocol(WebSocketProtocol):
+    # uvicorn's websocket protocol, but small messages skip permessage-deflate
+    def __init__(self, config: uvicorn.Config, *args, **kwargs):
+        super().__init__(config, *args, **kwargs)
+
+        if config.ws_per_message_deflate:
+            self.available_extensions = [
+                ThresholdPerMessageDeflateFactory(
+                    min_size=WS_COMPRESSION_MIN_SIZE,
+                    compress_settings={"level": WS_COMPRESSION_LEVEL},
+                )
+            ]
+
+
+# Runs anvil_proxy on several worker processes sharing one listening socket. This
+# process keeps the route snapshot up to date so the workers never have to ask
+# the database where an instance lives.
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    workers = int(os.getenv("PROXY_WORKERS", str(os.cpu_count() or 1)))
+    host = os.getenv("PROXY_HOST", "0.0.0.0")
+    port = int(os.getenv("PROXY_PORT", "8545"))
+
+    path = os.getenv("ROUTE_SNAPSHOT_PATH") or default_snapshot_path()
+    size = int(os.getenv("ROUTE_SNAPSHOT_SIZE", str(DEFAULT_SNAPSHOT_SIZE)))
+    refresh_interval = float(os.getenv("ROUTE_SNAPSHOT_REFRESH_INTERVAL", "30"))
+
+    # inherited by the workers
+    os.environ["ROUTE_SNAPSHOT_PATH"] = path
+    os.environ["PROXY_WORKERS"] = str(workers)
+    os.environ.setdefault("CAPTURE_SALT", secrets.token_hex(16))
+
+    database: Database = load_database()
+    writer = RouteSnapshotWriter(path, size)
+    RoutePublisher(database, writer, refresh_interval=refresh_interval).start()
+
+    try:
+        uvicorn.run(
+            "ctf_server:anvil_proxy",
+            host=host,
+            port=port,
+            workers=workers,
+            ws=ProxyWebSocketProtocol,
+        )
+    finally:
+        writer.close()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
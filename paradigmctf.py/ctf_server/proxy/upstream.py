@@ -0,0 +1,141 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Optional
+
+import aiohttp
+
+from ctf_server.types import InstanceEvent
+
+
+@dataclass
+class PoolStats:
+    created_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.monotonic)
+    requests: int = 0
+    in_flight: int = 0
+    errors: int = 0
+    timeouts: int = 0
+
+
+class UpstreamPool:
+    def __init__(
+        self,
+        max_connections_per_host: int,
+        keepalive_timeout: float,
+        connect_timeout: float,
+        read_timeout: float,
+    ):
+        self.stats = PoolStats()
+        self.__session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=max_connections_per_host,
+                keepalive_timeout=keepalive_timeout,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=connect_timeout,
+                sock_read=read_timeout,
+            ),
+        )
+
+    @asynccontextmanager
+    async def post(self, url: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        self.stats.requests += 1
+        self.stats.in_flight += 1
+        self.stats.last_used = time.monotonic()
+        try:
+            async with self.__session.post(url, **kwargs) as resp:
+                yield resp
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        except Exception:
+            self.stats.errors += 1
+            raise
+        finally:
+            self.stats.in_flight -= 1
+
+    async def close(self):
+        await self.__session.close()
+
+
+class UpstreamPools:
+    def __init__(
+        self,
+        max_connections_per_host: int = 32,
+        keepalive_timeout: float = 30,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        idle_timeout: float = 300,
+    ):
+        self.__max_connections_per_host = max_connections_per_host
+        self.__keepalive_timeout = keepalive_timeout
+        self.__connect_timeout = connect_timeout
+        self.__read_timeout = read_timeout
+        self.__idle_timeout = idle_timeout
+
+        # external_id -> pool shared by every anvil node of that instance
+        self.__pools: Dict[str, UpstreamPool] = {}
+        self.__reaper: Optional[asyncio.Task] = None
+
+    def get(self, external_id: str) -> UpstreamPool:
+        pool = self.__pools.get(external_id)
+        if pool is None:
+            pool = UpstreamPool(
+                max_connections_per_host=self.__max_connections_per_host,
+                keepalive_timeout=self.__keepalive_timeout,
+                connect_timeout=self.__connect_timeout,
+                read_timeout=self.__read_timeout,
+            )
+            self.__pools[external_id] = pool
+
+            if self.__reaper is None:
+                self.__reaper = asyncio.create_task(self.__reap_idle_pools())
+
+        return pool
+
+    def release(self, external_id: str):
+        pool = self.__pools.pop(external_id, None)
+        if pool is not None:
+            asyncio.create_task(pool.close())
+
+    async def close(self):
+        if self.__reaper is not None:
+            self.__reaper.cancel()
+
+        pools = list(self.__pools.values())
+        self.__pools.clear()
+        await asyncio.gather(*[pool.close() for pool in pools])
+
+    def get_stats(self) -> Dict[str, int]:
+        # summed over every instance, per-instance labels would grow without bound
+        stats = {
+            "pools": len(self.__pools),
+            "requests": 0,
+            "in_flight": 0,
+            "errors": 0,
+            "timeouts": 0,
+        }
+        for pool in self.__pools.values():
+            stats["requests"] += pool.stats.requests
+            stats["in_flight"] += pool.stats.in_flight
+            stats["errors"] += pool.stats.errors
+            stats["timeouts"] += pool.stats.timeouts
+        return stats
+
+    def on_instance_event(self, event: InstanceEvent):
+        if event["type"] == "unregister":
+            self.release(event["external_id"])
+
+    async def __reap_idle_pools(self):
+        # catches instances whose unregister event we never saw
+        while True:
+            await asyncio.sleep(self.__idle_timeout / 2)
+
+            deadline = time.monotonic() - self.__idle_timeout
+            for external_id, pool in list(self.__pools.items()):
+                if pool.stats.in_flight == 0 and pool.stats.last_used < deadline:
+                    self.release(external_id)
@@ -0,0 +1,393 @@
+import asyncio
+import logging
+import secrets
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import orjson
+import websockets
+from fastapi import WebSocket
+from starlette.websockets import WebSocketState
+
+from ctf_server.types import InstanceEvent
+
+from .cache import canonical_params
+
+
+@dataclass
+class WebSocketStats:
+    upstreams: int = 0
+    clients: int = 0
+    subscriptions: int = 0
+    subscribers: int = 0
+    dropped_slow_clients: int = 0
+
+
+class WebSocketClient:
+    def __init__(
+        self,
+        ws: WebSocket,
+        max_queue: int,
+        on_send: Optional[Callable[[int], None]] = None,
+    ):
+        self.ws = ws
+        self.closed = False
+        # sent to the client when closing
+        self.close_code = 1000
+        self.close_reason = ""
+        self.__on_send = on_send
+        # client subscription id -> shared subscription
+        self.subscriptions: Dict[str, "Subscription"] = {}
+
+        self.__queue: asyncio.Queue[Optional[str]] = asyncio.Queue(max_queue)
+
+    def send(self, message: bytes) -> bool:
+        if self.closed:
+            return True
+
+        try:
+            self.__queue.put_nowait(message.decode())
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def close(self, code: int = 1000, reason: str = ""):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.close_code = code
+        self.close_reason = reason
+        # wake the pump so it can close the socket
+        while not self.__queue.empty():
+            self.__queue.get_nowait()
+        self.__queue.put_nowait(None)
+
+    async def pump(self):
+        while True:
+            message = await self.__queue.get()
+            if message is None:
+                break
+
+            try:
+                await self.ws.send_text(message)
+            except Exception:
+                # the client went away, the receive loop will detach it
+                self.closed = True
+                return
+
+            if self.__on_send is not None:
+                self.__on_send(len(message))
+
+        if self.ws.application_state == WebSocketState.CONNECTED:
+            try:
+                await self.ws.close(code=self.close_code, reason=self.close_reason)
+            except Exception:
+                # the client already went away
+                pass
+
+
+@dataclass
+class Subscription:
+    key: bytes
+    upstream_id: Optional[str] = None
+    # client -> the subscription id that client knows this subscription by
+    subscribers: Dict[WebSocketClient, str] = field(default_factory=dict)
+    # clients waiting for the upstream eth_subscribe to complete
+    waiters: List[Tuple[WebSocketClient, Any, str]] = field(default_factory=list)
+
+
+def jsonrpc_message(id: Any, key: str, value: Any) -> bytes:
+    return orjson.dumps({"jsonrpc": "2.0", "id": id, key: value})
+
+
+class UpstreamWebSocket:
+    def __init__(self, url: str, multiplexer: "WebSocketMultiplexer", key: Tuple[str, str]):
+        self.__url = url
+        self.__multiplexer = multiplexer
+        self.__key = key
+
+        self.__ws: Optional[websockets.WebSocketClientProtocol] = None
+        self.__reader: Optional[asyncio.Task] = None
+        self.__next_id = 0
+        self.closed = False
+
+        self.clients: Set[WebSocketClient] = set()
+        # upstream request id -> (client, client request id) or the subscription being created
+        self.__pending: Dict[int, Tuple[Optional[WebSocketClient], Any, Optional[Subscription]]] = {}
+        # canonical eth_subscribe params -> subscription
+        self.subscriptions: Dict[bytes, Subscription] = {}
+        self.__by_upstream_id: Dict[str, Subscription] = {}
+
+    async def connect(self):
+        self.__ws = await websockets.connect(
+            self.__url,
+            # the upstream is on the cluster network, don't spend cpu compressing
+            compression=None,
+            max_size=64 * 1024 * 1024,
+        )
+        self.__reader = asyncio.create_task(self.__read())
+
+    def attach(self, client: WebSocketClient):
+        if self.closed:
+            # released while the client was waiting for it, it'll reconnect
+            # and get a fresh upstream
+            client.close(1011, "upstream closed")
+            return
+
+        self.clients.add(client)
+
+    def detach(self, client: WebSocketClient):
+        client.close()
+        self.clients.discard(client)
+
+        for subscription_id in list(client.subscriptions):
+            self.__unsubscribe(client, subscription_id)
+
+        if len(self.clients) == 0:
+            self.__multiplexer.release(self.__key, self)
+
+    async def handle(self, client: WebSocketClient, message: Dict):
+        method = message["method"]
+        if method == "eth_subscribe":
+            await self.__subscribe(client, message)
+        elif method == "eth_unsubscribe":
+            params = message.get("params")
+            subscription_id = params[0] if isinstance(params, list) and len(params) > 0 else None
+            client.send(
+                jsonrpc_message(
+                    message["id"], "result", self.__unsubscribe(client, subscription_id)
+                )
+            )
+        else:
+            await self.__send(message, client=client)
+
+    async def close(self, code: int = 1001, reason: str = "upstream closed"):
+        # clients are closed first so the reader, once cancelled, doesn't
+        # report this as an upstream failure
+        self.closed = True
+        for client in list(self.clients):
+            client.close(code, reason)
+
+        if self.__reader is not None:
+            self.__reader.cancel()
+
+        if self.__ws is not None:
+            await self.__ws.close()
+
+    async def __send(
+        self,
+        message: Dict,
+        client: Optional[WebSocketClient] = None,
+        subscription: Optional[Subscription] = None,
+    ):
+        self.__next_id += 1
+        self.__pending[self.__next_id] = (client, message.get("id"), subscription)
+        await self.__ws.send(orjson.dumps({**message, "id": self.__next_id}).decode())
+
+    async def __subscribe(self, client: WebSocketClient, message: Dict):
+        key = canonical_params(message.get("params", []))
+        subscription_id = "0x" + secrets.token_hex(16)
+
+        subscription = self.subscriptions.get(key)
+        if subscription is not None and subscription.upstream_id is not None:
+            subscription.subscribers[client] = subscription_id
+            client.subscriptions[subscription_id] = subscription
+            client.send(jsonrpc_message(message["id"], "result", subscription_id))
+            return
+
+        if subscription is not None:
+            subscription.waiters.append((client, message["id"], subscription_id))
+            return
+
+        subscription = Subscription(key=key)
+        subscription.waiters.append((client, message["id"], subscription_id))
+        self.subscriptions[key] = subscription
+
+        await self.__send(message, subscription=subscription)
+
+    def __unsubscribe(self, client: WebSocketClient, subscription_id: Any) -> bool:
+        subscription = client.subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            return False
+
+        subscription.subscribers.pop(client, None)
+        if len(subscription.subscribers) == 0 and len(subscription.waiters) == 0:
+            self.__drop_subscription(subscription)
+        return True
+
+    def __drop_subscription(self, subscription: Subscription):
+        # last subscriber is gone, stop the upstream subscription too
+        del self.subscriptions[subscription.key]
+        del self.__by_upstream_id[subscription.upstream_id]
+        if not self.__ws.closed:
+            asyncio.create_task(
+                self.__send(
+                    {
+                        "jsonrpc": "2.0",
+                        "method": "eth_unsubscribe",
+                        "params": [subscription.upstream_id],
+                    }
+                )
+            )
+
+    async def __read(self):
+        try:
+            async for raw_message in self.__ws:
+                try:
+                    message = orjson.loads(raw_message)
+                except orjson.JSONDecodeError:
+                    continue
+
+                if not isinstance(message, dict):
+                    continue
+
+                if message.get("method") == "eth_subscription":
+                    self.__on_notification(message)
+                else:
+                    self.__on_response(message)
+        except Exception as e:
+            logging.error("upstream websocket %s failed", self.__url, exc_info=e)
+        finally:
+            # clients reconnect and get a fresh upstream
+            self.__multiplexer.release(self.__key, self)
+            self.closed = True
+            for client in list(self.clients):
+                client.close(1011, "upstream failed")
+
+    def __on_response(self, message: Dict):
+        pending = self.__pending.pop(message.get("id"), None)
+        if pending is None:
+            return
+
+        client, request_id, subscription = pending
+        if subscription is None:
+            if client is not None:
+                self.__deliver(client, orjson.dumps({**message, "id": request_id}))
+            return
+
+        waiters, subscription.waiters = subscription.waiters, []
+        if "result" not in message:
+            del self.subscriptions[subscription.key]
+            for client, request_id, _ in waiters:
+                self.__deliver(client, orjson.dumps({**message, "id": request_id}))
+            return
+
+        subscription.upstream_id = message["result"]
+        self.__by_upstream_id[subscription.upstream_id] = subscription
+        for client, request_id, subscription_id in waiters:
+            if client.closed:
+                continue
+
+            subscription.subscribers[client] = subscription_id
+            client.subscriptions[subscription_id] = subscription
+            self.__deliver(client, jsonrpc_message(request_id, "result", subscription_id))
+
+        if len(subscription.subscribers) == 0:
+            # everyone left while we were subscribing
+            self.__drop_subscription(subscription)
+
+    def __on_notification(self, message: Dict):
+        params = message.get("params")
+        if not isinstance(params, dict):
+            return
+
+        subscription = self.__by_upstream_id.get(params.get("subscription"))
+        if subscription is None:
+            return
+
+        # encode the payload once and splice in each client's subscription id
+        result = orjson.dumps(params.get("result"))
+        for client, subscription_id in list(subscription.subscribers.items()):
+            self.__deliver(
+                client,
+                b'{"jsonrpc":"2.0","method":"eth_subscription","params":{"subscription":"'
+                + subscription_id.encode()
+                + b'","result":'
+                + result
+                + b"}}",
+            )
+
+    def __deliver(self, client: WebSocketClient, message: bytes):
+        if client.send(message):
+            return
+
+        logging.warning("dropping websocket client that fell behind on %s", self.__url)
+        self.__multiplexer.stats.dropped_slow_clients += 1
+        client.close(1008, "client too slow")
+
+
+class WebSocketMultiplexer:
+    def __init__(self):
+        # (external_id, anvil_id) -> shared upstream connection
+        self.__upstreams: Dict[Tuple[str, str], UpstreamWebSocket] = {}
+        self.__connecting: Dict[Tuple[str, str], asyncio.Future] = {}
+
+        self.stats = WebSocketStats()
+
+    async def acquire(self, external_id: str, anvil_id: str, url: str) -> UpstreamWebSocket:
+        key = (external_id, anvil_id)
+
+        upstream = self.__upstreams.get(key)
+        if upstream is not None:
+            return upstream
+
+        connecting = self.__connecting.get(key)
+        if connecting is not None:
+            return await asyncio.shield(connecting)
+
+        connecting = asyncio.get_running_loop().create_future()
+        self.__connecting[key] = connecting
+        try:
+            upstream = UpstreamWebSocket(url, self, key)
+            await upstream.connect()
+            self.__upstreams[key] = upstream
+            connecting.set_result(upstream)
+            return upstream
+        except Exception as e:
+            connecting.set_exception(e)
+            # mark the exception as retrieved in case nobody else was waiting
+            connecting.exception()
+            raise
+        finally:
+            if not connecting.done():
+                connecting.cancel()
+            del self.__connecting[key]
+
+    def release(
+        self,
+        key: Tuple[str, str],
+        upstream: UpstreamWebSocket,
+        code: int = 1001,
+        reason: str = "upstream closed",
+    ):
+        if self.__upstreams.get(key) is upstream:
+            del self.__upstreams[key]
+            asyncio.create_task(upstream.close(code, reason))
+
+    async def close(self):
+        upstreams = list(self.__upstreams.values())
+        self.__upstreams.clear()
+        await asyncio.gather(
+            *[upstream.close(1001, "proxy shutting down") for upstream in upstreams]
+        )
+
+    def on_instance_event(self, event: InstanceEvent):
+        if event["type"] != "unregister":
+            return
+
+        for key in [key for key in self.__upstreams if key[0] == event["external_id"]]:
+            self.release(key, self.__upstreams[key], 1001, "instance stopped")
+
+    def get_stats(self) -> Dict[str, int]:
+        self.stats.upstreams = len(self.__upstreams)
+        self.stats.clients = sum(len(u.clients) for u in self.__upstreams.values())
+        self.stats.subscriptions = sum(
+            len(u.subscriptions) for u in self.__upstreams.values()
+        )
+        self.stats.subscribers = sum(
+            len(s.subscribers)
+            for u in self.__upstreams.values()
+            for s in u.subscriptions.values()
+        )
+        return asdict(self.stats)
@@ -1,6 +1,7 @@
 import os
 import subprocess
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Dict, List, NotRequired, Optional
 
 from eth_account import Account
@@ -18,6 +19,15 @@ DEFAULT_MNEMONIC = "test test test test test test test test test test test junk"
 PUBLIC_HOST = os.getenv("PUBLIC_HOST", "http://127.0.0.1:8545")
 
 
+class RpcPolicyArgs(TypedDict):
+    # namespaces players may call, replaces the default of web3, eth and net
+    allowed_namespaces: NotRequired[Optional[List[str]]]
+    # methods allowed regardless of namespace, e.g. debug_traceCall
+    allowed_methods: NotRequired[Optional[List[str]]]
+    # methods forbidden on top of the default signing methods
+    disallowed_methods: NotRequired[Optional[List[str]]]
+
+
 class LaunchAnvilInstanceArgs(TypedDict):
     image: NotRequired[Optional[str]]
     accounts: NotRequired[Optional[int]]
@@ -31,6 +41,7 @@ class LaunchAnvilInstanceArgs(TypedDict):
     chain_id: NotRequired[Optional[int]]
     code_size_limit: NotRequired[Optional[int]]
     block_time: NotRequired[Optional[int]]
+    rpc_policy: NotRequired[Optional[RpcPolicyArgs]]
 
 
 def format_anvil_args(args: LaunchAnvilInstanceArgs, anvil_id: str, port: int = 8545) -> List[str]:
@@ -65,21 +76,47 @@ def format_anvil_args(args: LaunchAnvilInstanceArgs, anvil_id: str, port: int =
     return cmd_args
 
 
+class WarmPoolArgs(TypedDict):
+    # nodes kept booted for launches whose node with this id matches the profile
+    size: int
+    anvil_id: NotRequired[Optional[str]]
+    # seconds before an unclaimed node is replaced
+    max_age: NotRequired[Optional[float]]
+    # only the fields that change how anvil boots are compared
+    profile: NotRequired[Optional[LaunchAnvilInstanceArgs]]
+
+
 class DaemonInstanceArgs(TypedDict):
     image: str
 
 
+class RateLimitArgs(TypedDict):
+    # tokens per second and bucket size, requests cost one token unless weighted;
+    # instances are only limited once a rate is set here or on the proxy
+    rate: NotRequired[Optional[float]]
+    burst: NotRequired[Optional[float]]
+    # requests allowed to wait for tokens, and how long they may wait
+    max_queue: NotRequired[Optional[int]]
+    max_wait: NotRequired[Optional[float]]
+    method_costs: NotRequired[Optional[Dict[str, int]]]
+
+
 class CreateInstanceRequest(TypedDict):
     instance_id: str
     timeout: int
+    # counted against the team's instance quota
+    team_id: NotRequired[Optional[str]]
     anvil_instances: NotRequired[Dict[str, LaunchAnvilInstanceArgs]]
     daemon_instances: NotRequired[Dict[str, DaemonInstanceArgs]]
+    rate_limit: NotRequired[Optional[RateLimitArgs]]
+    rpc_policy: NotRequired[Optional[RpcPolicyArgs]]
 
 
 class InstanceInfo(TypedDict):
     id: str
     ip: str
     port: int
+    rpc_policy: NotRequired[Optional[RpcPolicyArgs]]
 
 
 @dataclass
@@ -99,6 +136,9 @@ class UserData(TypedDict):
     # launch_args: Dict[str, LaunchAnvilInstanceArgs]
     anvil_instances: Dict[str, InstanceInfo]
     daemon_instances: Dict[str, InstanceInfo]
+    rate_limit: NotRequired[Optional[RateLimitArgs]]
+    rpc_policy: NotRequired[Optional[RpcPolicyArgs]]
+    team_id: NotRequired[Optional[str]]
     metadata: Dict
 
     # def get_privileged_account(self, offset: int) -> LocalAccount:
@@ -128,11 +168,67 @@ class UserData(TypedDict):
     #     )
 
 
-def get_account(mnemonic: str, offset: int) -> LocalAccount:
-    seed = seed_from_mnemonic(mnemonic, "")
-    private_key = key_from_seed(seed, f"{DEFAULT_DERIVATION_PATH}{offset}")
+class JobEvent(TypedDict):
+    # "queued", "creating", "waiting", "funding", "registering", then
+    # "succeeded" or "failed"; detail names the node for per-node phases
+    phase: str
+    detail: Optional[str]
+    time: float
+
+
+class LaunchJobInfo(TypedDict):
+    job_id: str
+    instance_id: str
+    # "queued", "running", "succeeded" or "failed"
+    status: str
+    phase: str
+    events: List[JobEvent]
+    created_at: float
+    finished_at: Optional[float]
+    # launches ahead of this one while it waits for capacity
+    position: NotRequired[int]
+    data: NotRequired[UserData]
+    message: NotRequired[str]
+
+
+class InstanceRoute(TypedDict):
+    instance_id: str
+    anvil_instances: Dict[str, InstanceInfo]
+    rate_limit: NotRequired[Optional[RateLimitArgs]]
+    rpc_policy: NotRequired[Optional[RpcPolicyArgs]]
+
+
+class InstanceEvent(TypedDict):
+    # one of "register", "unregister", or "resync" if events may have been lost
+    type: str
+    instance_id: NotRequired[str]
+    external_id: NotRequired[str]
+    # on register, so expiry can be scheduled without reading the instance back
+    expires_at: NotRequired[float]
+
+
+def get_instance_route(instance: UserData) -> InstanceRoute:
+    return InstanceRoute(
+        instance_id=instance["instance_id"],
+        anvil_instances=instance.get("anvil_instances", {}),
+        rate_limit=instance.get("rate_limit"),
+        rpc_policy=instance.get("rpc_policy"),
+    )
 
-    return Account.from_key(private_key)
+
+@lru_cache(maxsize=64)
+def get_seed(mnemonic: str) -> bytes:
+    # 2048 rounds of pbkdf2, and every launch derives a dozen keys from one mnemonic
+    return seed_from_mnemonic(mnemonic, "")
+
+
+@lru_cache(maxsize=4096)
+def derive_account(mnemonic: str, derivation_path: str) -> LocalAccount:
+    return Account.from_key(key_from_seed(get_seed(mnemonic), derivation_path))
+
+
+def get_account(mnemonic: str, offset: int) -> LocalAccount:
+    return derive_account(mnemonic, f"{DEFAULT_DERIVATION_PATH}{offset}")
 
 
 def get_player_account(mnemonic: str) -> LocalAccount:
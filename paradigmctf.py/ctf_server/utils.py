@@ -1,16 +1,27 @@
 import os
 
 from .backends import Backend, KubernetesBackend, DockerBackend
-from .databases import Database, RedisDatabase, SQLiteDatabase
+from .databases import (
+    AsyncDatabase,
+    AsyncRedisDatabase,
+    AsyncSQLiteDatabase,
+    Database,
+    RedisDatabase,
+    SQLiteDatabase,
+)
 
 
-def load_database() -> Database:
+def load_database(asynchronous: bool = False) -> Database | AsyncDatabase:
     dbtype = os.getenv("DATABASE", "sqlite")
     if dbtype == "sqlite":
         dbpath = os.getenv("SQLITE_PATH", ":memory:")
+        if asynchronous:
+            return AsyncSQLiteDatabase(dbpath)
         return SQLiteDatabase(dbpath)
     elif dbtype == "redis":
         url = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+        if asynchronous:
+            return AsyncRedisDatabase(url)
         return RedisDatabase(url)
 
     raise Exception("invalid database type", dbtype)
@@ -1,3 +1,6 @@
+from typing import Any, Dict, List, Tuple
+
+import requests
 from web3 import Web3
 from web3.types import RPCResponse
 
@@ -30,3 +33,33 @@ def anvil_setBalance(
     balance: str,
 ):
     check_error(web3.provider.make_request("anvil_setBalance", [addr, balance]))
+
+
+def make_batch_request(web3: Web3, calls: List[Tuple[str, List[Any]]]) -> List[RPCResponse]:
+    # this version of web3 can't batch, so post the batch to the endpoint directly
+    resp = requests.post(
+        web3.provider.endpoint_uri,
+        json=[
+            {"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+            for i, (method, params) in enumerate(calls)
+        ],
+        **{"timeout": 10, **web3.provider.get_request_kwargs()},
+    )
+    resp.raise_for_status()
+
+    results = resp.json()
+    if not isinstance(results, list):
+        check_error(results)
+        raise Exception("rpc exception", "batch not supported")
+    return sorted(results, key=lambda result: result["id"])
+
+
+def anvil_setBalances(web3: Web3, balances: Dict[str, str]):
+    if len(balances) == 0:
+        # anvil rejects an empty batch
+        return
+
+    for resp in make_batch_request(
+        web3, [("anvil_setBalance", [addr, balance]) for addr, balance in balances.items()]
+    ):
+        check_error(resp)
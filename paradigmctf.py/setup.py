@@ -13,6 +13,9 @@ setup(
         "fastapi==0.104.1",
         "docker==6.1.3",
         "pwntools==4.11.0",
+        "orjson==3.9.10",
     ],
-    py_modules=["foundry", "ctf_server", "ctf_launchers", "ctf_solvers"],
+    # optional, the proxy only offers br responses when it's installed
+    extras_require={"compression": ["Brotli==1.1.0"]},
+    py_modules=["foundry", "ctf_server", "ctf_launchers", "ctf_solvers", "ctf_benchmarks"],
 )